@@ -0,0 +1,286 @@
+"""Admin search over users and orders.
+
+Users are found by username, email or phone prefix; orders by id, customer
+email or phone prefix, customer name or address words, and/or a date range.
+Every lookup is an index range scan:
+
+* text keys are compared case-insensitively (``lower(...)``) and phone
+  numbers by their digits alone, through expression indexes created by
+  ``upgrade_schema()`` (and on the archive by order_archive.py);
+* names and addresses go through ``order_search``, an FTS5 table kept in
+  step with the hot order table by triggers (archived orders are only found
+  by id, email, phone or date);
+* results come in pages of PAGE_SIZE, ordered by the search key and id, and
+  the next page starts after an opaque ``after`` cursor (keyset pagination)
+  instead of an OFFSET, so page 1000 is as fast as page 1.
+
+When ``by`` is not given it is guessed from the query: ``#123`` or a short
+number is an order id, anything with ``@`` an email, digits with optional
+``+ - ( )`` and spaces a phone number, anything else a username (users) or
+a customer name or address (orders).
+"""
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import namedtuple
+from datetime import datetime
+import binascii
+import json
+import re
+
+from sqlalchemy import column, func, literal_column, select, table, text, tuple_, union_all
+
+from listings import OrderRow, UserRow
+from models import db, User
+from order_archive import get_order, order_tables
+
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+USER_FIELDS = ('username', 'email', 'phone')
+ORDER_FIELDS = ('id', 'email', 'phone', 'name', 'date')
+
+PHONE_PUNCTUATION = (' ', '-', '+', '(', ')')
+
+_PHONE = re.compile(r'^[\d\s()+-]*\d[\d\s()+-]*$')
+_ORDER_ID = re.compile(r'^#?(\d{1,9})$')
+_WORDS = re.compile(r'\w+', re.UNICODE)
+
+Page = namedtuple('Page', 'rows next_after')
+
+
+class SearchError(ValueError):
+    """The search parameters (field or cursor) are not valid, or the search is not available."""
+
+
+def _digits_sql(expression):
+    for char in PHONE_PUNCTUATION:
+        expression = f"replace({expression}, '{char}', '')"
+    return expression
+
+
+def _digits(column_expression):
+    # Literals, not bound parameters, so SQLite matches the index expression
+    for char in PHONE_PUNCTUATION:
+        column_expression = func.replace(column_expression, literal_column(f"'{char}'"), literal_column("''"))
+    return column_expression
+
+
+USER_INDEXES = (
+    ('ix_user_username_lower', 'lower(username)'),
+    ('ix_user_email_lower', 'lower(email)'),
+    ('ix_user_phone_digits', _digits_sql('phone')),
+)
+ORDER_INDEXES = (
+    ('ix_order_customer_email_lower', 'lower(customer_email)'),
+    ('ix_order_customer_phone_digits', _digits_sql('customer_phone')),
+    ('ix_order_order_date', 'order_date'),
+)
+
+_FTS_TRIGGERS = {
+    'order_search_insert': '''AFTER INSERT ON "order" BEGIN
+        INSERT INTO order_search (rowid, customer_name, customer_address)
+        VALUES (new.id, new.customer_name, new.customer_address);
+    END''',
+    'order_search_delete': '''AFTER DELETE ON "order" BEGIN
+        INSERT INTO order_search (order_search, rowid, customer_name, customer_address)
+        VALUES ('delete', old.id, old.customer_name, old.customer_address);
+    END''',
+    'order_search_update': '''AFTER UPDATE OF customer_name, customer_address ON "order" BEGIN
+        INSERT INTO order_search (order_search, rowid, customer_name, customer_address)
+        VALUES ('delete', old.id, old.customer_name, old.customer_address);
+        INSERT INTO order_search (rowid, customer_name, customer_address)
+        VALUES (new.id, new.customer_name, new.customer_address);
+    END''',
+}
+
+_order_search = table('order_search', column('rowid'))
+
+
+def upgrade_schema(engine):
+    """Create the search indexes and the order_search table; safe to run on every start."""
+    with engine.begin() as conn:
+        for name, expression in USER_INDEXES:
+            conn.execute(text(f'CREATE INDEX IF NOT EXISTS {name} ON user ({expression})'))
+        for name, expression in ORDER_INDEXES:
+            conn.execute(text(f'CREATE INDEX IF NOT EXISTS {name} ON "order" ({expression})'))
+
+        conn.execute(text(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS order_search USING fts5("
+            "customer_name, customer_address, content='order', content_rowid='id', "
+            "tokenize='unicode61 remove_diacritics 2')"
+        ))
+        existing = {row[0] for row in conn.execute(text("SELECT name FROM sqlite_master WHERE type = 'trigger'"))}
+        if not existing.issuperset(_FTS_TRIGGERS):
+            # New, or the order table was recreated (which drops its triggers): index every order again
+            for name, body in _FTS_TRIGGERS.items():
+                conn.execute(text(f'DROP TRIGGER IF EXISTS {name}'))
+                conn.execute(text(f'CREATE TRIGGER {name} {body}'))
+            conn.execute(text("INSERT INTO order_search (order_search) VALUES ('rebuild')"))
+
+
+def _encode(key, row_id):
+    if isinstance(key, datetime):
+        key = key.isoformat()
+    return urlsafe_b64encode(json.dumps([key, row_id]).encode()).decode().rstrip('=')
+
+
+def _decode(after, by):
+    try:
+        key, row_id = json.loads(urlsafe_b64decode(after + '=' * (-len(after) % 4)))
+        if by == 'date':
+            key = datetime.fromisoformat(key)
+    except (binascii.Error, ValueError, TypeError):
+        raise SearchError('invalid cursor') from None
+    # Names are paged by FTS rowid, everything else by a text key
+    key_type = int if by == 'name' else (datetime if by == 'date' else str)
+    if not isinstance(key, key_type) or isinstance(key, bool) \
+            or not isinstance(row_id, int) or isinstance(row_id, bool):
+        raise SearchError('invalid cursor')
+    return key, row_id
+
+
+def _prefix_range(key, prefix):
+    """``key`` starts with ``prefix``, as a range the index can seek to."""
+    if not prefix:
+        return []
+    return [key >= prefix, key < prefix[:-1] + chr(ord(prefix[-1]) + 1)]
+
+
+def _page_of(statement, row_type, limit):
+    """Run a statement selecting (search_key, *row_type fields) with limit + 1."""
+    result = db.session.execute(statement).all()
+    rows = [row_type._make(row[1:]) for row in result[:limit]]
+    if len(result) <= limit:
+        return Page(rows, None)
+    last = result[limit - 1]
+    return Page(rows, _encode(last[0], last[1]))
+
+
+def _limit(limit):
+    return max(1, min(int(limit or PAGE_SIZE), MAX_PAGE_SIZE))
+
+
+def guess_user_field(q):
+    if '@' in q:
+        return 'email'
+    return 'phone' if _PHONE.match(q) else 'username'
+
+
+def guess_order_field(q):
+    if not q:
+        return 'date'
+    if _ORDER_ID.match(q):
+        return 'id'
+    if '@' in q:
+        return 'email'
+    return 'phone' if _PHONE.match(q) else 'name'
+
+
+def search_users(q, by=None, after=None, limit=PAGE_SIZE):
+    """Users whose ``by`` field starts with ``q``, ordered by that field."""
+    q = q.strip()
+    by = by or guess_user_field(q)
+    if by not in USER_FIELDS:
+        raise SearchError(f'cannot search users by {by!r}')
+    limit = _limit(limit)
+    if by == 'phone':
+        key, prefix = _digits(User.phone), re.sub(r'\D', '', q)
+    else:
+        key, prefix = func.lower(getattr(User, by)), q.lower()
+
+    statement = select(key.label('search_key'), *[getattr(User, field) for field in UserRow._fields])
+    # Rows without the field can't be placed on a page boundary, so they are never listed
+    statement = statement.where(key.is_not(None), *_prefix_range(key, prefix))
+    if after:
+        after_key, after_id = _decode(after, by)
+        statement = statement.where(key >= after_key, tuple_(key, User.id) > tuple_(after_key, after_id))
+    statement = statement.order_by(key, User.id).limit(limit + 1)
+    return _page_of(statement, UserRow, limit)
+
+
+def _order_branch(source, by, q, start, end, after, limit):
+    """Matching orders of one table (hot or archive), newest key first."""
+    c = source.c
+    if by == 'email':
+        key = func.lower(c.customer_email)
+        conditions = _prefix_range(key, q.lower())
+    elif by == 'phone':
+        key = _digits(c.customer_phone)
+        conditions = _prefix_range(key, re.sub(r'\D', '', q))
+    else:
+        key = c.order_date
+        conditions = []
+    conditions.append(key.is_not(None))
+    if start is not None:
+        conditions.append(c.order_date >= start)
+    if end is not None:
+        conditions.append(c.order_date < end)
+    if after:
+        after_key, after_id = after
+        conditions += [key <= after_key, tuple_(key, c.id) < tuple_(after_key, after_id)]
+    return (select(key.label('search_key'), *[c[field] for field in OrderRow._fields])
+            .where(*conditions)
+            .order_by(key.desc(), c.id.desc())
+            .limit(limit + 1))
+
+
+def search_orders(q='', by=None, start=None, end=None, after=None, limit=PAGE_SIZE):
+    """Orders matching ``q`` (see the module docstring), optionally within [start, end).
+
+    Results are newest first: by key then id for email and phone searches,
+    by date for date searches and by id for name searches.
+    """
+    q = q.strip()
+    by = by or guess_order_field(q)
+    if by not in ORDER_FIELDS:
+        raise SearchError(f'cannot search orders by {by!r}')
+    limit = _limit(limit)
+
+    if by == 'id':
+        match = _ORDER_ID.match(q)
+        order = get_order(int(match.group(1))) if match else None
+        if order is None or (start is not None and order.order_date < start) \
+                or (end is not None and order.order_date >= end):
+            return Page([], None)
+        return Page([OrderRow._make(getattr(order, field) for field in OrderRow._fields)], None)
+
+    if by == 'name':
+        return _search_order_names(q, start, end, after, limit)
+
+    after = _decode(after, by) if after else None
+    branches = [_order_branch(source, by, q, start, end, after, limit) for source in order_tables(start)]
+    if len(branches) == 1:
+        return _page_of(branches[0], OrderRow, limit)
+    # Each branch is ordered and limited on its own index; merge the two short lists
+    merged = union_all(*[select(branch.subquery()) for branch in branches]).subquery()
+    statement = select(merged).order_by(merged.c.search_key.desc(), merged.c.id.desc()).limit(limit + 1)
+    return _page_of(statement, OrderRow, limit)
+
+
+def _search_order_names(q, start, end, after, limit):
+    words = _WORDS.findall(q)
+    if not words:
+        return Page([], None)
+    # Databases that upgrade_schema() has not run on yet have no order_search table
+    exists = text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'order_search'")
+    if db.session.execute(exists).first() is None:
+        raise SearchError('name search is not available until the search index is created')
+    # Every word, as a prefix; quoting keeps FTS5 operators in the input literal
+    match = ' '.join('"{}"*'.format(word.replace('"', '')) for word in words)
+    source = order_tables()[0]
+    c = source.c
+    statement = (select(_order_search.c.rowid.label('search_key'), *[c[field] for field in OrderRow._fields])
+                 .select_from(_order_search.join(source, c.id == _order_search.c.rowid))
+                 .where(text('order_search MATCH :match').bindparams(match=match)))
+    if start is not None or end is not None:
+        in_range = [c.order_date >= start] if start is not None else []
+        if end is not None:
+            in_range.append(c.order_date < end)
+        # Orders in the range lie between these ids: lets FTS5 skip the rest of its matches
+        low, high = db.session.execute(select(func.min(c.id), func.max(c.id)).where(*in_range)).one()
+        if low is None:
+            return Page([], None)
+        statement = statement.where(_order_search.c.rowid.between(low, high), *in_range)
+    if after:
+        statement = statement.where(_order_search.c.rowid < _decode(after, 'name')[1])
+    statement = statement.order_by(_order_search.c.rowid.desc()).limit(limit + 1)
+    return _page_of(statement, OrderRow, limit)
@@ -1,113 +1,117 @@
-from flask import Flask, render_template, url_for, request, redirect, session, flash, jsonify
-from flask_sqlalchemy import SQLAlchemy
+from flask import Flask, current_app, render_template, url_for, request, redirect, session, flash, jsonify, send_from_directory
 import os
 from datetime import datetime, timedelta
 import json
-from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
 import time
 import uuid
 import random
 import string
+import threading
+from functools import lru_cache
 from sqlalchemy import inspect
+from sqlalchemy.exc import IntegrityError
+from config import load_config
+import admin_search
+import bestsellers
+from models import db, User, Product, Order, Promotion
+from cart import CartError, apply_operations, price_cart, price_cart_details
+import fragments
+import group_commit
+from group_commit import run_write
+import listings
+import live_dashboard
+import money
+import order_archive
+import promotions
+import outbox  # records order and user changes in the same transaction
+import profiler
+import resilience
+import slow_queries
+import throttle
+from order_archive import get_order_or_404, query_orders
+from recommendations import get_recommender
+from reports import sales_report
+from identity import admin_required, current_user, login_required
+from inventory import INITIAL_STOCK, OutOfStockError, reserve_stock
+import warmup
 
-# Configure upload folder
-UPLOAD_FOLDER = 'static/images/profile'
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
 
-# Create upload folder if it doesn't exist
-os.makedirs(UPLOAD_FOLDER, exist_ok=True)
-
-app = Flask(__name__)
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///ecommerce.db'
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.secret_key = 'fashion_store_secret_key'  # Required for session management
-app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
-app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max upload size
-
-# Currency conversion rate (1 USD to INR)
-USD_TO_INR_RATE = 83.12  # As of March 2025 (example rate)
-
-db = SQLAlchemy(app)
-
-# User Model
-class User(db.Model):
-    id = db.Column(db.Integer, primary_key=True)
-    username = db.Column(db.String(80), unique=True, nullable=False)
-    email = db.Column(db.String(120), unique=True, nullable=False)
-    password_hash = db.Column(db.String(200), nullable=False)  # No longer nullable
-    first_name = db.Column(db.String(50))
-    last_name = db.Column(db.String(50))
-    profile_image = db.Column(db.String(200), default='images/profile/default-profile.jpg')
-    phone = db.Column(db.String(20), nullable=True)  # Added phone field
-    created_date = db.Column(db.DateTime, default=datetime.utcnow)
-    
-    # Address fields
-    street_address = db.Column(db.String(200))
-    city = db.Column(db.String(100))
-    state = db.Column(db.String(100))
-    postal_code = db.Column(db.String(20))
-    country = db.Column(db.String(100), default='India')
-    
-    def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
-        
-    def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
-
-    def get_full_address(self):
-        address_parts = []
-        if self.street_address:
-            address_parts.append(self.street_address)
-        if self.city:
-            address_parts.append(self.city)
-        if self.state:
-            address_parts.append(self.state)
-        if self.postal_code:
-            address_parts.append(self.postal_code)
-        if self.country:
-            address_parts.append(self.country)
-        
-        if address_parts:
-            return ", ".join(address_parts)
-        return "No address provided"
-
-# Product Model
-class Product(db.Model):
-    id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(100), nullable=False)
-    price = db.Column(db.Float, nullable=False)
-    description = db.Column(db.Text, nullable=False)
-    category = db.Column(db.String(50), nullable=False)
-    image_url = db.Column(db.String(200), nullable=False)
-    created_date = db.Column(db.DateTime, default=datetime.utcnow)
-
-# Order Model
-class Order(db.Model):
-    id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)
-    customer_name = db.Column(db.String(100), nullable=False)
-    customer_email = db.Column(db.String(100), nullable=False)
-    customer_phone = db.Column(db.String(20), nullable=False)  # Added phone field
-    customer_address = db.Column(db.Text, nullable=False)
-    order_date = db.Column(db.DateTime, default=datetime.utcnow)
-    order_total = db.Column(db.Float, nullable=False)
-    order_items = db.Column(db.Text, nullable=False)  # JSON string of items
-    
-    user = db.relationship('User', backref=db.backref('orders', lazy=True))
-
-# Helper function to convert USD to INR
-def usd_to_inr(usd_amount):
-    # Convert to INR and round to nearest integer
-    return int(round(usd_amount * USD_TO_INR_RATE))
+# Currency conversion rate in paise per US dollar (83.12 INR to 1 USD)
+INR_PAISE_PER_USD = 8312  # As of March 2025 (example rate)
+
+# View functions are collected here and attached to every app built by create_app()
+_views = []
+
+def route(rule, **options):
+    def decorator(view):
+        _views.append((rule, view, options))
+        return view
+    return decorator
+
+def create_app(config=None):
+    """Build an application for a configuration profile.
+    
+    ``config`` is a profile name ('development', 'test', 'bench',
+    'production'), a config class or a dict of settings; see config.py.
+    Nothing is created on disk and no database connection is opened here:
+    tables come from upgrade_schema() and the rest of the startup work from
+    warmup.warm_up().
+    """
+    app = Flask(__name__)
+    load_config(app, config)
+    db.init_app(app)
+    for rule, view, options in _views:
+        app.add_url_rule(rule, view.__name__, view, **options)
+    app.context_processor(utility_processor)
+    fragments.init_app(app, currency=lambda: ('INR', INR_PAISE_PER_USD))
+    order_archive.init_app(app)
+    throttle.init_app(app)
+    group_commit.init_app(app)
+    resilience.init_app(app)
+    live_dashboard.init_app(app, convert=usd_to_inr)
+    slow_queries.init_app(app)
+    profiler.init_app(app)
+    return app
+
+_default_app = None
+_default_app_lock = threading.Lock()
+
+def get_app():
+    """The shared application used by the server scripts, created on first use."""
+    global _default_app
+    if _default_app is None:
+        with _default_app_lock:
+            if _default_app is None:
+                _default_app = create_app()
+    return _default_app
+
+def __getattr__(name):
+    # Keep `from app import app` working without building an app at import time
+    if name == 'app':
+        return get_app()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+# Helper function to convert USD to INR (cached: catalog pages convert the same prices over and over)
+@lru_cache(maxsize=4096)
+def usd_to_inr(usd_cents):
+    # Whole rupees for an amount in US cents, rounded once with integer arithmetic
+    return money.convert(usd_cents, INR_PAISE_PER_USD)
 
 # Make the conversion function available to all templates
-@app.context_processor
 def utility_processor():
     return dict(usd_to_inr=usd_to_inr)
 
+# Readiness probe: 503 until this process has finished warming up
+@route('/healthz/ready')
+def readiness():
+    if warmup.is_ready():
+        return jsonify({'status': 'ready'})
+    return jsonify({'status': 'warming up'}), 503
+
 # Authentication Routes
-@app.route('/login', methods=['GET', 'POST'])
+@route('/login', methods=['GET', 'POST'])
 def login():
     if request.method == 'POST':
         username = request.form.get('username')
@@ -125,7 +129,7 @@ def login():
     
     return render_template('login.html')
 
-@app.route('/signup', methods=['GET', 'POST'])
+@route('/signup', methods=['GET', 'POST'])
 def signup():
     if request.method == 'POST':
         signup_type = request.form.get('signup_type', 'regular')
@@ -163,37 +167,39 @@ def signup():
             )
             user.set_password(password)
             
-            db.session.add(user)
-            db.session.commit()
+            def add_user(db_session):
+                db_session.add(user)
+                db_session.flush()
+                return user.id
+            
+            try:
+                run_write(add_user)
+            except IntegrityError:
+                # Someone took the username or email since the checks above
+                flash('Username or email already exists', 'danger')
+                return render_template('signup.html')
             
             flash('Account created successfully! Please log in.', 'success')
             return redirect(url_for('login'))
     
     return render_template('signup.html')
 
-@app.route('/logout')
+@route('/logout')
 def logout():
     session.pop('user_id', None)
     session.pop('username', None)
     flash('You have been logged out', 'info')
     return redirect(url_for('home'))
 
-@app.route('/profile', methods=['GET', 'POST'])
+@route('/profile', methods=['GET', 'POST'])
+@login_required('Please login to access your profile')
 def profile():
-    if 'user_id' not in session:
-        flash('Please login to access your profile', 'warning')
-        return redirect(url_for('login'))
-    
     try:
-        user = User.query.get(session['user_id'])
-        if not user:
-            flash('User not found. Please login again.', 'danger')
-            session.pop('user_id', None)
-            session.pop('username', None)
-            return redirect(url_for('login'))
+        user = current_user()
         
         if request.method == 'POST':
-            # Update user profile
+            # Update user profile (on the full row; the cached identity is read-only)
+            user = db.session.get(User, user.id)
             user.first_name = request.form.get('first_name', '')
             user.last_name = request.form.get('last_name', '')
             user.phone = request.form.get('phone', '')
@@ -214,10 +220,10 @@ def profile():
                             unique_filename = f"{user.id}_{int(time.time())}_{filename}"
                             
                             # Ensure directory exists
-                            os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+                            os.makedirs(current_app.config['UPLOAD_FOLDER'], exist_ok=True)
                             
                             # Save the file
-                            file_path = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
+                            file_path = os.path.join(current_app.config['UPLOAD_FOLDER'], unique_filename)
                             file.save(file_path)
                             
                             # Update the user's profile image path
@@ -240,7 +246,7 @@ def profile():
         
         # Get user's orders for the order history section
         try:
-            orders = Order.query.filter_by(user_id=user.id).order_by(Order.order_date.desc()).all()
+            orders = query_orders(user_id=user.id)
         except Exception as e:
             flash(f'Error retrieving orders: {str(e)}', 'danger')
             # Try to fix the database schema
@@ -260,23 +266,15 @@ def profile():
         flash(f'An error occurred: {str(e)}', 'danger')
         return redirect(url_for('home'))
 
-@app.route('/my-orders')
+@route('/my-orders')
+@login_required('Please login to view your orders')
 def my_orders():
-    if 'user_id' not in session:
-        flash('Please login to view your orders', 'warning')
-        return redirect(url_for('login'))
-    
     try:
-        user = User.query.get(session['user_id'])
-        if not user:
-            flash('User not found. Please login again.', 'danger')
-            session.pop('user_id', None)
-            session.pop('username', None)
-            return redirect(url_for('login'))
+        user = current_user()
         
         # Get user's orders with most recent first
         try:
-            orders = Order.query.filter_by(user_id=user.id).order_by(Order.order_date.desc()).all()
+            orders = query_orders(user_id=user.id)
         except Exception as e:
             flash(f'Error retrieving orders: {str(e)}', 'danger')
             # Try to fix the database schema
@@ -295,7 +293,7 @@ def my_orders():
         flash(f'An error occurred: {str(e)}', 'danger')
         return redirect(url_for('home'))
 
-@app.route('/my-order/<int:order_id>')
+@route('/my-order/<int:order_id>')
 def my_order_detail(order_id):
     if 'user_id' not in session:
         flash('Please login to view your order', 'warning')
@@ -303,7 +301,7 @@ def my_order_detail(order_id):
     
     try:
         # Ensure the order exists
-        order = Order.query.get_or_404(order_id)
+        order = get_order_or_404(order_id)
         
         # Ensure the order belongs to the logged-in user
         if order.user_id != session['user_id']:
@@ -323,46 +321,57 @@ def my_order_detail(order_id):
         return redirect(url_for('my_orders'))
 
 # Routes
-@app.route('/')
+@route('/')
 def home():
-    products = Product.query.all()
+    # Shared, possibly slightly stale product list (see resilience.py)
+    products = resilience.catalog_data(current_app).get('home', listings.product_rows)
     for product in products:
         print(f"Product: {product.name}, Image URL: {product.image_url}")
-    return render_template('index.html', products=products)
+    # Ranked from the sales buckets kept by checkout (see bestsellers.py)
+    rankings = bestsellers.get_rankings(current_app)
+    trending = rankings.top_rows(products, '24h')
+    best_this_week = rankings.top_rows(products, '7d')
+    return render_template('index.html', products=products, trending=trending, best_this_week=best_this_week)
 
-@app.route('/category/<string:category>')
+@route('/category/<string:category>')
 def category(category):
-    products = Product.query.filter_by(category=category).all()
+    products = resilience.catalog_data(current_app).get(
+        ('category', category), lambda: listings.product_rows(category))
     print(f"Category: {category}, Number of products: {len(products)}")
     for product in products:
         print(f"Product: {product.name}, Category: {product.category}, Image URL: {product.image_url}")
-    return render_template('category.html', products=products, category=category)
+    
+    # Products often bought together with this category's products
+    also_bought = get_recommender(current_app).also_bought_products(
+        [product.id for product in products], exclude=[product.id for product in products])
+    best_this_week = bestsellers.get_rankings(current_app).top_rows(products, '7d', category)
+    return render_template('category.html', products=products, category=category, also_bought=also_bought,
+                           best_this_week=best_this_week)
 
 # Cart functionality
-@app.route('/cart')
+@route('/cart')
 def view_cart():
     cart = session.get('cart', {})
-    cart_items = []
-    total = 0
-    
-    for product_id, quantity in cart.items():
-        product = Product.query.get(product_id)
-        if product:
-            item_total = product.price * quantity
-            cart_items.append({
-                'id': product.id,
-                'name': product.name,
-                'price': product.price,
-                'quantity': quantity,
-                'image_url': product.image_url,
-                'category': product.category,
-                'item_total': item_total
-            })
-            total += item_total
-    
-    return render_template('cart.html', cart_items=cart_items, total=total)
-
-@app.route('/add_to_cart/<int:product_id>', methods=['POST'])
+    priced = price_cart_details(cart, coupon=session.get('coupon'))
+    cart_items = priced.items
+    
+    # "Customers also bought" suggestions for what's in the cart
+    also_bought = get_recommender(current_app).also_bought_products([item['id'] for item in cart_items])
+    
+    return render_template('cart.html', cart_items=cart_items, total_cents=priced.total_cents,
+                           subtotal_cents=priced.subtotal_cents, discount_cents=priced.discount_cents,
+                           promotions=priced.promotions, coupon=priced.coupon, also_bought=also_bought)
+
+@route('/api/also-bought/<int:product_id>')
+def also_bought_api(product_id):
+    limit = min(request.args.get('limit', 4, type=int), 20)
+    products = get_recommender(current_app).also_bought_products([product_id], limit=limit)
+    return jsonify({
+        'success': True,
+        'products': [dict(product._asdict(), price_inr=usd_to_inr(product.price_cents)) for product in products]
+    })
+
+@route('/add_to_cart/<int:product_id>', methods=['POST'])
 def add_to_cart(product_id):
     product = Product.query.get_or_404(product_id)
     quantity = int(request.form.get('quantity', 1))
@@ -383,13 +392,13 @@ def add_to_cart(product_id):
             'success': True, 
             'cart_count': sum(cart.values()),
             'product_name': product.name,
-            'product_price': usd_to_inr(product.price),
+            'product_price': usd_to_inr(product.price_cents),
             'product_category': product.category
         })
     
     return redirect(request.referrer or url_for('home'))
 
-@app.route('/update_cart/<int:product_id>', methods=['POST'])
+@route('/update_cart/<int:product_id>', methods=['POST'])
 def update_cart(product_id):
     cart = session.get('cart', {})
     cart_product_id = str(product_id)
@@ -409,7 +418,7 @@ def update_cart(product_id):
     
     return redirect(url_for('view_cart'))
 
-@app.route('/remove_from_cart/<int:product_id>', methods=['POST'])
+@route('/remove_from_cart/<int:product_id>', methods=['POST'])
 def remove_from_cart(product_id):
     cart = session.get('cart', {})
     cart_product_id = str(product_id)
@@ -424,7 +433,7 @@ def remove_from_cart(product_id):
     
     return redirect(url_for('view_cart'))
 
-@app.route('/clear_cart', methods=['POST'])
+@route('/clear_cart', methods=['POST'])
 def clear_cart():
     session.pop('cart', None)
     flash('Your cart has been cleared!', 'success')
@@ -434,7 +443,76 @@ def clear_cart():
     
     return redirect(url_for('view_cart'))
 
-@app.route('/checkout', methods=['GET', 'POST'])
+@route('/apply_coupon', methods=['POST'])
+def apply_coupon():
+    # An empty code removes the coupon
+    code = promotions.normalize_code(request.form.get('coupon'))
+    if code is None:
+        session.pop('coupon', None)
+        flash('Coupon removed.', 'success')
+    elif code in promotions.current_rules().coupons:
+        session['coupon'] = code
+        flash(f'Coupon {code} applied!', 'success')
+    else:
+        flash('That coupon is not valid or has expired.', 'danger')
+    
+    if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
+        return jsonify({'success': session.get('coupon') == code, 'coupon': session.get('coupon')})
+    
+    return redirect(url_for('view_cart'))
+
+@route('/api/cart', methods=['GET', 'POST'])
+def cart_api():
+    """Read the cart, or apply a batch of operations to it in one request.
+    
+    POST a JSON body like
+    {"operations": [{"op": "clear"}, {"op": "set", "product_id": 3, "quantity": 2},
+                    {"op": "add", "product_id": 5}, {"op": "remove", "product_id": 7}],
+     "coupon": "SPRING10"}
+    Either every operation is applied or, if one is invalid, none are.
+    "coupon" is optional; null or "" removes it. The response is the
+    priced cart with promotions applied.
+    """
+    cart = session.get('cart', {})
+    products = None
+    
+    if request.method == 'POST':
+        payload = request.get_json(silent=True)
+        if not isinstance(payload, dict):
+            return jsonify({'success': False, 'message': 'Expected a JSON object'}), 400
+        coupon = promotions.normalize_code(payload.get('coupon')) if 'coupon' in payload else session.get('coupon')
+        if coupon is not None and coupon not in promotions.current_rules().coupons:
+            return jsonify({'success': False, 'message': 'That coupon is not valid or has expired.'}), 400
+        try:
+            cart, products = apply_operations(cart, payload.get('operations', []))
+        except CartError as e:
+            return jsonify({'success': False, 'message': e.message, 'index': e.index}), 400
+        if cart:
+            session['cart'] = cart
+        else:
+            session.pop('cart', None)
+        if coupon is None:
+            session.pop('coupon', None)
+        else:
+            session['coupon'] = coupon
+    
+    priced = price_cart_details(cart, products, session.get('coupon'))
+    for item in priced.items:
+        item['price_inr'] = usd_to_inr(item['price_cents'])
+        item['item_total_inr'] = usd_to_inr(item['item_total_cents'])
+    return jsonify({
+        'success': True,
+        'cart_count': sum(cart.values()),
+        'items': priced.items,
+        'subtotal_cents': priced.subtotal_cents,
+        'discount_cents': priced.discount_cents,
+        'promotions': priced.promotions,
+        'coupon': priced.coupon,
+        'total_cents': priced.total_cents,
+        'total_inr': usd_to_inr(priced.total_cents)
+    })
+
+@route('/checkout', methods=['GET', 'POST'])
 def checkout():
     cart = session.get('cart', {})
     
@@ -444,133 +522,137 @@ def checkout():
     
     if request.method == 'POST':
         # Process the order
-        cart_items = []
-        total = 0
-        
-        for product_id, quantity in cart.items():
-            product = Product.query.get(product_id)
-            if product:
-                item_total = product.price * quantity
-                cart_items.append({
-                    'id': product.id,
-                    'name': product.name,
-                    'price': product.price,
-                    'quantity': quantity,
-                    'item_total': item_total
-                })
-                total += item_total
+        priced_items, total_cents = price_cart(cart, coupon=session.get('coupon'))
+        cart_items = [
+            {key: item[key] for key in ('id', 'name', 'price_cents', 'quantity', 'discount_cents', 'item_total_cents')}
+            for item in priced_items
+        ]
         
-        # Create new order
-        order = Order(
+        # New order
+        order_fields = dict(
             customer_name=request.form.get('name'),
             customer_email=request.form.get('email'),
             customer_phone=request.form.get('phone'),
             customer_address=f"{request.form.get('street_address')}, {request.form.get('city')}, {request.form.get('state')}, {request.form.get('postal_code')}, {request.form.get('country')}",
-            order_total=total,
-            order_items=json.dumps(cart_items)
+            order_total_cents=total_cents,
+            order_items=json.dumps(cart_items),
+            # Associate order with user if logged in
+            user_id=session.get('user_id')
         )
+        lines = [(item['id'], item['quantity']) for item in cart_items]
         
-        # Associate order with user if logged in
-        if 'user_id' in session:
-            order.user_id = session['user_id']
+        # Reserve stock and insert the order in one transaction
+        def place_order(db_session):
+            reserve_stock(db_session, lines)
+            bestsellers.record_sale(db_session, lines)
+            order = Order(**order_fields)
+            db_session.add(order)
+            db_session.flush()
+            return order.id
         
-        db.session.add(order)
-        db.session.commit()
+        try:
+            order_id = run_write(place_order)
+        except OutOfStockError as e:
+            name = next((item['name'] for item in cart_items if item['id'] == e.product_id), 'An item')
+            flash(f'Sorry, {name} does not have enough stock to fill your order.', 'danger')
+            return redirect(url_for('view_cart'))
+        except ValueError:
+            flash('Your cart contains an invalid quantity. Please update it and try again.', 'danger')
+            return redirect(url_for('view_cart'))
         
         # Clear the cart
         session.pop('cart', None)
+        session.pop('coupon', None)
         
         flash('Your order has been placed successfully!', 'success')
-        return redirect(url_for('order_confirmation', order_id=order.id))
+        return redirect(url_for('order_confirmation', order_id=order_id))
     
     # GET request - show checkout form
-    cart_items = []
-    total = 0
-    
-    for product_id, quantity in cart.items():
-        product = Product.query.get(product_id)
-        if product:
-            item_total = product.price * quantity
-            cart_items.append({
-                'id': product.id,
-                'name': product.name,
-                'price': product.price,
-                'quantity': quantity,
-                'image_url': product.image_url,
-                'category': product.category,
-                'item_total': item_total
-            })
-            total += item_total
+    cart_items, total_cents = price_cart(cart, coupon=session.get('coupon'))
     
     # Pre-fill form with user data if logged in
-    user = None
-    if 'user_id' in session:
-        user = User.query.get(session['user_id'])
+    user = current_user()
     
-    return render_template('checkout.html', cart_items=cart_items, total=total, user=user)
+    return render_template('checkout.html', cart_items=cart_items, total_cents=total_cents, user=user)
 
-@app.route('/order_confirmation/<int:order_id>')
+@route('/order_confirmation/<int:order_id>')
 def order_confirmation(order_id):
-    order = Order.query.get_or_404(order_id)
+    order = get_order_or_404(order_id)
     order_items = json.loads(order.order_items)
     
     return render_template('order_confirmation.html', order=order, order_items=order_items)
 
-@app.route('/admin/orders')
+@route('/admin/orders')
+@admin_required
 def admin_orders():
-    # Simple admin authentication
-    if 'user_id' not in session:
-        flash('Please login to access admin panel', 'warning')
-        return redirect(url_for('login'))
-    
-    # Check if user is admin (check for username 'admin' instead of user_id 1)
-    user = User.query.get(session['user_id'])
-    if not user or user.username != 'admin':
-        flash('You do not have permission to access this page', 'danger')
-        return redirect(url_for('home'))
-    
-    # Get all orders with most recent first
-    orders = Order.query.order_by(Order.order_date.desc()).all()
+    # Orders with most recent first; archived orders are included only when
+    # the requested date range (?start=YYYY-MM-DD&end=YYYY-MM-DD) reaches them
+    start = parse_date_arg('start')
+    end = parse_date_arg('end')
+    if start is None and end is None:
+        horizon = order_archive.archive_horizon()
+        start = horizon + timedelta(microseconds=1) if horizon else None
+    if end is not None:
+        end += timedelta(days=1)
+    # Search box: ?q=...&by=id|email|phone|name|date, next page with ?after=<cursor>
+    q = request.args.get('q', '').strip()
+    if q or request.args.get('by'):
+        page = _admin_search(admin_search.search_orders, q, request.args.get('by'),
+                             parse_date_arg('start'), end, request.args.get('after'))
+        return render_template('admin_orders.html', orders=page.rows, q=q, next_after=page.next_after)
+    orders = listings.order_rows(start=start, end=end)
     
     return render_template('admin_orders.html', orders=orders)
 
-@app.route('/admin/users')
+@route('/admin/users')
+@admin_required
 def admin_users():
-    # Simple admin authentication
-    if 'user_id' not in session:
-        flash('Please login to access admin panel', 'warning')
-        return redirect(url_for('login'))
-    
-    # Check if user is admin (check for username 'admin' instead of user_id 1)
-    user = User.query.get(session['user_id'])
-    if not user or user.username != 'admin':
-        flash('You do not have permission to access this page', 'danger')
-        return redirect(url_for('home'))
+    # Search box: ?q=...&by=username|email|phone, next page with ?after=<cursor>
+    q = request.args.get('q', '').strip()
+    if q:
+        page = _admin_search(admin_search.search_users, q, request.args.get('by'), after=request.args.get('after'))
+        return render_template('admin_users.html', users=page.rows, q=q, next_after=page.next_after)
     
     # Get all users
-    users = User.query.all()
+    users = listings.user_rows()
     
     return render_template('admin_users.html', users=users)
 
-@app.route('/admin/order/<int:order_id>')
+def _admin_search(search, *args, **kwargs):
+    try:
+        return search(*args, **kwargs)
+    except admin_search.SearchError as e:
+        flash(f'Invalid search: {e}', 'danger')
+        return admin_search.Page([], None)
+
+@route('/admin/search')
+@admin_required
+def admin_search_api():
+    # JSON for the search box: ?kind=users|orders&q=...&by=...&start=...&end=...&after=...&limit=...
+    end = parse_date_arg('end')
+    if end is not None:
+        end += timedelta(days=1)
+    try:
+        if request.args.get('kind') == 'users':
+            page = admin_search.search_users(request.args.get('q', ''), request.args.get('by'),
+                                             request.args.get('after'), request.args.get('limit', type=int))
+        else:
+            page = admin_search.search_orders(request.args.get('q', ''), request.args.get('by'),
+                                              parse_date_arg('start'), end, request.args.get('after'),
+                                              request.args.get('limit', type=int))
+    except admin_search.SearchError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    return jsonify({'success': True, 'results': [row._asdict() for row in page.rows], 'next_after': page.next_after})
+
+@route('/admin/order/<int:order_id>')
+@admin_required
 def admin_order_detail(order_id):
-    # Simple admin authentication
-    if 'user_id' not in session:
-        flash('Please login to access admin panel', 'warning')
-        return redirect(url_for('login'))
-    
-    # Check if user is admin (check for username 'admin' instead of user_id 1)
-    user = User.query.get(session['user_id'])
-    if not user or user.username != 'admin':
-        flash('You do not have permission to access this page', 'danger')
-        return redirect(url_for('home'))
-    
-    order = Order.query.get_or_404(order_id)
+    order = get_order_or_404(order_id)
     order_items = json.loads(order.order_items)
     
     return render_template('admin_order_detail.html', order=order, order_items=order_items)
 
-@app.route('/reset_db')
+@route('/reset_db')
 def reset_db():
     db.drop_all()
     db.create_all()
@@ -584,282 +666,382 @@ def init_db():
         products = [
             {
                 'name': 'Men\'s Classic T-Shirt',
-                'price': 29.99,
+                'price_cents': 2999,
                 'description': 'Comfortable cotton t-shirt for everyday wear',
                 'category': 'men',
                 'image_url': 'static/images/men/pexels-chetanvlad-1766702.jpg'
             },
             {
                 'name': 'Men\'s Denim Jeans',
-                'price': 79.99,
+                'price_cents': 7999,
                 'description': 'Classic fit denim jeans',
                 'category': 'men',
                 'image_url': 'static/images/men/pexels-hazardos-1306248.jpg'
             },
             {
                 'name': 'Men\'s Casual Outfit',
-                'price': 89.99,
+                'price_cents': 8999,
                 'description': 'Stylish casual outfit for any occasion',
                 'category': 'men',
                 'image_url': 'static/images/men/pexels-chloekalaartist-1043474.jpg'
             },
             {
                 'name': 'Men\'s Formal Shirt',
-                'price': 69.99,
+                'price_cents': 6999,
                 'description': 'Cotton formal shirt for business wear',
                 'category': 'men',
                 'image_url': 'static/images/men/pexels-ajaykumar786-1337477.jpg'
             },
             {
                 'name': 'Men\'s Street Style',
-                'price': 129.99,
+                'price_cents': 12999,
                 'description': 'Modern street style ensemble',
                 'category': 'men',
                 'image_url': 'static/images/men/pexels-thelazyartist-1342609.jpg'
             },
             {
                 'name': 'Women\'s Summer Dress',
-                'price': 59.99,
+                'price_cents': 5999,
                 'description': 'Elegant floral summer dress',
                 'category': 'women',
                 'image_url': 'static/images/women/pexels-chloekalaartist-1004642.jpg'
             },
             {
                 'name': 'Women\'s Casual Outfit',
-                'price': 89.99,
+                'price_cents': 8999,
                 'description': 'Stylish casual ensemble',
                 'category': 'women',
                 'image_url': 'static/images/women/pexels-luiz-gustavo-miertschink-925274-1877736.jpg'
             },
             {
                 'name': 'Women\'s Fashion Collection',
-                'price': 149.99,
+                'price_cents': 14999,
                 'description': 'Trendy fashion collection',
                 'category': 'women',
                 'image_url': 'static/images/women/pexels-leonnebrito-1844012.jpg'
             },
             {
                 'name': 'Women\'s Elegant Dress',
-                'price': 119.99,
+                'price_cents': 11999,
                 'description': 'Elegant dress for special occasions',
                 'category': 'women',
                 'image_url': 'static/images/women/pexels-olenagoldman-1021693 - Copy.jpg'
             },
             {
                 'name': 'Women\'s Street Style',
-                'price': 79.99,
+                'price_cents': 7999,
                 'description': 'Modern street style outfit',
                 'category': 'women',
                 'image_url': 'static/images/women/pexels-gabiguerino-1839904.jpg'
             },
             {
                 'name': 'Kids\' Casual T-Shirt',
-                'price': 24.99,
+                'price_cents': 2499,
                 'description': 'Comfortable cotton t-shirt for kids',
                 'category': 'kids',
                 'image_url': 'static/images/kids/kids-tshirt.jpg'
             },
             {
                 'name': 'Kids\' Denim Jeans',
-                'price': 39.99,
+                'price_cents': 3999,
                 'description': 'Durable denim jeans for active kids',
                 'category': 'kids',
                 'image_url': 'static/images/kids/kids-jeans.jpg'
             },
             {
                 'name': 'Kids\' Summer Outfit',
-                'price': 49.99,
+                'price_cents': 4999,
                 'description': 'Colorful summer outfit for children',
                 'category': 'kids',
                 'image_url': 'static/images/kids/kids-summer.jpg'
             },
             {
                 'name': 'Kids\' School Uniform',
-                'price': 59.99,
+                'price_cents': 5999,
                 'description': 'Smart and comfortable school uniform',
                 'category': 'kids',
                 'image_url': 'static/images/kids/kids-uniform.jpg'
             },
             {
                 'name': 'Kids\' Party Dress',
-                'price': 44.99,
+                'price_cents': 4499,
                 'description': 'Elegant party dress for special occasions',
                 'category': 'kids',
                 'image_url': 'static/images/kids/kids-party.jpg'
             },
             {
                 'name': 'Kids\' Winter Jacket',
-                'price': 64.99,
+                'price_cents': 6499,
                 'description': 'Warm and cozy winter jacket for cold days',
                 'category': 'kids',
                 'image_url': 'static/images/kids/kids-winter.jpg'
             },
             {
                 'name': 'Kids\' Sneakers',
-                'price': 34.99,
+                'price_cents': 3499,
                 'description': 'Comfortable and stylish sneakers for active kids',
                 'category': 'kids',
                 'image_url': 'static/images/kids/kids-shoes.jpg'
             },
             {
                 'name': 'Kids\' Backpack',
-                'price': 29.99,
+                'price_cents': 2999,
                 'description': 'Colorful backpack perfect for school or travel',
                 'category': 'kids',
                 'image_url': 'static/images/kids/kids-backpack.jpg'
             },
             {
                 'name': 'Kids\' Pajama Set',
-                'price': 27.99,
+                'price_cents': 2799,
                 'description': 'Soft and comfortable pajama set for a good night\'s sleep',
                 'category': 'kids',
                 'image_url': 'static/images/kids/kids-tshirt.jpg'
             },
             {
                 'name': 'Kids\' Accessories Set',
-                'price': 19.99,
+                'price_cents': 1999,
                 'description': 'Cute hair accessories set for little girls',
                 'category': 'kids',
                 'image_url': 'static/images/kids/kids-backpack.jpg'
             }
         ]
         for product_data in products:
-            product = Product(**product_data)
+            product = Product(stock=INITIAL_STOCK, **product_data)
             db.session.add(product)
         db.session.commit()
 
+# Helper to read an optional YYYY-MM-DD query argument
+def parse_date_arg(name):
+    value = request.args.get(name)
+    if not value:
+        return None
+    try:
+        return datetime.strptime(value, '%Y-%m-%d')
+    except ValueError:
+        return None
+
 # Helper function to check allowed file extensions
 def allowed_file(filename):
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-@app.route('/admin/dashboard')
+@route('/admin/dashboard')
+@admin_required
 def admin_dashboard():
-    # Simple admin authentication
-    if 'user_id' not in session:
-        flash('Please login to access admin panel', 'warning')
-        return redirect(url_for('login'))
-    
-    # Check if user is admin (check for username 'admin' instead of user_id 1)
-    user = User.query.get(session['user_id'])
-    if not user or user.username != 'admin':
-        flash('You do not have permission to access this page', 'danger')
-        return redirect(url_for('home'))
-    
-    # Get all users
-    users = User.query.all()
-    
-    # Get all orders with most recent first
-    orders = Order.query.order_by(Order.order_date.desc()).all()
-    
-    # Get all products
-    products = Product.query.all()
-    
-    # Get recent orders (last 5)
-    recent_orders = orders[:5] if orders else []
-    
-    # Get recent users (last 5)
-    recent_users = sorted(users, key=lambda x: x.created_date, reverse=True)[:5] if users else []
-    
-    # Calculate total revenue
-    total_revenue = sum(usd_to_inr(order.order_total) for order in orders) if orders else 0
-    
-    # Count products by category
-    category_counts = {}
-    for product in products:
-        if product.category in category_counts:
-            category_counts[product.category] += 1
-        else:
-            category_counts[product.category] = 1
+    # Figures kept up to date by live_dashboard.py, shared by every admin;
+    # the page follows them through admin_dashboard_stream
+    figures = live_dashboard.get_dashboard(current_app).current()
+    orders, users, products = figures['orders'], figures['users'], figures['products']
     
     return render_template('admin_dashboard.html', 
-                           users=users, 
-                           orders=orders, 
-                           products=products,
-                           recent_orders=recent_orders,
-                           recent_users=recent_users,
-                           total_revenue=total_revenue,
-                           category_counts=category_counts)
-
-@app.route('/admin/products')
+                           order_count=orders['count'],
+                           user_count=users['count'],
+                           product_count=products['count'],
+                           recent_orders=orders['recent'],
+                           recent_users=users['recent'],
+                           total_revenue=orders['revenue'],
+                           category_counts=products['categories'],
+                           stream_url=url_for('admin_dashboard_stream'))
+
+@route('/admin/dashboard/stream')
+@admin_required
+def admin_dashboard_stream():
+    # Server-Sent Events; browsers reconnect on their own with Last-Event-ID
+    dashboard = live_dashboard.get_dashboard(current_app)
+    chunks = dashboard.stream(request.headers.get('Last-Event-ID') or request.args.get('after'))
+    return current_app.response_class(chunks, mimetype='text/event-stream',
+                                      headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@route('/admin/reports/sales')
+@admin_required
+def admin_sales_report():
+    # Revenue breakdowns, AOV, repeat customers and cohorts for ?start=YYYY-MM-DD&end=YYYY-MM-DD
+    start = parse_date_arg('start')
+    end = parse_date_arg('end')
+    if end is not None:
+        end += timedelta(days=1)
+    return jsonify(sales_report(start, end))
+
+@route('/admin/slow-queries')
+@admin_required
+def admin_slow_queries():
+    # Statements over SLOW_QUERY_MS with their query plans, most total time first
+    log = current_app.extensions.get('slow_queries')
+    if log is None:
+        return jsonify({'enabled': False})
+    return jsonify(log.report())
+
+@route('/admin/profiler', methods=['GET', 'POST'])
+@admin_required
+def admin_profiler():
+    # JSON: GET shows the plan and the files written; POST arms every worker, e.g.
+    # {"endpoint": "category", "fraction": 0.1, "seconds": 600} or {"memory_interval": 60}; {} disarms
+    request_profiler = current_app.extensions.get('profiler')
+    if request_profiler is None:
+        return jsonify({'enabled': False})
+    if request.method == 'POST':
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict):
+            return jsonify({'success': False, 'message': 'Expected a JSON object'}), 400
+        try:
+            request_profiler.arm(data)
+        except profiler.ProfilerError as e:
+            return jsonify({'success': False, 'message': str(e)}), 400
+    return jsonify(request_profiler.status())
+
+@route('/admin/profiler/trigger', methods=['POST'])
+@admin_required
+def admin_profiler_trigger():
+    # A token that profiles the one request sending it in the X-Profile-Token header
+    request_profiler = current_app.extensions.get('profiler')
+    if request_profiler is None:
+        return jsonify({'enabled': False}), 404
+    return jsonify({'success': True, 'header': 'X-Profile-Token', 'token': request_profiler.trigger(),
+                    'expires_in': profiler.TRIGGER_SECONDS})
+
+@route('/admin/profiler/files/<name>')
+@admin_required
+def admin_profiler_file(name):
+    request_profiler = current_app.extensions.get('profiler')
+    if request_profiler is None:
+        return jsonify({'enabled': False}), 404
+    return send_from_directory(request_profiler.directory, name, as_attachment=True)
+
+@route('/admin/promotions', methods=['GET', 'POST'])
+@admin_required
+def admin_promotions():
+    # JSON: GET lists every promotion, POST creates one (fields as in promotions.FIELDS)
+    if request.method == 'POST':
+        return _save_promotion(Promotion())
+    rows = Promotion.query.order_by(Promotion.id.desc()).all()
+    return jsonify({'success': True, 'promotions': [promotions.as_dict(row) for row in rows]})
+
+@route('/admin/promotions/<int:promotion_id>', methods=['POST'])
+@admin_required
+def admin_update_promotion(promotion_id):
+    # Change some fields, e.g. {"active": false} to end a promotion
+    return _save_promotion(Promotion.query.get_or_404(promotion_id))
+
+def _save_promotion(promotion):
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({'success': False, 'message': 'Expected a JSON object'}), 400
+    try:
+        promotions.update_promotion(promotion, data)
+    except promotions.PromotionError as e:
+        db.session.rollback()
+        return jsonify({'success': False, 'message': str(e)}), 400
+    if promotion.product_id is not None and db.session.get(Product, promotion.product_id) is None:
+        db.session.rollback()
+        return jsonify({'success': False, 'message': f'Product {promotion.product_id} does not exist'}), 400
+    # Only when the category is set, so a rule can still be ended after its products are gone
+    if 'category' in data and promotion.category is not None and not db.session.execute(
+            db.select(Product.id).filter_by(category=promotion.category).limit(1)).first():
+        db.session.rollback()
+        return jsonify({'success': False, 'message': f"No product is in category '{promotion.category}'"}), 400
+    db.session.add(promotion)
+    db.session.commit()
+    return jsonify({'success': True, 'promotion': promotions.as_dict(promotion)})
+
+@route('/admin/products')
+@admin_required
 def admin_products():
-    # Simple admin authentication
-    if 'user_id' not in session:
-        flash('Please login to access admin panel', 'warning')
-        return redirect(url_for('login'))
-    
-    # Check if user is admin (check for username 'admin' instead of user_id 1)
-    user = User.query.get(session['user_id'])
-    if not user or user.username != 'admin':
-        flash('You do not have permission to access this page', 'danger')
-        return redirect(url_for('home'))
-    
     # Get filter parameters
     category = request.args.get('category', '')
     sort = request.args.get('sort', 'name')
     
-    # Base query
-    query = Product.query
+    # Base query (list columns only, see listings.py)
+    query = listings.select_products()
     
     # Apply category filter
     if category:
-        query = query.filter_by(category=category)
+        query = query.where(Product.category == category)
     
     # Apply sorting
     if sort == 'price_low':
-        query = query.order_by(Product.price)
+        query = query.order_by(Product.price_cents)
     elif sort == 'price_high':
-        query = query.order_by(Product.price.desc())
+        query = query.order_by(Product.price_cents.desc())
     elif sort == 'newest':
         query = query.order_by(Product.created_date.desc())
     else:  # Default to name
         query = query.order_by(Product.name)
     
     # Get products
-    products = query.all()
+    products = listings.fetch(query, listings.ProductRow)
     
     return render_template('admin_products.html', products=products)
 
-if __name__ == '__main__':
+def upgrade_schema(app=None):
+    """Create missing tables and columns and load the sample products.
+    
+    Runs once when a server starts, before any worker begins serving.
+    """
+    app = app or get_app()
     with app.app_context():
-        try:
-            # Only create tables if they don't exist, don't drop existing data
-            db.create_all()
-            
-            # Check if the customer_phone column exists in the Order table
-            inspector = inspect(db.engine)
-            columns = [column['name'] for column in inspector.get_columns('order')]
-            
-            # If customer_phone column doesn't exist, add it
-            if 'customer_phone' not in columns:
-                print("Adding missing customer_phone column to Order table...")
-                with db.engine.connect() as conn:
-                    conn.execute(db.text('ALTER TABLE "order" ADD COLUMN customer_phone VARCHAR(20)'))
-                    conn.commit()
-                print("Database schema updated successfully.")
-                
-                # Update existing orders with a default phone number
-                print("Updating existing orders with default phone number...")
-                orders = Order.query.all()
-                for order in orders:
-                    if not hasattr(order, 'customer_phone') or not order.customer_phone:
-                        order.customer_phone = "Not provided"
-                db.session.commit()
-                print("Existing orders updated successfully.")
+        # Dollar amounts stored as REAL become integer cents (see money.py); this runs
+        # first, because the queries below already select the new columns
+        for table in money.upgrade_schema(db.engine, order_archive.archive_path(app)):
+            print(f"Converted the money columns of the {table} table to integer cents.")
+        
+        # Only create tables if they don't exist, don't drop existing data
+        db.create_all()
+        
+        # Check if the customer_phone column exists in the Order table
+        inspector = inspect(db.engine)
+        columns = [column['name'] for column in inspector.get_columns('order')]
+        
+        # If customer_phone column doesn't exist, add it
+        if 'customer_phone' not in columns:
+            print("Adding missing customer_phone column to Order table...")
+            with db.engine.connect() as conn:
+                conn.execute(db.text('ALTER TABLE "order" ADD COLUMN customer_phone VARCHAR(20)'))
+                conn.commit()
+            print("Database schema updated successfully.")
             
-            # Initialize products only if none exist
-            if not Product.query.first():
-                init_db()
-            else:
-                print("Database already contains products. Skipping initialization.")
-        except Exception as e:
-            print(f"Error updating database schema: {str(e)}")
-            print("Recreating database from scratch...")
-            db.drop_all()
-            db.create_all()
+            # Update existing orders with a default phone number
+            print("Updating existing orders with default phone number...")
+            orders = Order.query.all()
+            for order in orders:
+                if not hasattr(order, 'customer_phone') or not order.customer_phone:
+                    order.customer_phone = "Not provided"
+            db.session.commit()
+            print("Existing orders updated successfully.")
+        
+        # If role column doesn't exist, add it and make the admin account an admin
+        user_columns = [column['name'] for column in inspector.get_columns('user')]
+        if 'role' not in user_columns:
+            print("Adding missing role column to User table...")
+            with db.engine.connect() as conn:
+                conn.execute(db.text("ALTER TABLE user ADD COLUMN role VARCHAR(20) NOT NULL DEFAULT 'customer'"))
+                conn.execute(db.text("UPDATE user SET role = 'admin' WHERE username = 'admin'"))
+                conn.commit()
+            print("Role column added successfully.")
+        
+        # If stock column doesn't exist, add it and stock existing products
+        product_columns = [column['name'] for column in inspector.get_columns('product')]
+        if 'stock' not in product_columns:
+            print("Adding missing stock column to Product table...")
+            with db.engine.connect() as conn:
+                conn.execute(db.text('ALTER TABLE product ADD COLUMN stock INTEGER NOT NULL DEFAULT 0'))
+                conn.execute(db.text('UPDATE product SET stock = :stock'), {'stock': INITIAL_STOCK})
+                conn.commit()
+            print("Stock column added successfully.")
+        
+        # Initialize products only if none exist
+        if not Product.query.first():
             init_db()
-            print("Database recreated successfully.")
-            
+        else:
+            print("Database already contains products. Skipping initialization.")
+        
+        # Search indexes and the order name/address index (see admin_search.py)
+        admin_search.upgrade_schema(db.engine)
+
+if __name__ == '__main__':
+    app = create_app(os.environ.get('FASHION_STORE_ENV', 'development'))
+    upgrade_schema(app)
+    warmup.warm_up(app)
+    
     # Run the app on port 3000
     print("\n=================================================")
     print("Access the website at: http://localhost:3000")
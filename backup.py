@@ -0,0 +1,257 @@
+"""Online backups of the store databases.
+
+Snapshots are taken with SQLite's online backup API while the store keeps
+running: pages are copied STEP_PAGES at a time with a short pause between
+steps, so request threads are never starved of the database or the disk.
+The backup connection holds one read transaction for the whole copy, which
+in WAL mode pins a consistent snapshot without blocking writers (otherwise
+every write from the app would restart the copy).
+
+Each snapshot is checked with ``PRAGMA integrity_check`` before it is
+gzipped into the backup directory as ``<name>-YYYYmmdd-HHMMSS.ffffff.db.gz``, and
+only the newest ``keep`` snapshots of each database are kept. The order
+archive (see order_archive.py) is backed up alongside ecommerce.db.
+
+    python backup.py create                 # one snapshot now
+    python backup.py schedule --every 360   # one snapshot every 6 hours
+    python backup.py list
+    python backup.py verify BACKUP_FILE
+    python backup.py restore BACKUP_FILE    # replaces the live database
+"""
+import argparse
+from datetime import datetime
+import glob
+import gzip
+import logging
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+
+STEP_PAGES = 256
+STEP_PAUSE = 0.01
+DEFAULT_KEEP = 14
+SUFFIX = '.db.gz'
+
+logger = logging.getLogger('fashion-store.backup')
+
+
+class BackupError(Exception):
+    """A snapshot could not be taken, verified or restored."""
+
+
+def _fsync_and_replace(tmp, path):
+    with open(tmp, 'rb') as f:
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def copy_database(source_path, target_path, step_pages=STEP_PAGES, pause=STEP_PAUSE):
+    """Copy a live database into ``target_path`` in throttled steps; returns the page count."""
+    source = sqlite3.connect(source_path, timeout=30)
+    target = sqlite3.connect(target_path)
+    pages = []
+
+    def progress(status, remaining, total):
+        pages[:] = [total]
+        if remaining:
+            time.sleep(pause)
+
+    try:
+        # Pin one snapshot for every step of the copy
+        source.execute('BEGIN')
+        source.execute('SELECT count(*) FROM sqlite_master').fetchone()
+        source.backup(target, pages=step_pages, progress=progress)
+        source.rollback()
+        # A self-contained file: no -wal/-shm needed to open it
+        target.execute('PRAGMA journal_mode=DELETE')
+    finally:
+        target.close()
+        source.close()
+    return pages[0] if pages else 0
+
+
+def check_integrity(database_path):
+    """Raise BackupError unless ``PRAGMA integrity_check`` passes."""
+    conn = sqlite3.connect(f'file:{database_path}?mode=ro', uri=True)
+    try:
+        problems = [row[0] for row in conn.execute('PRAGMA integrity_check')]
+    except sqlite3.DatabaseError as e:
+        raise BackupError(f'{database_path} is not a usable database: {e}') from None
+    finally:
+        conn.close()
+    if problems != ['ok']:
+        raise BackupError(f'{database_path} failed the integrity check: {"; ".join(problems[:5])}')
+
+
+def snapshot(database_path, backup_dir, compress=True, step_pages=STEP_PAGES, pause=STEP_PAUSE):
+    """Take a verified snapshot of ``database_path`` into ``backup_dir``; returns its path."""
+    if not os.path.exists(database_path):
+        raise BackupError(f'{database_path} does not exist')
+    os.makedirs(backup_dir, exist_ok=True)
+    name = os.path.splitext(os.path.basename(database_path))[0]
+    # Down to the microsecond, so two snapshots within a second don't replace each other
+    stamp = datetime.now().strftime('%Y%m%d-%H%M%S.%f')
+    path = os.path.join(backup_dir, f'{name}-{stamp}' + (SUFFIX if compress else '.db'))
+
+    fd, copy = tempfile.mkstemp(prefix=f'.{name}-', suffix='.partial', dir=backup_dir)
+    os.close(fd)
+    try:
+        started = time.perf_counter()
+        pages = copy_database(database_path, copy, step_pages, pause)
+        check_integrity(copy)
+        if compress:
+            packed = copy + '.gz'
+            with open(copy, 'rb') as src, gzip.open(packed, 'wb', compresslevel=6) as dst:
+                shutil.copyfileobj(src, dst, 1024 * 1024)
+            os.remove(copy)
+            copy = packed
+        _fsync_and_replace(copy, path)
+    except BaseException:
+        for leftover in (copy, copy + '.gz'):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+        raise
+    logger.info("Backed up %s (%d pages) to %s in %.1fs", database_path, pages, path,
+                time.perf_counter() - started)
+    return path
+
+
+def list_backups(backup_dir, name=None):
+    """Backup files in ``backup_dir``, oldest first, optionally only those of database ``name``."""
+    pattern = f'{name}-*' if name else '*'
+    found = glob.glob(os.path.join(backup_dir, pattern + SUFFIX)) + glob.glob(os.path.join(backup_dir, pattern + '.db'))
+    return sorted(found, key=lambda path: os.path.basename(path).rsplit('-', 2)[-2:])
+
+
+def rotate(backup_dir, name, keep=DEFAULT_KEEP):
+    """Delete all but the newest ``keep`` backups of database ``name``; returns the deleted paths."""
+    backups = list_backups(backup_dir, name)
+    expired = backups[:-keep] if keep > 0 else []
+    for path in expired:
+        os.remove(path)
+        logger.info("Removed old backup %s", path)
+    return expired
+
+
+def _unpacked(backup_file, directory):
+    """Path of an uncompressed copy of ``backup_file`` (the caller removes it)."""
+    fd, path = tempfile.mkstemp(prefix='.restore-', suffix='.db', dir=directory)
+    with os.fdopen(fd, 'wb') as dst:
+        opener = gzip.open if backup_file.endswith('.gz') else open
+        try:
+            with opener(backup_file, 'rb') as src:
+                shutil.copyfileobj(src, dst, 1024 * 1024)
+        except (OSError, EOFError) as e:
+            os.remove(path)
+            raise BackupError(f'{backup_file} is damaged: {e}') from None
+    return path
+
+
+def verify(backup_file):
+    """Unpack ``backup_file`` to a temporary file and run the integrity check on it."""
+    path = _unpacked(backup_file, tempfile.gettempdir())
+    try:
+        check_integrity(path)
+    finally:
+        os.remove(path)
+
+
+def restore(backup_file, database_path, backup_dir=None, step_pages=STEP_PAGES):
+    """Replace the contents of ``database_path`` with ``backup_file``.
+
+    The backup is verified first and, when ``backup_dir`` is given, the
+    current database is snapshotted there before being overwritten. The
+    copy goes through the backup API into the live file, so running
+    processes see the restored data on their next transaction instead of
+    holding on to a replaced file.
+    """
+    path = _unpacked(backup_file, os.path.dirname(os.path.abspath(database_path)))
+    try:
+        check_integrity(path)
+        if backup_dir and os.path.exists(database_path):
+            snapshot(database_path, backup_dir)
+        source = sqlite3.connect(path)
+        target = sqlite3.connect(database_path, timeout=30)
+        try:
+            source.backup(target, pages=step_pages)
+        finally:
+            target.close()
+            source.close()
+    finally:
+        os.remove(path)
+    logger.info("Restored %s from %s", database_path, backup_file)
+
+
+def backup_all(databases, backup_dir, keep=DEFAULT_KEEP, compress=True):
+    """Snapshot and rotate every existing database in ``databases``; returns the new files."""
+    created = []
+    for database_path in databases:
+        if database_path and os.path.exists(database_path):
+            created.append(snapshot(database_path, backup_dir, compress))
+            rotate(backup_dir, os.path.splitext(os.path.basename(database_path))[0], keep)
+    return created
+
+
+def run_schedule(databases, backup_dir, every_seconds, keep=DEFAULT_KEEP, compress=True):
+    """Take a backup every ``every_seconds`` until interrupted; failures are logged and retried next time."""
+    while True:
+        started = time.monotonic()
+        try:
+            backup_all(databases, backup_dir, keep, compress)
+        except (BackupError, sqlite3.Error, OSError):
+            logger.exception("Scheduled backup failed")
+        time.sleep(max(0, every_seconds - (time.monotonic() - started)))
+
+
+def backup_dir_for(app):
+    return app.config.get('BACKUP_DIR') or os.path.join(app.instance_path, 'backups')
+
+
+if __name__ == '__main__':
+    from app import get_app
+    from models import db
+    from order_archive import archive_path
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Online backups of the store databases")
+    commands = parser.add_subparsers(dest='command', required=True)
+    for command in ('create', 'schedule'):
+        sub = commands.add_parser(command)
+        sub.add_argument('--keep', type=int, default=None, help="snapshots to keep per database (default: BACKUP_KEEP)")
+        sub.add_argument('--no-compress', action='store_true')
+        if command == 'schedule':
+            sub.add_argument('--every', type=float, default=24 * 60, help="minutes between backups")
+    commands.add_parser('list')
+    commands.add_parser('verify').add_argument('backup_file')
+    restore_parser = commands.add_parser('restore')
+    restore_parser.add_argument('backup_file')
+    restore_parser.add_argument('--archive', action='store_true', help="restore the order archive instead of ecommerce.db")
+    args = parser.parse_args()
+
+    app = get_app()
+    with app.app_context():
+        database = db.engine.url.database
+    databases = [database, archive_path(app)]
+    directory = backup_dir_for(app)
+    keep = getattr(args, 'keep', None) or app.config.get('BACKUP_KEEP', DEFAULT_KEEP)
+
+    try:
+        if args.command == 'create':
+            for path in backup_all(databases, directory, keep, not args.no_compress):
+                print(path)
+        elif args.command == 'schedule':
+            run_schedule(databases, directory, args.every * 60, keep, not args.no_compress)
+        elif args.command == 'list':
+            for path in list_backups(directory):
+                print(f"{path}  {os.path.getsize(path) / 1024 / 1024:.1f} MB")
+        elif args.command == 'verify':
+            verify(args.backup_file)
+            print(f"{args.backup_file}: ok")
+        elif args.command == 'restore':
+            target = databases[1] if args.archive else databases[0]
+            restore(args.backup_file, target, directory)
+            print(f"Restored {target} from {args.backup_file}")
+    except BackupError as e:
+        raise SystemExit(str(e))
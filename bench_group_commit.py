@@ -0,0 +1,122 @@
+"""Throughput benchmark for group commit.
+
+Threads place orders (reserve stock + insert the order) against a scratch
+SQLite database, first each committing its own transaction as checkout()
+does by default, then through a GroupCommitWriter. Prints orders per second
+for both and checks that the stock adds up.
+
+    python bench_group_commit.py --threads 16 --seconds 5 --dir /path/on/the/real/disk
+"""
+import argparse
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.orm import Session
+
+from group_commit import GroupCommitWriter
+from inventory import reserve_stock
+from models import Order, Product, set_sqlite_pragmas
+
+PRODUCTS = 20
+STOCK = 10 ** 9
+
+
+def make_engine(db_path):
+    engine = create_engine(f'sqlite:///{db_path}', connect_args={'timeout': 60})
+    event.listen(engine, 'connect', set_sqlite_pragmas)
+    Product.__table__.create(engine)
+    Order.__table__.create(engine)
+    with engine.begin() as conn:
+        for i in range(PRODUCTS):
+            conn.execute(Product.__table__.insert().values(
+                name=f'Product {i}', price_cents=1000, description='bench', category='bench',
+                image_url='bench.jpg', stock=STOCK
+            ))
+    return engine
+
+
+def order_job(rng):
+    lines = [(rng.randint(1, PRODUCTS), rng.randint(1, 3)) for _ in range(rng.randint(1, 3))]
+
+    def place_order(session):
+        reserve_stock(session, lines)
+        order = Order(customer_name='Bench', customer_email='bench@example.com', customer_phone='0',
+                      customer_address='Bench', order_total_cents=1000 * sum(q for _, q in lines),
+                      order_items=json.dumps([{'id': p, 'quantity': q} for p, q in lines]))
+        session.add(order)
+        session.flush()
+        return order.id
+    return place_order, sum(q for _, q in lines)
+
+
+def run(mode, threads, seconds, directory=None):
+    db_dir = tempfile.mkdtemp(prefix='bench_group_commit_', dir=directory)
+    engine = make_engine(os.path.join(db_dir, 'bench.db'))
+    writer = GroupCommitWriter(engine) if mode == 'group' else None
+    counts = {'orders': 0, 'units': 0}
+    latencies = []
+    lock = threading.Lock()
+    stop_at = [0]
+    start_gate = threading.Event()
+
+    def worker():
+        rng = random.Random()
+        orders = units = 0
+        local_latencies = []
+        start_gate.wait()
+        while time.perf_counter() < stop_at[0]:
+            job, quantity = order_job(rng)
+            started = time.perf_counter()
+            if writer is None:
+                with Session(engine) as session:
+                    job(session)
+                    session.commit()
+            else:
+                writer.submit(job).result()
+            local_latencies.append(time.perf_counter() - started)
+            orders += 1
+            units += quantity
+        with lock:
+            counts['orders'] += orders
+            counts['units'] += units
+            latencies.extend(local_latencies)
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    for t in workers:
+        t.start()
+    started = time.perf_counter()
+    stop_at[0] = started + seconds
+    start_gate.set()
+    for t in workers:
+        t.join()
+    elapsed = time.perf_counter() - started
+    if writer is not None:
+        writer.close()
+
+    with engine.connect() as conn:
+        stored = conn.execute(text('SELECT count(*) FROM "order"')).scalar()
+        sold = conn.execute(text('SELECT sum(:stock - stock) FROM product'), {'stock': STOCK}).scalar()
+    engine.dispose()
+
+    latencies.sort()
+    p99 = latencies[int(len(latencies) * 0.99)] * 1000 if latencies else 0
+    batches = f", {writer.jobs / max(writer.batches, 1):.1f} orders/commit" if writer else ''
+    print(f"{mode:>6}: {counts['orders'] / elapsed:8.0f} orders/s, p99 {p99:.1f}ms{batches}")
+    if stored != counts['orders'] or sold != counts['units']:
+        raise SystemExit(f"MISMATCH: {stored} orders stored for {counts['orders']} placed, "
+                         f"{sold} units sold for {counts['units']} reserved")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--dir', default=None, help="where to put the scratch database (default: the temp dir)")
+    args = parser.parse_args()
+    for mode in ('direct', 'group'):
+        run(mode, args.threads, args.seconds, args.dir)
@@ -0,0 +1,134 @@
+"""Microbenchmark for pricing a checkout with promotions.
+
+Generates a catalog and a large set of promotions (product, category and
+cart-wide rules, some behind coupons, some expired or not started yet),
+then prices random carts the way checkout() does: first by checking every
+rule against every line, then with the compiled RuleSet from promotions.py.
+Prints carts per second for both and checks that every total agrees.
+
+    python bench_promotions.py --rules 20000 --lines 10 --seconds 3
+"""
+import argparse
+from collections import namedtuple
+from datetime import datetime, timedelta
+import random
+import time
+
+from cart import price_cart_details
+from promotions import KINDS, cart_discount, compile_rules, line_discount, normalize_code
+
+CATEGORIES = ['men', 'women', 'kids', 'shoes', 'bags', 'sale', 'sport', 'formal']
+
+BenchProduct = namedtuple('BenchProduct', 'id name price_cents image_url category')
+BenchPromotion = namedtuple(
+    'BenchPromotion', 'id name kind percent amount_cents buy_quantity get_quantity product_id category '
+                      'coupon_code min_subtotal_cents starts_at ends_at active')
+NaiveRule = namedtuple('NaiveRule', 'kind value buy get')
+
+
+def make_catalog(products, rng):
+    return {i: BenchProduct(i, f'Product {i}', rng.randint(500, 20000), 'bench.jpg', rng.choice(CATEGORIES))
+            for i in range(1, products + 1)}
+
+
+def make_promotions(count, products, coupons, rng, now):
+    promotions = []
+    for i in range(1, count + 1):
+        kind = rng.choice(KINDS)
+        scope = rng.random()
+        product_id = category = None
+        if scope < 0.8:
+            product_id = rng.randint(1, products)
+        elif scope < 0.95 or kind == 'buy_x_get_y':
+            category = rng.choice(CATEGORIES)
+        starts_at = now - timedelta(days=1) if rng.random() < 0.9 else now + timedelta(days=1)
+        ends_at = None if rng.random() < 0.8 else now + timedelta(days=rng.choice((-2, 3)))
+        promotions.append(BenchPromotion(
+            i, f'Promotion {i}', kind,
+            rng.choice((5, 10, 15, 25, 50)) if kind == 'percent' else None,
+            rng.randint(100, 2000) if kind == 'amount' else None,
+            rng.randint(1, 3), 1, product_id, category,
+            f'CODE{rng.randint(1, coupons)}' if rng.random() < 0.3 else None,
+            rng.choice((None, None, 5000, 20000)), starts_at, ends_at, rng.random() < 0.95))
+    return promotions
+
+
+def price_naively(promotions, items, coupon, now):
+    """Reference pricing: every rule is checked against every line."""
+    coupon = normalize_code(coupon)
+    live = [p for p in promotions if p.active and (p.starts_at is None or p.starts_at <= now)
+            and (p.ends_at is None or p.ends_at > now)]
+    if coupon not in {normalize_code(p.coupon_code) for p in live}:
+        coupon = None
+    subtotal = sum(item['price_cents'] * item['quantity'] for item in items)
+    line_total = 0
+    for item in items:
+        best = 0
+        for p in live:
+            if p.coupon_code not in (None, coupon) or (p.min_subtotal_cents or 0) > subtotal:
+                continue
+            if p.product_id == item['id'] or (p.product_id is None and p.category == item['category']):
+                best = max(best, line_discount(_rule(p), item['price_cents'], item['quantity']))
+        line_total += best
+    remaining = subtotal - line_total
+    best = 0
+    for p in live:
+        if p.product_id is None and not p.category and p.coupon_code in (None, coupon) \
+                and (p.min_subtotal_cents or 0) <= subtotal:
+            best = max(best, cart_discount(_rule(p), remaining))
+    return remaining - best
+
+
+def _rule(p):
+    return NaiveRule(p.kind, p.percent if p.kind == 'percent' else p.amount_cents or 0, p.buy_quantity, p.get_quantity)
+
+
+def run(rules_count, products, lines, coupons, seconds, seed):
+    rng = random.Random(seed)
+    now = datetime.utcnow()
+    catalog = make_catalog(products, rng)
+    promotions = make_promotions(rules_count, products, coupons, rng, now)
+
+    started = time.perf_counter()
+    rules = compile_rules(promotions, now)
+    compile_ms = (time.perf_counter() - started) * 1000
+    print(f"{rules_count} promotions compiled to {len(rules)} live rules in {compile_ms:.1f}ms")
+
+    carts = []
+    for _ in range(200):
+        cart = {str(rng.randint(1, products)): rng.randint(1, 4) for _ in range(lines)}
+        carts.append((cart, f'CODE{rng.randint(1, coupons)}' if rng.random() < 0.5 else None))
+
+    results = {}
+    for mode in ('naive', 'compiled'):
+        priced = 0
+        totals = []
+        started = time.perf_counter()
+        while time.perf_counter() - started < seconds:
+            for cart, coupon in carts:
+                if mode == 'naive':
+                    items = price_cart_details(cart, catalog, rules=compile_rules([])).items
+                    total = price_naively(promotions, items, coupon, now)
+                else:
+                    total = price_cart_details(cart, catalog, coupon, rules).total_cents
+                if priced < len(carts):
+                    totals.append(total)
+                priced += 1
+        elapsed = time.perf_counter() - started
+        results[mode] = totals
+        print(f"{mode:>9}: {priced / elapsed:10.0f} carts/s, {elapsed / priced * 1e6:8.1f}us per checkout")
+    if results['naive'] != results['compiled']:
+        mismatches = sum(a != b for a, b in zip(results['naive'], results['compiled']))
+        raise SystemExit(f"MISMATCH: {mismatches} of {len(carts)} carts priced differently")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rules', type=int, default=20000)
+    parser.add_argument('--products', type=int, default=5000)
+    parser.add_argument('--lines', type=int, default=10, help="lines per cart")
+    parser.add_argument('--coupons', type=int, default=50, help="distinct coupon codes")
+    parser.add_argument('--seconds', type=float, default=3)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    run(args.rules, args.products, args.lines, args.coupons, args.seconds, args.seed)
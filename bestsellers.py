@@ -0,0 +1,252 @@
+"""Bestseller rankings over sliding windows, from materialized sales buckets.
+
+Checkout adds the units of every order line to two counters of the
+``sales_bucket`` table, one for the hour and one for the day of the sale,
+in the same transaction as the order (``record_sale()``). Nothing ever
+reads ``Order.order_items`` to rank products.
+
+Rankings cover three windows:
+
+* ``24h``: the last 24 hourly buckets ("trending");
+* ``7d`` and ``30d``: the last 7 and 30 daily buckets, today included
+  ("bestsellers this week / month").
+
+Each process sums the buckets of every window once per
+BESTSELLERS_REFRESH_SECONDS, which is one GROUP BY over a few thousand small
+rows. It also refreshes early (at most every MIN_REFRESH_SECONDS) after it
+commits a sale itself. The top N per category are picked from those totals
+with a heap and kept until the next refresh, so pages just read a list.
+
+Old buckets are pruned, and the table can be rebuilt from the orders
+themselves (e.g. after restoring a backup or editing orders):
+
+    python bestsellers.py              # prune buckets outside every window
+    python bestsellers.py --rebuild    # recount the windows from the orders
+"""
+import argparse
+from datetime import datetime, timedelta
+import heapq
+import json
+import logging
+import threading
+import time
+import weakref
+
+from sqlalchemy import delete, event, func, select
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.orm import Session
+
+from inventory import merge_lines
+from models import db, Product, SalesBucket
+from order_archive import order_source
+
+DEFAULT_REFRESH_SECONDS = 60
+MIN_REFRESH_SECONDS = 5
+DEFAULT_LIMIT = 8
+CHUNK_SIZE = 5000
+
+# Window -> (bucket granularity, number of buckets)
+WINDOWS = {
+    '24h': ('hour', 24),
+    '7d': ('day', 7),
+    '30d': ('day', 30),
+}
+
+logger = logging.getLogger('fashion-store.bestsellers')
+
+_buckets = SalesBucket.__table__
+_rankings = weakref.WeakSet()
+
+
+def bucket_start(granularity, when):
+    if granularity == 'hour':
+        return when.replace(minute=0, second=0, microsecond=0)
+    return when.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def window_start(window, now=None):
+    """Start of the oldest bucket in ``window``."""
+    granularity, count = WINDOWS[window]
+    step = timedelta(hours=1) if granularity == 'hour' else timedelta(days=1)
+    return bucket_start(granularity, now or datetime.utcnow()) - step * (count - 1)
+
+
+def _oldest_needed(granularity, now=None):
+    return min(window_start(window, now) for window, (g, _) in WINDOWS.items() if g == granularity)
+
+
+def _upsert(session, rows):
+    statement = insert(_buckets)
+    statement = statement.on_conflict_do_update(
+        index_elements=[_buckets.c.granularity, _buckets.c.start, _buckets.c.product_id],
+        set_={'units': _buckets.c.units + statement.excluded.units},
+    )
+    session.execute(statement, rows)
+
+
+def record_sale(session, lines, when=None):
+    """Count the (product_id, quantity) lines of an order in the current transaction."""
+    when = when or datetime.utcnow()
+    merged = merge_lines(lines)
+    if not merged:
+        return
+    rows = [{'granularity': granularity, 'start': bucket_start(granularity, when),
+             'product_id': product_id, 'units': quantity}
+            for granularity in ('hour', 'day') for product_id, quantity in sorted(merged.items())]
+    _upsert(session, rows)
+    session.info['bestsellers_sold'] = True
+
+
+def prune(session, now=None):
+    """Delete buckets no window reaches any more; returns how many."""
+    deleted = 0
+    for granularity in ('hour', 'day'):
+        result = session.execute(delete(SalesBucket).where(
+            SalesBucket.granularity == granularity, SalesBucket.start < _oldest_needed(granularity, now)))
+        deleted += result.rowcount
+    return deleted
+
+
+def rebuild(session, now=None):
+    """Replace every bucket with counts from the orders in the windows; returns the orders read."""
+    now = now or datetime.utcnow()
+    # Deleting first takes the write lock, so no checkout can slip in between reading and writing
+    session.execute(delete(SalesBucket))
+    since = min(_oldest_needed('hour', now), _oldest_needed('day', now))
+    source = order_source(since)
+    rows = session.execute(
+        select(source.c.order_date, source.c.order_items).where(source.c.order_date >= since)
+        .execution_options(yield_per=CHUNK_SIZE))
+    counts = {}
+    orders = 0
+    for order_date, order_items in rows:
+        orders += 1
+        try:
+            lines = merge_lines((item['id'], item['quantity']) for item in json.loads(order_items))
+        except (ValueError, TypeError, KeyError):
+            continue
+        for granularity in ('hour', 'day'):
+            start = bucket_start(granularity, order_date)
+            if start < _oldest_needed(granularity, now):
+                continue
+            for product_id, quantity in lines.items():
+                key = (granularity, start, product_id)
+                counts[key] = counts.get(key, 0) + quantity
+    if counts:
+        _upsert(session, [{'granularity': granularity, 'start': start, 'product_id': product_id, 'units': units}
+                          for (granularity, start, product_id), units in counts.items()])
+    return orders
+
+
+class Rankings:
+    """Per-window sales totals of one process, with cached top-N lists; see the module docstring."""
+
+    def __init__(self, app, refresh_seconds=DEFAULT_REFRESH_SECONDS):
+        self.app = app
+        self.refresh_seconds = refresh_seconds
+        self._totals = None  # window -> {category: [(units, product_id), ...]}
+        self._top = {}  # (window, category, limit) -> [(product_id, units), ...]
+        self._loaded = float('-inf')
+        self._sold = False
+        self._lock = threading.Lock()
+        _rankings.add(self)
+
+    def _load(self, now=None):
+        totals = {}
+        for window, (granularity, _) in WINDOWS.items():
+            rows = db.session.execute(
+                select(SalesBucket.product_id, Product.category, func.sum(SalesBucket.units))
+                .join(Product, Product.id == SalesBucket.product_id)
+                .where(SalesBucket.granularity == granularity, SalesBucket.start >= window_start(window, now))
+                .group_by(SalesBucket.product_id))
+            by_category = totals[window] = {}
+            for product_id, category, units in rows:
+                by_category.setdefault(category, []).append((units, product_id))
+        return totals
+
+    def _due(self):
+        age = time.monotonic() - self._loaded
+        return age >= self.refresh_seconds or (self._sold and age >= MIN_REFRESH_SECONDS)
+
+    def _current(self):
+        if self._due():
+            with self._lock:
+                if self._due():
+                    self._sold = False
+                    try:
+                        with self.app.app_context():
+                            self._totals = self._load()
+                    except Exception:
+                        # Rankings are decoration: keep the last ones rather than fail the page
+                        logger.exception("Loading the bestseller rankings failed")
+                        if self._totals is None:
+                            self._totals = {window: {} for window in WINDOWS}
+                    self._top = {}
+                    self._loaded = time.monotonic()
+        return self._totals
+
+    def sold(self):
+        """Called after this process commits a sale."""
+        self._sold = True
+
+    def top(self, window='7d', category=None, limit=DEFAULT_LIMIT):
+        """(product_id, units) of the best sellers in ``window``, most units first."""
+        if window not in WINDOWS:
+            raise ValueError(f'unknown window {window!r}')
+        totals = self._current()
+        key = (window, category, limit)
+        top = self._top.get(key)
+        if top is None:
+            by_category = totals[window]
+            candidates = by_category.get(category, []) if category is not None \
+                else [item for items in by_category.values() for item in items]
+            # Ties go to the newer product (higher id)
+            top = self._top[key] = [(product_id, int(units))
+                                    for units, product_id in heapq.nlargest(limit, candidates)]
+        return top
+
+    def top_rows(self, rows, window='7d', category=None, limit=DEFAULT_LIMIT):
+        """The ``rows`` (anything with an ``id``) that are best sellers in ``window``, best first."""
+        by_id = {row.id: row for row in rows}
+        return [by_id[product_id] for product_id, _ in self.top(window, category, limit) if product_id in by_id]
+
+
+def get_rankings(app):
+    rankings = app.extensions.get('bestsellers')
+    if rankings is None:
+        rankings = app.extensions['bestsellers'] = Rankings(
+            app, app.config.get('BESTSELLERS_REFRESH_SECONDS', DEFAULT_REFRESH_SECONDS))
+    return rankings
+
+
+# Let this process's rankings catch up soon after it commits a sale
+@event.listens_for(Session, 'after_commit')
+def _refresh_after_sale(session):
+    if session.info.pop('bestsellers_sold', False):
+        for rankings in list(_rankings):
+            rankings.sold()
+
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_sale(session):
+    session.info.pop('bestsellers_sold', None)
+
+
+if __name__ == '__main__':
+    from app import get_app
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Maintain the bestseller sales buckets")
+    parser.add_argument('--rebuild', action='store_true', help="recount the windows from the orders")
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    with get_app().app_context():
+        if args.rebuild:
+            orders = rebuild(db.session)
+            db.session.commit()
+            print(f"Rebuilt the sales buckets from {orders} orders ({time.perf_counter() - started:.2f}s)")
+        else:
+            deleted = prune(db.session)
+            db.session.commit()
+            print(f"Pruned {deleted} old sales buckets ({time.perf_counter() - started:.2f}s)")
@@ -0,0 +1,137 @@
+"""Cart pricing and batch cart updates.
+
+The cart lives in the session as ``{product_id (str): quantity}``. Pricing a
+cart loads all of its products with one query and applies the promotions
+(see promotions.py) in one pass over the lines, and ``apply_operations``
+applies a whole list of add/set/remove/clear operations to a copy of the
+cart, so a caller can validate everything first and store the result once.
+Amounts are integer cents (see money.py).
+"""
+import re
+
+from models import Product
+from promotions import current_rules
+
+OPERATIONS = ('add', 'set', 'remove', 'clear')
+MAX_OPERATIONS = 200
+# Units of one product a cart may hold (stock and totals are SQLite integers)
+MAX_QUANTITY = 999
+
+_INTEGER = re.compile(r'\s*[+-]?[0-9]+\s*')
+
+
+class CartError(ValueError):
+    """An operation in a batch was invalid; nothing in the batch is applied."""
+
+    def __init__(self, message, index=None):
+        super().__init__(message)
+        self.message = message
+        self.index = index
+
+
+def load_products(product_ids):
+    """Products for ``product_ids`` keyed by id, in a single query."""
+    ids = {int(product_id) for product_id in product_ids}
+    if not ids:
+        return {}
+    return {product.id: product for product in Product.query.filter(Product.id.in_(ids)).all()}
+
+
+def price_cart(cart, products=None, coupon=None):
+    """Return (cart_items, total_cents) for a session cart after promotions; unknown products are skipped."""
+    priced = price_cart_details(cart, products, coupon)
+    return priced.items, priced.total_cents
+
+
+def price_cart_details(cart, products=None, coupon=None, rules=None):
+    """The cart priced with the promotions in ``rules`` (default: the app's) as a PricedCart."""
+    if products is None:
+        products = load_products(cart.keys())
+    cart_items = []
+    for product_id, quantity in cart.items():
+        product = products.get(int(product_id))
+        if product:
+            cart_items.append({
+                'id': product.id,
+                'name': product.name,
+                'price_cents': product.price_cents,
+                'quantity': quantity,
+                'image_url': product.image_url,
+                'category': product.category,
+                'item_total_cents': product.price_cents * quantity
+            })
+    if rules is None:
+        rules = current_rules()
+    return rules.apply(cart_items, coupon)
+
+
+def _integer(value):
+    """``value`` as an int if it is one, or a string of one; None otherwise (no bools or floats)."""
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, int):
+        return value
+    if isinstance(value, str) and _INTEGER.fullmatch(value):
+        return int(value)
+    return None
+
+
+def _parse_operation(index, operation):
+    if not isinstance(operation, dict):
+        raise CartError('Each operation must be an object', index)
+    op = operation.get('op')
+    if op not in OPERATIONS:
+        raise CartError(f"Unknown operation '{op}'", index)
+    if op == 'clear':
+        return op, None, None
+    try:
+        product_id = int(operation.get('product_id'))
+    except (TypeError, ValueError):
+        raise CartError('product_id must be an integer', index) from None
+    quantity = None
+    if op in ('add', 'set'):
+        quantity = _integer(operation.get('quantity', 1))
+        if quantity is None:
+            raise CartError('quantity must be an integer', index)
+        if quantity < 0 or (op == 'add' and quantity == 0):
+            raise CartError('quantity must be positive', index)
+        if quantity > MAX_QUANTITY:
+            raise CartError(f'quantity must be at most {MAX_QUANTITY}', index)
+    return op, product_id, quantity
+
+
+def apply_operations(cart, operations):
+    """Apply a batch of operations to a copy of ``cart``.
+
+    Returns ``(new_cart, products)`` where ``products`` maps the ids in the
+    new cart to their Product rows. Raises CartError, leaving ``cart``
+    untouched, if any operation is malformed or names an unknown product.
+    """
+    if not isinstance(operations, list):
+        raise CartError('operations must be a list')
+    if len(operations) > MAX_OPERATIONS:
+        raise CartError(f'At most {MAX_OPERATIONS} operations per request')
+
+    parsed = [_parse_operation(index, operation) for index, operation in enumerate(operations)]
+
+    # Validate every product id with one query
+    referenced = {product_id for _, product_id, _ in parsed if product_id is not None}
+    products = load_products(referenced | {int(product_id) for product_id in cart})
+    for index, (op, product_id, _) in enumerate(parsed):
+        if op in ('add', 'set') and product_id not in products:
+            raise CartError(f'Product {product_id} does not exist', index)
+
+    new_cart = dict(cart)
+    for index, (op, product_id, quantity) in enumerate(parsed):
+        key = str(product_id)
+        if op == 'clear':
+            new_cart = {}
+        elif op == 'add':
+            new_cart[key] = new_cart.get(key, 0) + quantity
+            if new_cart[key] > MAX_QUANTITY:
+                raise CartError(f'At most {MAX_QUANTITY} of a product per cart', index)
+        elif op == 'set' and quantity > 0:
+            new_cart[key] = quantity
+        else:
+            new_cart.pop(key, None)
+    return new_cart, products
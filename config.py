@@ -0,0 +1,154 @@
+"""Configuration profiles for the Fashion Store.
+
+``create_app()`` picks a profile by name (``development``, ``test``,
+``bench`` or ``production``), from the ``FASHION_STORE_ENV`` environment
+variable when no name is given. Settings can then be overridden from a
+Python file named by ``FASHION_STORE_SETTINGS`` and from environment
+variables prefixed with ``FASHION_STORE_`` (for example
+``FASHION_STORE_SQLALCHEMY_DATABASE_URI``).
+"""
+import os
+import tempfile
+
+
+class Config:
+    SECRET_KEY = 'fashion_store_secret_key'  # Required for session management
+    SQLALCHEMY_DATABASE_URI = 'sqlite:///ecommerce.db'
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # Wait for the write lock instead of failing when several threads or worker processes write at once
+    SQLALCHEMY_ENGINE_OPTIONS = {'connect_args': {'timeout': 30}}
+    UPLOAD_FOLDER = 'static/images/profile'
+    MAX_CONTENT_LENGTH = 16 * 1024 * 1024  # 16MB max upload size
+    WARMUP_PATHS = ('/',)
+    # Old orders live in a separate read-only database (see order_archive.py);
+    # None puts it next to the main database as <name>_archive.db
+    ORDER_ARCHIVE_PATH = None
+    ORDER_ARCHIVE_AFTER_DAYS = 365
+    # Output of recommendations.py; None means instance/recommendations
+    RECOMMENDATIONS_DIR = None
+    # Send checkout and signup writes through one batching writer thread (see group_commit.py)
+    GROUP_COMMIT = False
+    GROUP_COMMIT_MAX_BATCH = 64
+    # Seconds a write may wait for others to join its batch; with 0, batches form while the previous one syncs
+    GROUP_COMMIT_MAX_DELAY = 0
+    GROUP_COMMIT_TIMEOUT = 30
+    # Catalog pages reuse product lists this young, and fall back to older
+    # ones if a refresh takes longer than CATALOG_DEADLINE (see resilience.py)
+    CATALOG_FRESH_SECONDS = 5
+    CATALOG_DEADLINE = 0.25
+    CATALOG_BREAKER_FAILURES = 3
+    CATALOG_BREAKER_RESET = 10
+    # Product lists kept in memory; least recently used are dropped first
+    CATALOG_MAX_ENTRIES = 256
+    # {% cache %} blocks in templates (see fragments.py)
+    FRAGMENT_CACHE_BYTES = 8 * 1024 * 1024
+    FRAGMENT_CACHE_TTL = 60
+    # Snapshots written by backup.py; None means instance/backups
+    BACKUP_DIR = None
+    BACKUP_KEEP = 14
+    # Per-IP/per-session limits on login, signup, checkout and the cart calls (see throttle.py)
+    RATE_LIMIT_ENABLED = True
+    RATE_LIMITS = {}
+    # Statements slower than this are logged with their query plan (see
+    # slow_queries.py); None turns the timing off. None for the log means
+    # instance/slow_queries.log
+    SLOW_QUERY_MS = 100
+    SLOW_QUERY_LOG = None
+    SLOW_QUERY_SHAPES = 200
+    SLOW_QUERY_RECENT = 500
+    # Admin request profiler and tracemalloc diffs (see profiler.py). Even when
+    # enabled, requests are only wrapped while an admin has armed it. None for
+    # the directory means instance/profiles; the newest PROFILER_KEEP files stay
+    PROFILER_ENABLED = False
+    PROFILER_DIR = None
+    PROFILER_KEEP = 200
+    PROFILER_SAMPLE_MS = 5
+    PROFILER_TRACE_FRAMES = 1
+    # Admin dashboard figures, followed incrementally (see live_dashboard.py).
+    # At most DASHBOARD_STREAMS event streams per process hold a waitress
+    # thread, each for DASHBOARD_STREAM_SECONDS; other admins poll
+    DASHBOARD_POLL_SECONDS = 1.0
+    DASHBOARD_RESYNC_SECONDS = 5 * 60
+    DASHBOARD_STREAMS = 1
+    DASHBOARD_STREAM_SECONDS = 20
+    DASHBOARD_BACKLOG = 256
+    # How often each process checks the promotion table for changes made by
+    # other processes (see promotions.py)
+    PROMOTIONS_CHECK_SECONDS = 5
+    # Seconds between reloads of the bestseller windows (see bestsellers.py)
+    BESTSELLERS_REFRESH_SECONDS = 60
+    # Order and user change events relayed by outbox.py; None for the
+    # directory means instance/events. Segments are sealed (gzipped) at this size
+    OUTBOX_DIR = None
+    OUTBOX_SEGMENT_BYTES = 64 * 1024 * 1024
+    # Refuse sheddable requests once this many are running; keep it below
+    # waitress's thread count (4 by default, --threads for prefork_server.py)
+    SHED_IN_FLIGHT = 3
+
+
+class DevelopmentConfig(Config):
+    DEBUG = True
+
+
+class TestConfig(Config):
+    """Private in-memory database per app; nothing touches the disk."""
+    TESTING = True
+    SECRET_KEY = 'test'
+    SQLALCHEMY_DATABASE_URI = 'sqlite://'
+    SQLALCHEMY_ENGINE_OPTIONS = {}
+    UPLOAD_FOLDER = os.path.join(tempfile.gettempdir(), 'fashion_store_test_uploads')
+    WARMUP_PATHS = ()
+    # Every test client request comes from the same address
+    RATE_LIMIT_ENABLED = False
+    # No timing, and no log file under instance/
+    SLOW_QUERY_MS = None
+
+
+class BenchConfig(Config):
+    """File-backed database on tmpfs, so benchmarks see real SQLite locking without disk I/O."""
+    SECRET_KEY = 'bench'
+    SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(
+        '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir(),
+        f'fashion_store_bench_{os.getpid()}.db'
+    )
+    # Load generators hit the store from a single address
+    RATE_LIMIT_ENABLED = False
+    UPLOAD_FOLDER = os.path.join(tempfile.gettempdir(), 'fashion_store_bench_uploads')
+
+
+class ProductionConfig(Config):
+    # Taken from the SECRET_KEY environment variable when the app is created; there is no default
+    SECRET_KEY = None
+
+
+config_by_name = {
+    'development': DevelopmentConfig,
+    'dev': DevelopmentConfig,
+    'test': TestConfig,
+    'testing': TestConfig,
+    'bench': BenchConfig,
+    'production': ProductionConfig,
+    'prod': ProductionConfig,
+}
+
+
+def load_config(app, config=None):
+    """Apply a profile (name, class or dict) plus file and environment overrides."""
+    if config is None:
+        config = os.environ.get('FASHION_STORE_ENV', 'development')
+    if isinstance(config, str):
+        try:
+            config = config_by_name[config.lower()]
+        except KeyError:
+            raise ValueError(f"Unknown configuration profile '{config}'") from None
+    if isinstance(config, dict):
+        app.config.from_object(Config)
+        app.config.update(config)
+    else:
+        app.config.from_object(config)
+    app.config.from_envvar('FASHION_STORE_SETTINGS', silent=True)
+    app.config.from_prefixed_env('FASHION_STORE')
+    if app.config.get('SECRET_KEY') is None:
+        app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY')
+        if not app.config['SECRET_KEY']:
+            raise RuntimeError("The production profile needs a SECRET_KEY environment variable")
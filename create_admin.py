@@ -16,6 +16,7 @@ def create_admin_user():
             email='admin@example.com',
             first_name='Admin',
             last_name='User',
+            role='admin',
             password_hash=generate_password_hash('admin123')
         )
         
@@ -0,0 +1,151 @@
+"""Cache for rendered template fragments.
+
+Wrap a block in a template with ``{% cache %}`` and it is rendered once and
+then served from memory:
+
+    {% for product in products %}
+      {% cache 'product_card', product.id %}
+        <div class="card">... {{ usd_to_inr(product.price_cents) }} ...</div>
+      {% endcache %}
+    {% endfor %}
+
+The key is the name and values given to the tag plus the catalog version
+and the display currency, so a card is re-rendered after any product is
+changed or the conversion rate moves. The catalog version is bumped when a
+transaction that changed a Product commits in this process; other worker
+processes pick the change up when their entries expire after
+FRAGMENT_CACHE_TTL seconds. Entries live in an LRU bounded by the total
+size of the cached HTML (FRAGMENT_CACHE_BYTES).
+"""
+from collections import OrderedDict
+import threading
+import time
+
+from jinja2 import nodes
+from jinja2.ext import Extension
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from models import Product
+
+DEFAULT_MAX_BYTES = 8 * 1024 * 1024
+DEFAULT_TTL = 60
+
+_catalog_version = 0
+
+
+def catalog_version():
+    return _catalog_version
+
+
+def bump_catalog_version():
+    global _catalog_version
+    _catalog_version += 1
+
+
+class FragmentCache:
+    """An LRU of rendered HTML strings bounded by their total length."""
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, ttl=DEFAULT_TTL):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key -> (expires, html)
+        self._lock = threading.Lock()
+
+    def get(self, key, now=None):
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= now:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, html, now=None):
+        now = time.monotonic() if now is None else now
+        if len(html) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old[1])
+            self._entries[key] = (now + self.ttl, html)
+            self.size += len(html)
+            while self.size > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self.size -= len(evicted)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class FragmentCacheExtension(Extension):
+    """Adds ``{% cache name, key, ... %}...{% endcache %}`` to the environment."""
+
+    tags = {'cache'}
+
+    def __init__(self, environment):
+        super().__init__(environment)
+        environment.extend(fragment_cache=FragmentCache(), fragment_currency=lambda: None)
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        parts = [parser.parse_expression()]
+        while parser.stream.skip_if('comma'):
+            parts.append(parser.parse_expression())
+        body = parser.parse_statements(('name:endcache',), drop_needle=True)
+        return nodes.CallBlock(self.call_method('_render', [nodes.Tuple(parts, 'load')]),
+                               [], [], body).set_lineno(lineno)
+
+    def _render(self, parts, caller):
+        environment = self.environment
+        key = (parts, _catalog_version, environment.fragment_currency())
+        html = environment.fragment_cache.get(key)
+        if html is None:
+            html = caller()
+            environment.fragment_cache.set(key, html)
+        return html
+
+
+def init_app(app, currency=None):
+    """Enable ``{% cache %}`` in ``app``'s templates.
+
+    ``currency`` returns what, besides the catalog, the cached HTML depends
+    on (for example the display currency and its rate).
+    """
+    app.jinja_env.add_extension(FragmentCacheExtension)
+    cache = app.jinja_env.fragment_cache
+    cache.max_bytes = app.config.get('FRAGMENT_CACHE_BYTES', DEFAULT_MAX_BYTES)
+    cache.ttl = app.config.get('FRAGMENT_CACHE_TTL', DEFAULT_TTL)
+    if currency is not None:
+        app.jinja_env.fragment_currency = currency
+    app.extensions['fragment_cache'] = cache
+    return cache
+
+
+# Bump the catalog version once a transaction that changed products commits
+@event.listens_for(Session, 'after_flush')
+def _remember_catalog_change(session, flush_context):
+    if any(isinstance(obj, Product) for obj in list(session.new) + list(session.dirty) + list(session.deleted)):
+        session.info['catalog_changed'] = True
+
+
+@event.listens_for(Session, 'after_commit')
+def _bump_after_commit(session):
+    if session.info.pop('catalog_changed', False):
+        bump_catalog_version()
+
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_catalog_change(session):
+    session.info.pop('catalog_changed', None)
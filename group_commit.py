@@ -0,0 +1,164 @@
+"""Group commit for order and user inserts.
+
+SQLite has one writer at a time and, in WAL mode, syncs the log on every
+commit. With GROUP_COMMIT enabled, request threads don't write themselves:
+they hand a job to a single writer thread and wait on a future. The writer
+takes every job queued up while it was busy with the previous batch (at
+most GROUP_COMMIT_MAX_BATCH, optionally waiting up to
+GROUP_COMMIT_MAX_DELAY seconds for more), runs each in its own SAVEPOINT
+inside one ``BEGIN IMMEDIATE`` transaction and commits them together, so a
+burst of checkouts costs one lock acquisition and one sync per batch. A job
+that raises only rolls back its own savepoint; its caller gets the
+exception, everyone else in the batch still commits.
+
+A job is ``job(session) -> result``; it must flush whatever it needs for
+its result (e.g. the new row's id) and must not touch objects belonging to
+the caller's session. Use ``run_write(job)``, which runs the job directly
+on ``db.session`` when group commit is off.
+"""
+import atexit
+from concurrent.futures import Future
+import logging
+import queue
+import threading
+import time
+
+from flask import current_app
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+from models import db
+
+DEFAULT_MAX_BATCH = 64
+DEFAULT_MAX_DELAY = 0
+DEFAULT_TIMEOUT = 30
+
+logger = logging.getLogger('fashion-store.group_commit')
+
+_STOP = object()
+
+
+class WriterClosed(RuntimeError):
+    """The writer was shut down; the job was not run."""
+
+
+class GroupCommitWriter:
+    def __init__(self, engine, max_batch=DEFAULT_MAX_BATCH, max_delay=DEFAULT_MAX_DELAY):
+        self.engine = engine
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.batches = 0
+        self.jobs = 0
+        self._queue = queue.Queue()
+        self._thread = None
+        self._closed = False
+        self._lock = threading.Lock()
+
+    def submit(self, job):
+        """Queue ``job`` for the next batch; returns a Future for its result."""
+        future = Future()
+        with self._lock:
+            if self._closed:
+                raise WriterClosed('The group-commit writer has been closed')
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='group-commit', daemon=True)
+                self._thread.start()
+            self._queue.put((job, future))
+        return future
+
+    def close(self, timeout=10):
+        """Commit what is queued, then stop the writer thread."""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            thread = self._thread
+        if thread is not None:
+            self._queue.put(_STOP)
+            thread.join(timeout)
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is _STOP:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.max_delay
+            while len(batch) < self.max_batch:
+                try:
+                    item = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+            self._commit(batch)
+
+    def _commit(self, batch):
+        outcomes = []
+        try:
+            with Session(self.engine, expire_on_commit=False) as session:
+                # Take the write lock up front so the batch never has to upgrade a read lock
+                session.execute(text('BEGIN IMMEDIATE'))
+                for job, future in batch:
+                    if not future.set_running_or_notify_cancel():
+                        continue
+                    try:
+                        with session.begin_nested():
+                            result = job(session)
+                    except Exception as e:
+                        outcomes.append((future, False, e))
+                    else:
+                        outcomes.append((future, True, result))
+                session.commit()
+        except Exception as e:
+            logger.exception("Group commit of %d jobs failed", len(batch))
+            for _, future in batch:
+                if future.running():
+                    future.set_exception(e)
+            return
+        self.batches += 1
+        self.jobs += len(outcomes)
+        # Only now is every successful job durable
+        for future, ok, value in outcomes:
+            if ok:
+                future.set_result(value)
+            else:
+                future.set_exception(value)
+
+
+def run_write(job, timeout=None):
+    """Run ``job(session)`` and commit it; returns the job's result or raises its exception."""
+    writer = current_app.extensions.get('group_commit')
+    if writer is None:
+        try:
+            result = job(db.session)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        return result
+    future = writer.submit(job)
+    try:
+        return future.result(timeout or current_app.config.get('GROUP_COMMIT_TIMEOUT', DEFAULT_TIMEOUT))
+    except TimeoutError:
+        # Drop the job if the writer has not started it yet
+        future.cancel()
+        raise
+
+
+def init_app(app):
+    """Start routing run_write() jobs through a writer thread if GROUP_COMMIT is set."""
+    if not app.config.get('GROUP_COMMIT'):
+        return None
+    with app.app_context():
+        engine = db.engine
+    writer = app.extensions['group_commit'] = GroupCommitWriter(
+        engine,
+        app.config.get('GROUP_COMMIT_MAX_BATCH', DEFAULT_MAX_BATCH),
+        app.config.get('GROUP_COMMIT_MAX_DELAY', DEFAULT_MAX_DELAY),
+    )
+    atexit.register(writer.close)
+    return writer
@@ -0,0 +1,155 @@
+"""Who is logged in, without a user-row query on every request.
+
+``current_user()`` is memoized on ``flask.g`` for the rest of the request and
+backed by a small per-process TTL cache of ``Identity`` snapshots keyed by
+user id. Commits that change or delete a user evict that user's entry, so
+profile and role changes are seen immediately by this process and within
+``IDENTITY_TTL`` seconds by other worker processes.
+
+Write paths (profile updates) still load the full ``User`` row.
+"""
+from functools import wraps
+import threading
+import time
+
+from flask import flash, g, redirect, session, url_for
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from models import db, User
+
+IDENTITY_TTL = 30
+IDENTITY_CACHE_SIZE = 10000
+
+_IDENTITY_FIELDS = (
+    'id', 'username', 'email', 'role', 'first_name', 'last_name', 'phone',
+    'profile_image', 'created_date', 'street_address', 'city', 'state',
+    'postal_code', 'country'
+)
+
+
+class Identity:
+    """Read-only snapshot of a user's non-secret columns."""
+    __slots__ = _IDENTITY_FIELDS
+
+    def __init__(self, user):
+        for field in _IDENTITY_FIELDS:
+            setattr(self, field, getattr(user, field))
+
+    @property
+    def is_admin(self):
+        return self.role == 'admin'
+
+    get_full_address = User.get_full_address
+
+
+class IdentityCache:
+    def __init__(self, ttl=IDENTITY_TTL, max_entries=IDENTITY_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = {}  # user id -> (expires_at, identity)
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        entry = self._entries.get(user_id)
+        if entry is None or entry[0] < time.monotonic():
+            return None
+        return entry[1]
+
+    def put(self, identity):
+        with self._lock:
+            if len(self._entries) >= self.max_entries:
+                now = time.monotonic()
+                for user_id in [k for k, (expires_at, _) in self._entries.items() if expires_at < now]:
+                    del self._entries[user_id]
+                if len(self._entries) >= self.max_entries:
+                    self._entries.clear()
+            self._entries[identity.id] = (time.monotonic() + self.ttl, identity)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+identity_cache = IdentityCache()
+
+
+def load_identity(user_id):
+    """Identity for ``user_id`` from the cache, or from the database on a miss."""
+    identity = identity_cache.get(user_id)
+    if identity is None:
+        user = db.session.get(User, user_id)
+        if user is None:
+            return None
+        identity = Identity(user)
+        identity_cache.put(identity)
+    return identity
+
+
+def current_user():
+    """The logged-in user's Identity, or None. Looked up at most once per request."""
+    if 'current_user' not in g:
+        user_id = session.get('user_id')
+        identity = load_identity(user_id) if user_id is not None else None
+        if user_id is not None and identity is None:
+            # The account is gone; forget the stale login
+            session.pop('user_id', None)
+            session.pop('username', None)
+        g.current_user = identity
+    return g.current_user
+
+
+def login_required(message):
+    """Redirect anonymous visitors to the login page with ``message``."""
+    def decorator(view):
+        @wraps(view)
+        def wrapped(*args, **kwargs):
+            if 'user_id' not in session:
+                flash(message, 'warning')
+                return redirect(url_for('login'))
+            if current_user() is None:
+                flash('User not found. Please login again.', 'danger')
+                return redirect(url_for('login'))
+            return view(*args, **kwargs)
+        return wrapped
+    return decorator
+
+
+def admin_required(view):
+    """Only let users with the admin role through."""
+    @wraps(view)
+    def wrapped(*args, **kwargs):
+        if 'user_id' not in session:
+            flash('Please login to access admin panel', 'warning')
+            return redirect(url_for('login'))
+        user = current_user()
+        if user is None or not user.is_admin:
+            flash('You do not have permission to access this page', 'danger')
+            return redirect(url_for('home'))
+        return view(*args, **kwargs)
+    return wrapped
+
+
+# Evict users changed in a transaction once it commits, so a concurrent
+# request can't re-cache the old row in between
+@event.listens_for(Session, 'after_flush')
+def _remember_changed_users(session, flush_context):
+    changed = session.info.setdefault('changed_user_ids', set())
+    for obj in list(session.dirty) + list(session.deleted):
+        if isinstance(obj, User) and obj.id is not None:
+            changed.add(obj.id)
+
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_changed_users(session):
+    for user_id in session.info.pop('changed_user_ids', ()):
+        identity_cache.invalidate(user_id)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_changed_users(session):
+    session.info.pop('changed_user_ids', None)
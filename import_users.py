@@ -0,0 +1,293 @@
+"""Bulk import of user accounts from CSV or JSON Lines.
+
+    python import_users.py customers.csv
+    python import_users.py customers.jsonl --rejects rejected.jsonl
+
+Records use the User column names (username, email, first_name, last_name,
+phone, street_address, city, state, postal_code, country, role) plus either
+``password`` or ``password_hash``, an existing werkzeug hash such as
+``pbkdf2:sha256:600000$salt$hex`` that is stored as is. Plain passwords are
+hashed on a process pool, one worker per core by default; hashing is by far
+the slowest part of an import, so migrating hashes avoids it entirely.
+
+Usernames and (case-insensitively) emails that already exist, or appear
+earlier in the file, are skipped. The existing ones are read once up front
+rather than looked up row by row. Accounts are inserted BATCH_SIZE at a
+time, each batch in one transaction, and after every batch the number of
+records handled is saved to ``<file>.checkpoint``; run the same command
+again after an interruption to carry on from there (``--restart`` starts
+over). Rows of a batch that was committed but not yet checkpointed are
+simply skipped as existing on the second run.
+
+The outbox gets a 'user created' event for every imported account, written
+by the same transaction as its batch (see outbox.py).
+
+Invalid records are counted and, with ``--rejects``, written to a JSON
+Lines file with the reason (passwords are left out).
+"""
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import csv
+from datetime import datetime
+from itertools import islice, repeat
+import json
+import logging
+import os
+import re
+import time
+
+from sqlalchemy import DateTime, bindparam, func, insert, literal, literal_column, select, text
+from werkzeug.security import generate_password_hash
+
+from models import db, OutboxEvent, User
+from outbox import PRIVATE_FIELDS
+
+BATCH_SIZE = 2000
+
+FIELDS = (
+    'username', 'email', 'first_name', 'last_name', 'phone', 'role', 'created_date',
+    'street_address', 'city', 'state', 'postal_code', 'country'
+)
+ROLES = ('customer', 'admin')
+DEFAULT_COUNTRY = User.__table__.c.country.default.arg
+
+# What werkzeug's generate_password_hash() produces (and check_password_hash() accepts)
+WERKZEUG_HASH = re.compile(r'^(pbkdf2:[a-z0-9_]+(:\d+)?|scrypt(:\d+){0,3})\$[^$]+\$[0-9a-f]+$')
+
+logger = logging.getLogger('fashion-store.import_users')
+
+_user = User.__table__
+
+
+def _isoformat(column):
+    # SQLite stores '2025-03-02 10:15:04.000000'; datetime.isoformat() gives '2025-03-02T10:15:04'
+    return func.replace(func.replace(column, ' ', 'T'), '.000000', '')
+
+
+# The same payload as outbox.snapshot(), built by SQLite for every account above :before
+_user_created = OutboxEvent.__table__.insert().from_select(
+    ['topic', 'op', 'key', 'payload', 'created_at'],
+    select(
+        literal('user'), literal('created'), _user.c.id,
+        func.json_object(*[part for column in _user.columns if column.name not in PRIVATE_FIELDS
+                           for part in (literal_column(f"'{column.name}'"),
+                                        _isoformat(column) if isinstance(column.type, DateTime) else column)]),
+        bindparam('created_at', type_=DateTime),
+    ).where(_user.c.id > bindparam('before')).order_by(_user.c.id),
+)
+
+
+class Rejected(ValueError):
+    """A record that can't be imported; the message says why."""
+
+
+def read_records(path, format=None):
+    """Yield the records of a .csv or .jsonl file as dicts (a Rejected for unreadable lines)."""
+    format = format or ('csv' if path.lower().endswith('.csv') else 'jsonl')
+    with open(path, encoding='utf-8-sig', newline='' if format == 'csv' else None) as f:
+        if format == 'csv':
+            yield from csv.DictReader(f)
+            return
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError as e:
+                yield Rejected(f'not valid JSON: {e}')
+                continue
+            yield record if isinstance(record, dict) else Rejected('not a JSON object')
+
+
+def clean(record, allow_admin=False):
+    """The User row and plain password (None if already hashed) for ``record``."""
+    if isinstance(record, Rejected):
+        raise record
+    # executemany() needs the same keys in every row, so missing values are filled in here
+    row = {}
+    for field in FIELDS:
+        value = record.get(field)
+        if isinstance(value, str):
+            value = value.strip()
+        row[field] = None if value in (None, '') else value
+
+    if not row.get('username'):
+        raise Rejected('missing username')
+    email = row['email']
+    if not email or '@' not in email:
+        raise Rejected('missing or invalid email')
+    role = row['role'] = row['role'] or 'customer'
+    if role not in ROLES or (role == 'admin' and not allow_admin):
+        raise Rejected(f'role {role!r} not allowed')
+    row['country'] = row['country'] or DEFAULT_COUNTRY
+    if row['created_date'] is None:
+        row['created_date'] = datetime.utcnow()
+    else:
+        try:
+            row['created_date'] = datetime.fromisoformat(row['created_date'])
+        except (TypeError, ValueError):
+            raise Rejected('invalid created_date') from None
+
+    password_hash = (record.get('password_hash') or '').strip()
+    if password_hash:
+        if not WERKZEUG_HASH.match(password_hash):
+            raise Rejected('password_hash is not a werkzeug password hash')
+        row['password_hash'] = password_hash
+        return row, None
+    password = record.get('password')
+    if not password:
+        raise Rejected('missing password')
+    row['password_hash'] = None
+    return row, str(password)
+
+
+def _hash_password(password, method):
+    return generate_password_hash(password) if method is None else generate_password_hash(password, method)
+
+
+def existing_accounts():
+    """Every username and lower-cased email already in the database."""
+    usernames, emails = set(), set()
+    rows = db.session.execute(select(User.username, func.lower(User.email)))
+    for username, email in rows:
+        usernames.add(username)
+        emails.add(email)
+    return usernames, emails
+
+
+def load_checkpoint(path, source):
+    """Saved progress for ``source``, or None if there is none (or it was for another file)."""
+    try:
+        with open(path) as f:
+            state = json.load(f)
+    except FileNotFoundError:
+        return None
+    if state.get('source') != os.path.abspath(source) or state.get('size') != os.path.getsize(source):
+        raise SystemExit(f"{path} belongs to a different input file; use --restart to start over")
+    return state
+
+
+def save_checkpoint(path, state):
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(state, f)
+    os.replace(tmp, path)
+
+
+def import_users(path, format=None, batch_size=BATCH_SIZE, workers=None, method=None,
+                 allow_admin=False, checkpoint=None, restart=False, rejects=None):
+    """Import the accounts in ``path`` (inside an app context); returns the final counts."""
+    checkpoint = checkpoint or path + '.checkpoint'
+    state = None if restart else load_checkpoint(checkpoint, path)
+    if state is None:
+        state = {'source': os.path.abspath(path), 'size': os.path.getsize(path), 'records': 0,
+                 'imported': 0, 'existing': 0, 'duplicates': 0, 'rejected': 0, 'conflicts': 0}
+    elif state.get('finished'):
+        logger.info("%s was already imported completely", path)
+        return state
+    else:
+        logger.info("Resuming %s after %d records", path, state['records'])
+
+    usernames, emails = existing_accounts()
+    records = read_records(path, format)
+    skipped = sum(1 for _ in islice(records, state['records']))
+    if skipped < state['records']:
+        raise SystemExit(f"{path} is shorter than its checkpoint; use --restart to start over")
+    statement = insert(User).prefix_with('OR IGNORE')
+
+    def commit(batch, rejects_file):
+        rows, hashes, tally, rejected = batch
+        for row, password_hash in zip(rows, hashes):
+            if password_hash is not None:
+                row['password_hash'] = password_hash
+        if rows:
+            connection = db.session.connection()
+            # Take the write lock first, so no signup can take an id between here and the outbox rows
+            connection.execute(text('BEGIN IMMEDIATE'))
+            before = connection.execute(select(func.coalesce(func.max(_user.c.id), 0))).scalar()
+            # OR IGNORE: an account signed up since existing_accounts() ran is counted, not fatal
+            inserted = connection.execute(statement, rows).rowcount
+            # Core inserts skip the session's outbox hook, so the events are written here
+            connection.execute(_user_created, {'before': before, 'created_at': datetime.utcnow()})
+            db.session.commit()
+            tally['imported'] += inserted
+            tally['conflicts'] += len(rows) - inserted
+        rejects_file.writelines(json.dumps(line) + '\n' for line in rejected)
+        rejects_file.flush()
+        for name, count in tally.items():
+            state[name] += count
+        save_checkpoint(checkpoint, state)
+
+    started = time.perf_counter()
+    seen_usernames, seen_emails = set(), set()
+    position = resumed_at = state['records']
+    pending = None
+    workers = workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=workers) as pool, \
+            open(rejects or os.devnull, 'a', encoding='utf-8') as rejects_file:
+        while True:
+            chunk = list(islice(records, batch_size))
+            if not chunk:
+                break
+            tally = dict.fromkeys(('records', 'imported', 'existing', 'duplicates', 'rejected', 'conflicts'), 0)
+            tally['records'] = len(chunk)
+            rows, passwords, rejected = [], [], []
+            for position, record in enumerate(chunk, position + 1):
+                try:
+                    row, password = clean(record, allow_admin)
+                except Rejected as e:
+                    tally['rejected'] += 1
+                    rejected.append({'record': position, 'reason': str(e)})
+                    continue
+                username, email = row['username'], row['email'].lower()
+                if username in usernames or email in emails:
+                    tally['existing'] += 1
+                    continue
+                if username in seen_usernames or email in seen_emails:
+                    tally['duplicates'] += 1
+                    continue
+                seen_usernames.add(username)
+                seen_emails.add(email)
+                rows.append(row)
+                passwords.append(password)
+
+            # Hash this batch on the pool while the previous one is written
+            hashed = pool.map(_hash_password, [password for password in passwords if password is not None],
+                              repeat(method), chunksize=max(1, len(passwords) // (workers * 4)))
+            if pending:
+                commit(pending, rejects_file)
+                logger.info("%d records handled, %d imported (%.0f records/s)", state['records'],
+                            state['imported'], (state['records'] - resumed_at) / (time.perf_counter() - started))
+            hashed = iter(list(hashed))
+            pending = (rows, [None if password is None else next(hashed) for password in passwords], tally, rejected)
+        if pending:
+            commit(pending, rejects_file)
+    state['finished'] = True
+    save_checkpoint(checkpoint, state)
+    return state
+
+
+if __name__ == '__main__':
+    from app import get_app
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Import user accounts from a CSV or JSON Lines file")
+    parser.add_argument('file')
+    parser.add_argument('--format', choices=('csv', 'jsonl'), help="default: from the file extension")
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    parser.add_argument('--workers', type=int, default=None, help="hashing processes (default: one per core)")
+    parser.add_argument('--method', default=None, help="werkzeug hash method (default: werkzeug's default)")
+    parser.add_argument('--allow-admin', action='store_true', help="accept records with role 'admin'")
+    parser.add_argument('--checkpoint', default=None, help="default: FILE.checkpoint")
+    parser.add_argument('--restart', action='store_true', help="ignore the checkpoint and start from the top")
+    parser.add_argument('--rejects', default=None, help="append rejected records to this JSON Lines file")
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    with get_app().app_context():
+        counts = import_users(args.file, args.format, args.batch_size, args.workers, args.method,
+                              args.allow_admin, args.checkpoint, args.restart, args.rejects)
+    print(f"Imported {counts['imported']} users from {counts['records']} records "
+          f"({counts['existing']} already existed, {counts['duplicates']} duplicates in the file, "
+          f"{counts['rejected']} rejected, {counts['conflicts']} signed up meanwhile) "
+          f"in {time.perf_counter() - started:.1f}s")
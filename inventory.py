@@ -0,0 +1,65 @@
+"""Stock tracking for the Fashion Store.
+
+Checkout reserves every cart line with a conditional UPDATE, so two requests
+racing for the last unit can never both succeed: the database only
+decrements a row when enough stock is left, and a line that cannot be filled
+rolls back the whole order.
+"""
+from sqlalchemy import text
+
+from cart import MAX_QUANTITY
+
+# Stock given to the sample products and to existing products when the
+# stock column is first added to an old database
+INITIAL_STOCK = 100
+
+_RESERVE_SQL = text(
+    'UPDATE product SET stock = stock - :quantity '
+    'WHERE id = :product_id AND stock >= :quantity'
+)
+
+
+class OutOfStockError(Exception):
+    """Raised when a cart line asks for more units than are in stock."""
+
+    def __init__(self, product_id, quantity):
+        super().__init__(f"Not enough stock for product {product_id} (requested {quantity})")
+        self.product_id = product_id
+        self.quantity = quantity
+
+
+def merge_lines(lines):
+    """Combine (product_id, quantity) pairs so each product is reserved once."""
+    merged = {}
+    for product_id, quantity in lines:
+        product_id = int(product_id)
+        merged[product_id] = merged.get(product_id, 0) + int(quantity)
+    return merged
+
+
+def reserve_stock(session, lines):
+    """Decrement stock for every (product_id, quantity) line.
+
+    Runs inside the caller's transaction: the caller commits together with
+    the order insert, or rolls back if this raises. Products are updated in
+    id order so concurrent reservations always take row locks in the same
+    order on databases that have them.
+    """
+    merged = merge_lines(lines)
+    for product_id in sorted(merged):
+        quantity = merged[product_id]
+        # Also guards carts stored before MAX_QUANTITY existed; SQLite integers overflow past 2**63
+        if not 0 < quantity <= MAX_QUANTITY:
+            raise ValueError(f"Invalid quantity {quantity} for product {product_id}")
+        result = session.execute(_RESERVE_SQL, {'product_id': product_id, 'quantity': quantity})
+        if result.rowcount != 1:
+            raise OutOfStockError(product_id, quantity)
+
+
+def release_stock(session, lines):
+    """Put reserved units back, e.g. when an order is cancelled."""
+    for product_id, quantity in merge_lines(lines).items():
+        session.execute(
+            text('UPDATE product SET stock = stock + :quantity WHERE id = :product_id'),
+            {'product_id': product_id, 'quantity': quantity}
+        )
@@ -0,0 +1,66 @@
+"""Read-only rows for the listing pages.
+
+The catalog and admin lists show a handful of columns of many rows. Loading
+them as ORM objects puts every instance in the session's identity map and
+pulls in the large text columns (``Product.description``,
+``Order.order_items``) the lists never display. The helpers here select only
+the listed columns and return plain named tuples instead: immutable, cheap,
+safe to share between threads (see resilience.py) and never flushed.
+
+Pages that show or change a single record (product and order details,
+profile, checkout) keep using the models.
+"""
+from collections import namedtuple
+
+from sqlalchemy import select
+
+from models import db, Order, Product, User
+from order_archive import order_source
+
+ProductRow = namedtuple('ProductRow', 'id name price_cents category image_url stock created_date')
+UserRow = namedtuple('UserRow', 'id username email first_name last_name phone role created_date')
+OrderRow = namedtuple('OrderRow', 'id user_id customer_name customer_email customer_phone order_date order_total_cents')
+
+
+def _columns(source, row_type):
+    return [getattr(source, field) for field in row_type._fields]
+
+
+def fetch(statement, row_type):
+    """Run ``statement`` and return its rows as ``row_type`` tuples."""
+    return list(map(row_type._make, db.session.execute(statement)))
+
+
+def select_products():
+    """SELECT of the ProductRow columns, for callers that filter or sort themselves."""
+    return select(*_columns(Product, ProductRow))
+
+
+def select_users():
+    """SELECT of the UserRow columns."""
+    return select(*_columns(User, UserRow))
+
+
+def select_orders():
+    """SELECT of the OrderRow columns of the hot order table (the archive is left out)."""
+    return select(*_columns(Order, OrderRow))
+
+
+def product_rows(category=None):
+    statement = select_products()
+    if category is not None:
+        statement = statement.where(Product.category == category)
+    return fetch(statement.order_by(Product.id), ProductRow)
+
+
+def user_rows():
+    return fetch(select_users().order_by(User.id), UserRow)
+
+
+def order_rows(start=None, end=None, user_id=None, limit=None):
+    """Orders in [start, end), newest first, from the hot table and, if needed, the archive."""
+    source = order_source(start, end, user_id)
+    statement = select(*_columns(source.c, OrderRow)).order_by(source.c.order_date.desc())
+    if limit is not None:
+        statement = statement.limit(limit)
+    return fetch(statement, OrderRow)
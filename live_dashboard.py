@@ -0,0 +1,350 @@
+"""Live figures for the admin dashboard, pushed over Server-Sent Events.
+
+Each worker process keeps one Dashboard with what admin_dashboard() shows:
+revenue and order count, user count, products per category and the latest
+orders and users. Instead of reloading every table on every refresh it
+follows what changed:
+
+* orders and users newer than the last id seen are counted and summed (a
+  range on the primary key), at most every DASHBOARD_POLL_SECONDS. A
+  commit in this process that adds one wakes the poller straight away;
+  checkouts and signups in other worker processes show up on the next poll.
+* products are recounted when the catalog version moves (see fragments.py).
+* everything is recounted every DASHBOARD_RESYNC_SECONDS, and soon after an
+  order or user is deleted here, which corrects edits, deletions and
+  archiving done elsewhere.
+
+The page renders the current figures. ``/admin/dashboard/stream`` is an
+``EventSource`` for the changes: a ``snapshot`` event with every section,
+then ``delta`` events with the sections that changed (``orders``, ``users``,
+``products``), each with an id of the form ``<process epoch>-<sequence>``.
+The last DASHBOARD_BACKLOG events are kept, so a browser that reconnects
+with ``Last-Event-ID`` gets what it missed; one that fell further behind, or
+that reached another worker process, gets a new snapshot.
+
+Waitress has a handful of threads per process, so a stream may only hold
+one of them for DASHBOARD_STREAM_SECONDS, and at most DASHBOARD_STREAMS
+streams are held at once. Other admins get the pending events and the
+stream closes at once with a longer ``retry``, so their browsers poll
+instead. Either way no database work is done per admin: they all read the
+same figures, and the poller stops a minute after the last admin leaves.
+
+    const source = new EventSource('/admin/dashboard/stream');
+    source.addEventListener('snapshot', e => render(JSON.parse(e.data)));
+    source.addEventListener('delta', e => render(JSON.parse(e.data)));
+"""
+from collections import deque
+from datetime import date, datetime
+import json
+import logging
+import threading
+import time
+import uuid
+import weakref
+
+from sqlalchemy import event, func, select
+from sqlalchemy.orm import Session
+
+from fragments import catalog_version
+import listings
+from listings import OrderRow, UserRow
+from models import db, Order, Product, User
+from order_archive import order_source
+
+DEFAULT_POLL_SECONDS = 1.0
+DEFAULT_RESYNC_SECONDS = 5 * 60
+DEFAULT_STREAMS = 1
+DEFAULT_STREAM_SECONDS = 20
+DEFAULT_BACKLOG = 256
+RECENT = 5
+RETRY_MS = 500  # reconnect delay after a held stream ends
+BUSY_RETRY_MS = 5000  # reconnect delay when every stream slot was taken
+IDLE_SECONDS = 60  # keep polling this long after the last stream request
+RESYNC_AFTER_DELETE = 5
+
+SECTIONS = ('orders', 'users', 'products')
+
+logger = logging.getLogger('fashion-store.live_dashboard')
+
+_dashboards = weakref.WeakSet()
+
+
+def _json_default(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+def _encode(name, event_id, data):
+    data = json.dumps(data, separators=(',', ':'), default=_json_default)
+    return f'id: {event_id}\nevent: {name}\ndata: {data}\n\n'
+
+
+class Dashboard:
+    """Running totals for one process; see the module docstring."""
+
+    def __init__(self, app, convert=None, poll_seconds=DEFAULT_POLL_SECONDS,
+                 resync_seconds=DEFAULT_RESYNC_SECONDS, streams=DEFAULT_STREAMS,
+                 stream_seconds=DEFAULT_STREAM_SECONDS, backlog=DEFAULT_BACKLOG):
+        self.app = app
+        self.convert = convert or (lambda cents: cents)
+        self.poll_seconds = poll_seconds
+        self.resync_seconds = resync_seconds
+        self.stream_seconds = stream_seconds
+        self.epoch = uuid.uuid4().hex[:8]
+        self.seq = 0
+        self.events = deque(maxlen=backlog)  # (seq, encoded event)
+        self.state = None
+        self.polled_at = 0.0
+        self.resync_at = 0.0
+        self.client_seen = 0.0
+        self.held = 0
+        self.stats = {'polls': 0, 'resyncs': 0, 'streams': 0, 'busy': 0}
+        self._changed = threading.Condition()
+        self._refreshing = threading.Lock()
+        self._wake = threading.Event()
+        self._slots = threading.BoundedSemaphore(streams)
+        self._poller = None
+        _dashboards.add(self)
+
+    # Keeping the figures --------------------------------------------------
+
+    def _sections(self, state, names=SECTIONS):
+        sections = {}
+        if 'orders' in names:
+            sections['orders'] = {
+                'count': state['order_count'],
+                'revenue': self.convert(state['revenue']),
+                'recent': [row._asdict() for row in state['recent_orders']],
+            }
+        if 'users' in names:
+            sections['users'] = {
+                'count': state['user_count'],
+                'recent': [row._asdict() for row in state['recent_users']],
+            }
+        if 'products' in names:
+            sections['products'] = {'count': sum(state['categories'].values()), 'categories': state['categories']}
+        return sections
+
+    def _publish(self, state, changed):
+        with self._changed:
+            self.state = state
+            if changed:
+                self.seq += 1
+                self.events.append((self.seq, _encode('delta', f'{self.epoch}-{self.seq}',
+                                                      self._sections(state, changed))))
+            self._changed.notify_all()
+
+    def _count_products(self):
+        rows = db.session.execute(select(Product.category, func.count()).group_by(Product.category))
+        return {category: count for category, count in rows}
+
+    def _resync(self):
+        version = catalog_version()
+        last_order = db.session.scalar(select(func.max(Order.id))) or 0
+        last_user = db.session.scalar(select(func.max(User.id))) or 0
+        source = order_source()
+        order_count, revenue = db.session.execute(
+            select(func.count(), func.coalesce(func.sum(source.c.order_total_cents), 0)).where(source.c.id <= last_order)
+        ).one()
+        state = {
+            'last_order_id': last_order,
+            'last_user_id': last_user,
+            'order_count': order_count,
+            'revenue': revenue,
+            'user_count': db.session.scalar(select(func.count()).select_from(User).where(User.id <= last_user)),
+            'categories': self._count_products(),
+            'catalog_version': version,
+            'recent_orders': listings.fetch(
+                listings.select_orders().where(Order.id <= last_order).order_by(Order.id.desc()).limit(RECENT),
+                OrderRow),
+            'recent_users': listings.fetch(
+                listings.select_users().where(User.id <= last_user).order_by(User.id.desc()).limit(RECENT),
+                UserRow),
+        }
+        self.stats['resyncs'] += 1
+        self.resync_at = time.monotonic() + self.resync_seconds
+        # A full snapshot may differ from the last one in every section
+        self._publish(state, SECTIONS if self.state is not None else ())
+
+    def _poll(self):
+        state = dict(self.state)
+        changed = []
+        count, total, last = db.session.execute(
+            select(func.count(), func.coalesce(func.sum(Order.order_total_cents), 0), func.max(Order.id))
+            .where(Order.id > state['last_order_id'])
+        ).one()
+        if count:
+            # Ids are handed out in commit order (one writer at a time), so nothing is skipped
+            latest = listings.fetch(
+                listings.select_orders().where(Order.id > state['last_order_id'], Order.id <= last)
+                .order_by(Order.id.desc()).limit(RECENT), OrderRow)
+            state.update(last_order_id=last, order_count=state['order_count'] + count,
+                         revenue=state['revenue'] + total, recent_orders=(latest + state['recent_orders'])[:RECENT])
+            changed.append('orders')
+
+        count, last = db.session.execute(
+            select(func.count(), func.max(User.id)).where(User.id > state['last_user_id'])
+        ).one()
+        if count:
+            latest = listings.fetch(
+                listings.select_users().where(User.id > state['last_user_id'], User.id <= last)
+                .order_by(User.id.desc()).limit(RECENT), UserRow)
+            state.update(last_user_id=last, user_count=state['user_count'] + count,
+                         recent_users=(latest + state['recent_users'])[:RECENT])
+            changed.append('users')
+
+        version = catalog_version()
+        if version != state['catalog_version']:
+            categories = self._count_products()
+            if categories != state['categories']:
+                changed.append('products')
+            state.update(catalog_version=version, categories=categories)
+        self.stats['polls'] += 1
+        self._publish(state, changed)
+
+    def refresh(self, wait=False):
+        """Bring the figures up to date; skipped if another thread is already doing it."""
+        if not self._refreshing.acquire(blocking=wait):
+            return
+        try:
+            with self.app.app_context():
+                if self.state is None or time.monotonic() >= self.resync_at:
+                    self._resync()
+                else:
+                    self._poll()
+            self.polled_at = time.monotonic()
+        except Exception:
+            if self.state is None:
+                raise
+            logger.exception("Refreshing the dashboard failed")
+        finally:
+            self._refreshing.release()
+
+    def changed(self, deleted=False):
+        """Called after this process commits an order or user change."""
+        if deleted:
+            self.resync_at = min(self.resync_at, time.monotonic() + RESYNC_AFTER_DELETE)
+        self._wake.set()
+
+    def current(self):
+        """The figures for the page, polled first if the poller isn't keeping them fresh."""
+        if self.state is None:
+            self.refresh(wait=True)
+        elif time.monotonic() - self.polled_at >= self.poll_seconds:
+            self.refresh()
+        with self._changed:
+            return self._sections(self.state)
+
+    def _ensure_poller(self):
+        # Started lazily so a forked worker gets its own thread
+        if self._poller is not None and self._poller.is_alive():
+            return
+        with self._changed:
+            if self._poller is None or not self._poller.is_alive():
+                self._poller = threading.Thread(target=self._poll_forever, name='dashboard-poller', daemon=True)
+                self._poller.start()
+
+    def _poll_forever(self):
+        while time.monotonic() - self.client_seen < IDLE_SECONDS:
+            self._wake.wait(self.poll_seconds)
+            self._wake.clear()
+            self.refresh()
+
+    # Streaming -------------------------------------------------------------
+
+    def _parse_event_id(self, event_id):
+        epoch, _, seq = (event_id or '').partition('-')
+        if epoch != self.epoch or not seq.isdigit():
+            return None
+        return int(seq)
+
+    def _pending(self, after):
+        """Encoded events after sequence ``after`` (a snapshot if they are gone) and the new position."""
+        oldest = self.events[0][0] if self.events else self.seq + 1
+        if after is None or after > self.seq or after < oldest - 1:
+            return [_encode('snapshot', f'{self.epoch}-{self.seq}', self._sections(self.state))], self.seq
+        return [chunk for seq, chunk in self.events if seq > after], self.seq
+
+    def stream(self, last_event_id=None):
+        """The text chunks of one SSE response; see the module docstring."""
+        self.client_seen = time.monotonic()
+        self._ensure_poller()
+        if self.state is None:
+            self.refresh(wait=True)
+        after = self._parse_event_id(last_event_id)
+
+        def generate():
+            # The slot is taken here, not before, so a response that is never iterated can't leak it
+            held = self._slots.acquire(blocking=False)
+            self.stats['streams' if held else 'busy'] += 1
+            if held:
+                self.held += 1
+            try:
+                yield f'retry: {RETRY_MS if held else BUSY_RETRY_MS}\n\n'
+                position = after
+                deadline = time.monotonic() + (self.stream_seconds if held else 0)
+                while True:
+                    with self._changed:
+                        chunks, position = self._pending(position)
+                        remaining = deadline - time.monotonic()
+                        if not chunks and remaining > 0:
+                            self._changed.wait(min(remaining, IDLE_SECONDS / 2))
+                            chunks, position = self._pending(position)
+                    if chunks:
+                        yield ''.join(chunks)
+                    if time.monotonic() >= deadline:
+                        return
+                    self.client_seen = time.monotonic()
+                    self._ensure_poller()
+            finally:
+                if held:
+                    self.held -= 1
+                    self._slots.release()
+
+        return generate()
+
+    def report(self):
+        return dict(self.stats, seq=self.seq, held=self.held, backlog=len(self.events),
+                    polling=self._poller is not None and self._poller.is_alive())
+
+
+def get_dashboard(app):
+    return app.extensions['live_dashboard']
+
+
+def init_app(app, convert=None):
+    """Set up the dashboard of ``app``; ``convert`` turns USD cents into the display currency."""
+    dashboard = app.extensions['live_dashboard'] = Dashboard(
+        app,
+        convert=convert,
+        poll_seconds=app.config.get('DASHBOARD_POLL_SECONDS', DEFAULT_POLL_SECONDS),
+        resync_seconds=app.config.get('DASHBOARD_RESYNC_SECONDS', DEFAULT_RESYNC_SECONDS),
+        streams=app.config.get('DASHBOARD_STREAMS', DEFAULT_STREAMS),
+        stream_seconds=app.config.get('DASHBOARD_STREAM_SECONDS', DEFAULT_STREAM_SECONDS),
+        backlog=app.config.get('DASHBOARD_BACKLOG', DEFAULT_BACKLOG),
+    )
+    return dashboard
+
+
+# Wake the dashboards once a transaction that added or removed orders or users commits
+@event.listens_for(Session, 'after_flush')
+def _remember_dashboard_change(session, flush_context):
+    if any(isinstance(obj, (Order, User)) for obj in session.new):
+        session.info['dashboard_changed'] = True
+    if any(isinstance(obj, (Order, User)) for obj in session.deleted):
+        session.info['dashboard_changed'] = session.info['dashboard_deleted'] = True
+
+
+@event.listens_for(Session, 'after_commit')
+def _wake_dashboards(session):
+    deleted = session.info.pop('dashboard_deleted', False)
+    if session.info.pop('dashboard_changed', False):
+        for dashboard in list(_dashboards):
+            dashboard.changed(deleted)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_dashboard_change(session):
+    session.info.pop('dashboard_changed', None)
+    session.info.pop('dashboard_deleted', None)
@@ -1,8 +1,13 @@
 from app import app, db
 from sqlalchemy import Column, String
+from inventory import INITIAL_STOCK
+import money
+from order_archive import archive_path
 
 # Run this script to migrate the database schema
-# It will add the phone field to the User model and customer_phone field to the Order model
+# It will add the phone field to the User model, customer_phone field to the Order model,
+# the stock field to the Product model and the role field to the User model,
+# and convert dollar amounts stored as REAL to integer cents (see money.py)
 
 def migrate_db():
     with app.app_context():
@@ -24,6 +29,39 @@ def migrate_db():
         except Exception as e:
             print(f"Error adding customer_phone column to Order table: {e}")
         
+        # Add stock column to Product table if it doesn't exist
+        try:
+            with db.engine.connect() as conn:
+                conn.execute(db.text('ALTER TABLE product ADD COLUMN stock INTEGER NOT NULL DEFAULT 0'))
+                print("Added stock column to Product table")
+                
+                # Give existing products their initial stock
+                conn.execute(db.text('UPDATE product SET stock = :stock'), {'stock': INITIAL_STOCK})
+                conn.commit()
+                print("Set initial stock for existing products")
+        except Exception as e:
+            print(f"Error adding stock column to Product table: {e}")
+        
+        # Add role column to User table if it doesn't exist
+        try:
+            with db.engine.connect() as conn:
+                conn.execute(db.text("ALTER TABLE user ADD COLUMN role VARCHAR(20) NOT NULL DEFAULT 'customer'"))
+                print("Added role column to User table")
+                
+                # The admin account keeps its admin rights
+                conn.execute(db.text("UPDATE user SET role = 'admin' WHERE username = 'admin'"))
+                conn.commit()
+                print("Gave the admin user the admin role")
+        except Exception as e:
+            print(f"Error adding role column to User table: {e}")
+        
+        # Store prices and order totals as integer cents
+        try:
+            converted = money.upgrade_schema(db.engine, archive_path(app))
+            print(f"Converted money columns to cents in: {', '.join(converted) or 'nothing (already converted)'}")
+        except Exception as e:
+            print(f"Error converting money columns to cents: {e}")
+        
         print("Migration completed")
 
 if __name__ == "__main__":
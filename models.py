@@ -0,0 +1,133 @@
+"""Database models for the Fashion Store.
+
+``db`` is not bound to an application here; ``create_app()`` in app.py
+attaches it, so importing the models costs nothing and several apps (for
+example isolated test instances) can share them.
+"""
+from datetime import datetime
+import sqlite3
+
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from werkzeug.security import generate_password_hash, check_password_hash
+
+from money import Money
+
+db = SQLAlchemy()
+
+# Use WAL so readers never block on a writer; the setting is stored in the database file
+@event.listens_for(Engine, 'connect')
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.close()
+
+# User Model
+class User(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    username = db.Column(db.String(80), unique=True, nullable=False)
+    email = db.Column(db.String(120), unique=True, nullable=False)
+    password_hash = db.Column(db.String(200), nullable=False)  # No longer nullable
+    first_name = db.Column(db.String(50))
+    last_name = db.Column(db.String(50))
+    profile_image = db.Column(db.String(200), default='images/profile/default-profile.jpg')
+    phone = db.Column(db.String(20), nullable=True)  # Added phone field
+    role = db.Column(db.String(20), nullable=False, default='customer')  # 'customer' or 'admin'
+    created_date = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    # Address fields
+    street_address = db.Column(db.String(200))
+    city = db.Column(db.String(100))
+    state = db.Column(db.String(100))
+    postal_code = db.Column(db.String(20))
+    country = db.Column(db.String(100), default='India')
+    
+    def set_password(self, password):
+        self.password_hash = generate_password_hash(password)
+        
+    def check_password(self, password):
+        return check_password_hash(self.password_hash, password)
+
+    def get_full_address(self):
+        address_parts = []
+        if self.street_address:
+            address_parts.append(self.street_address)
+        if self.city:
+            address_parts.append(self.city)
+        if self.state:
+            address_parts.append(self.state)
+        if self.postal_code:
+            address_parts.append(self.postal_code)
+        if self.country:
+            address_parts.append(self.country)
+        
+        if address_parts:
+            return ", ".join(address_parts)
+        return "No address provided"
+
+# Product Model
+class Product(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(100), nullable=False)
+    price_cents = db.Column(Money, nullable=False)  # USD cents (see money.py)
+    description = db.Column(db.Text, nullable=False)
+    category = db.Column(db.String(50), nullable=False)
+    image_url = db.Column(db.String(200), nullable=False)
+    stock = db.Column(db.Integer, nullable=False, default=0)
+    created_date = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (db.CheckConstraint('stock >= 0', name='ck_product_stock'),)
+
+# Order Model
+class Order(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)
+    customer_name = db.Column(db.String(100), nullable=False)
+    customer_email = db.Column(db.String(100), nullable=False)
+    customer_phone = db.Column(db.String(20), nullable=False)  # Added phone field
+    customer_address = db.Column(db.Text, nullable=False)
+    order_date = db.Column(db.DateTime, default=datetime.utcnow)
+    order_total_cents = db.Column(Money, nullable=False)  # USD cents
+    order_items = db.Column(db.Text, nullable=False)  # JSON string of items
+    
+    user = db.relationship('User', backref=db.backref('orders', lazy=True))
+
+# Promotion Model: discounts and coupons applied when a cart is priced (see promotions.py)
+class Promotion(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(100), nullable=False)  # Shown next to the discount
+    kind = db.Column(db.String(20), nullable=False)  # 'percent', 'amount' or 'buy_x_get_y'
+    percent = db.Column(db.Integer)  # 'percent': whole percent off
+    amount_cents = db.Column(Money)  # 'amount': USD cents off each unit (off the order for cart-wide rules)
+    buy_quantity = db.Column(db.Integer)  # buy_x_get_y: for every buy_quantity units bought...
+    get_quantity = db.Column(db.Integer)  # ...get_quantity more are free
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'))  # Applies to this product,
+    category = db.Column(db.String(50))  # or this category, or (neither set) the whole cart
+    coupon_code = db.Column(db.String(40), index=True)  # Only when this code is entered (upper case)
+    min_subtotal_cents = db.Column(Money)
+    starts_at = db.Column(db.DateTime)
+    ends_at = db.Column(db.DateTime)
+    active = db.Column(db.Boolean, nullable=False, default=True)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+# Sales Bucket Model: units sold per product per hour and per day (see bestsellers.py)
+class SalesBucket(db.Model):
+    __tablename__ = 'sales_bucket'
+    granularity = db.Column(db.String(4), primary_key=True)  # 'hour' or 'day'
+    start = db.Column(db.DateTime, primary_key=True)  # Start of the hour or day (UTC)
+    product_id = db.Column(db.Integer, primary_key=True)
+    units = db.Column(db.Integer, nullable=False, default=0)
+
+# Outbox Model: order and user changes waiting for the relay (see outbox.py)
+class OutboxEvent(db.Model):
+    __tablename__ = 'outbox'
+    id = db.Column(db.Integer, primary_key=True)  # The event's offset; AUTOINCREMENT never reuses one
+    topic = db.Column(db.String(20), nullable=False)  # 'order' or 'user'
+    op = db.Column(db.String(10), nullable=False)  # 'created', 'updated' or 'deleted'
+    key = db.Column(db.Integer, nullable=False)
+    payload = db.Column(db.Text, nullable=False)  # JSON snapshot of the row
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    __table_args__ = {'sqlite_autoincrement': True}
@@ -0,0 +1,152 @@
+"""Money as integers in minor units.
+
+Prices, discounts and totals are stored and computed as whole US cents
+(``Product.price_cents``, ``Order.order_total_cents``, and the
+``price_cents``, ``discount_cents`` and ``item_total_cents`` of every order
+line), so adding up a cart or a year of orders is exact integer arithmetic.
+Floats only appear where a person types an amount (``to_cents()``).
+
+Amounts shown in another currency are converted with an integer rate in the
+minor units of that currency per dollar (paise per USD) and rounded once,
+half up, at the very end (``convert()``). The same expression works on
+NumPy int64 arrays, so reports convert whole columns at a time.
+
+Databases from before integer money are converted by ``upgrade_schema()``:
+the REAL columns are replaced by INTEGER ones and the order lines are
+rewritten, all in one transaction per file.
+"""
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+import os
+import sqlite3
+
+from sqlalchemy.types import Integer, TypeDecorator
+
+CENTS_PER_UNIT = 100
+
+
+class Money(TypeDecorator):
+    """An INTEGER column of minor units that refuses anything but ints."""
+
+    impl = Integer
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is not None and (isinstance(value, bool) or not isinstance(value, int)):
+            raise TypeError(f'money is stored in integer cents, got {value!r}')
+        return value
+
+
+def to_cents(amount):
+    """Cents in ``amount`` (a string, int, float or Decimal in dollars), rounded half up.
+
+    Raises ValueError if ``amount`` is not a finite number.
+    """
+    try:
+        # str() first, so 19.99 becomes Decimal('19.99') and not its binary approximation
+        value = Decimal(str(amount).strip())
+    except (InvalidOperation, TypeError):
+        raise ValueError(f'not an amount: {amount!r}') from None
+    if not value.is_finite():
+        raise ValueError(f'not an amount: {amount!r}')
+    return int((value * CENTS_PER_UNIT).to_integral_value(rounding=ROUND_HALF_UP))
+
+
+def format_cents(cents):
+    """'12.30' for 1230."""
+    sign = '-' if cents < 0 else ''
+    units, rest = divmod(abs(cents), CENTS_PER_UNIT)
+    return f'{sign}{units}.{rest:02d}'
+
+
+def convert(cents, rate):
+    """Whole units of another currency for ``cents``, at ``rate`` of its minor units per dollar.
+
+    ``cents`` may be an int or a NumPy integer array of non-negative
+    amounts. Rounds half up, once.
+    """
+    scale = CENTS_PER_UNIT * CENTS_PER_UNIT
+    return (cents * rate + scale // 2) // scale
+
+
+# Converting databases from REAL dollars -------------------------------------
+
+def _cents_sql(expression):
+    return f'CAST(ROUND({expression} * 100) AS INTEGER)'
+
+
+# Every order line gets integer price_cents, discount_cents and item_total_cents in place of its dollar amounts
+_ORDER_LINES_SQL = (
+    "SELECT json_group_array(json(json_set(json_remove(line.value, '$.price', '$.discount', '$.item_total'), "
+    "'$.price_cents', {price}, '$.discount_cents', {discount}, '$.item_total_cents', {item_total}))) "
+    'FROM json_each(t.order_items) AS line'
+).format(
+    price=_cents_sql("json_extract(line.value, '$.price')"),
+    discount=_cents_sql("coalesce(json_extract(line.value, '$.discount'), 0)"),
+    item_total=_cents_sql("json_extract(line.value, '$.item_total')"),
+)
+
+# table -> [(old REAL column, new INTEGER column, SQL for the new value), ...]
+_CONVERSIONS = {
+    'product': [('price', 'price_cents', _cents_sql('price'))],
+    'order': [('order_total', 'order_total_cents', _cents_sql('order_total'))],
+    'promotion': [
+        ('value', 'percent', "CASE WHEN kind = 'percent' THEN CAST(ROUND(value) AS INTEGER) END"),
+        (None, 'amount_cents', f"CASE WHEN kind = 'amount' THEN {_cents_sql('value')} END"),
+        ('min_subtotal', 'min_subtotal_cents', _cents_sql('min_subtotal')),
+    ],
+}
+
+
+def _columns(conn, schema, table):
+    return [row[1] for row in conn.execute(f'PRAGMA {schema}.table_info("{table}")')]
+
+
+def convert_tables(conn, schema='main'):
+    """Replace the dollar columns of the tables in ``schema`` with cents; returns the tables converted.
+
+    ``conn`` is a sqlite3 connection. Tables that don't exist or were
+    converted already are left alone, so this is safe to run on every start.
+    """
+    converted = []
+    conn.execute('SAVEPOINT money')
+    try:
+        for table, columns in _CONVERSIONS.items():
+            existing = _columns(conn, schema, table)
+            if not existing or columns[0][0] not in existing:
+                continue
+            for _, new, _ in columns:
+                if new not in existing:
+                    conn.execute(f'ALTER TABLE {schema}."{table}" ADD COLUMN {new} INTEGER')
+            conn.execute(f'UPDATE {schema}."{table}" AS t SET ' + ', '.join(
+                f'{new} = {expression}' for _, new, expression in columns))
+            if table == 'order':
+                conn.execute(f'UPDATE {schema}."order" AS t SET order_items = ({_ORDER_LINES_SQL}) '
+                             f"WHERE json_valid(t.order_items) AND json_type(t.order_items) = 'array'")
+            for old, _, _ in columns:
+                if old is not None:
+                    conn.execute(f'ALTER TABLE {schema}."{table}" DROP COLUMN {old}')
+            converted.append(table)
+    except BaseException:
+        conn.execute('ROLLBACK TO money')
+        conn.execute('RELEASE money')
+        raise
+    conn.execute('RELEASE money')
+    return converted
+
+
+def upgrade_schema(engine, archive_file=None):
+    """Convert the database of ``engine``, and the order archive file if there is one."""
+    converted = []
+    raw = engine.raw_connection()
+    try:
+        converted += convert_tables(raw.driver_connection)
+    finally:
+        raw.close()
+    if archive_file and os.path.exists(archive_file):
+        # The app only ever attaches the archive read-only
+        conn = sqlite3.connect(archive_file, timeout=30, isolation_level=None)
+        try:
+            converted += [f'archive {table}' for table in convert_tables(conn)]
+        finally:
+            conn.close()
+    return converted
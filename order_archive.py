@@ -0,0 +1,269 @@
+"""Hot/cold storage for orders.
+
+Old orders are moved in batches from the ``order`` table in ecommerce.db into
+a separate SQLite file (``ORDER_ARCHIVE_PATH``, by default
+``ecommerce_archive.db`` next to the main database). Every connection opened
+by the app ATTACHes that file read-only as ``archive``. The query helpers
+below only read the archive when the requested date range reaches back past
+the newest archived order, so day-to-day pages only touch the small hot
+table.
+
+Run the mover from cron or by hand:
+
+    python order_archive.py --older-than-days 365 --batch-size 500 --vacuum
+
+Archived orders are read-only: they are returned as ordinary ``Order``
+objects, but changes to them are not saved.
+"""
+import argparse
+from datetime import datetime, timedelta
+import os
+import sqlite3
+import threading
+import time
+
+from flask import abort, current_app
+from sqlalchemy import MetaData, event, select, union_all, func
+
+import money
+from models import db, Order
+
+ARCHIVE_SCHEMA = 'archive'
+DEFAULT_ARCHIVE_AFTER_DAYS = 365
+DEFAULT_BATCH_SIZE = 500
+
+_archive_table = Order.__table__.to_metadata(MetaData(), schema=ARCHIVE_SCHEMA)
+
+# Newest archived order date per archive file, refreshed at most every HORIZON_TTL seconds
+HORIZON_TTL = 60
+_horizons = {}
+_horizons_lock = threading.Lock()
+
+
+def archive_path(app):
+    """Path of the archive file for ``app``, or None for in-memory databases."""
+    configured = app.config.get('ORDER_ARCHIVE_PATH')
+    if configured:
+        return configured
+    with app.app_context():
+        database = db.engine.url.database
+    if not database or database == ':memory:':
+        return None
+    root, ext = os.path.splitext(database)
+    return f"{root}_archive{ext or '.db'}"
+
+
+def init_app(app):
+    """ATTACH the archive read-only on every new connection of ``app``'s engine."""
+    path = archive_path(app)
+    if path is None:
+        return
+    app.extensions['order_archive'] = path
+    with app.app_context():
+        engine = db.engine
+
+    @event.listens_for(engine, 'connect')
+    def attach_archive(dbapi_connection, connection_record):
+        _attach(dbapi_connection, connection_record.info, path)
+
+
+def _attach(dbapi_connection, info, path):
+    if os.path.exists(path):
+        uri = 'file:' + os.path.abspath(path).replace('?', '%3f') + '?mode=ro'
+        dbapi_connection.execute(f"ATTACH DATABASE ? AS {ARCHIVE_SCHEMA}", (uri,))
+        info['archive_attached'] = True
+
+
+def _archive_attached():
+    path = current_app.extensions.get('order_archive')
+    if path is None:
+        return False
+    conn = db.session.connection()
+    if not conn.info.get('archive_attached'):
+        # The archive may have been created after this connection was opened
+        try:
+            _attach(conn.connection.dbapi_connection, conn.info, path)
+        except sqlite3.OperationalError:
+            return False
+    return bool(conn.info.get('archive_attached'))
+
+
+def archive_horizon():
+    """Date of the newest archived order, or None when nothing is archived."""
+    if not _archive_attached():
+        return None
+    path = current_app.extensions['order_archive']
+    now = time.monotonic()
+    cached = _horizons.get(path)
+    if cached and cached[0] > now:
+        return cached[1]
+    horizon = db.session.execute(select(func.max(_archive_table.c.order_date))).scalar()
+    with _horizons_lock:
+        _horizons[path] = (now + HORIZON_TTL, horizon)
+    return horizon
+
+
+def _needs_archive(start):
+    horizon = archive_horizon()
+    return horizon is not None and (start is None or start <= horizon)
+
+
+def _filtered(table, start, end, user_id, after_id=None):
+    query = select(*table.c)
+    if after_id is not None:
+        query = query.where(table.c.id > after_id)
+    if start is not None:
+        query = query.where(table.c.order_date >= start)
+    if end is not None:
+        query = query.where(table.c.order_date < end)
+    if user_id is not None:
+        query = query.where(table.c.user_id == user_id)
+    return query
+
+
+def order_tables(start=None):
+    """The tables holding orders from ``start`` on: the hot table, plus the archive if needed."""
+    if _needs_archive(start):
+        return [Order.__table__, _archive_table]
+    return [Order.__table__]
+
+
+def order_source(start=None, end=None, user_id=None, after_id=None):
+    """Order rows in [start, end) as a subquery: the hot table, plus the archive if needed.
+
+    ``after_id`` keeps only orders with a higher id, for readers that pick up
+    new orders incrementally.
+    """
+    selects = [_filtered(table, start, end, user_id, after_id) for table in order_tables(start)]
+    if len(selects) == 1:
+        return selects[0].subquery()
+    return union_all(*selects).subquery()
+
+
+def query_orders(start=None, end=None, user_id=None, limit=None):
+    """Orders in [start, end), newest first, from the hot table and, if needed, the archive."""
+    source = order_source(start, end, user_id)
+    statement = select(source).order_by(source.c.order_date.desc())
+    if limit is not None:
+        statement = statement.limit(limit)
+    return db.session.execute(select(Order).from_statement(statement)).scalars().all()
+
+
+def get_order(order_id):
+    """An order by id from the hot table, falling back to the archive; None if missing."""
+    order = db.session.get(Order, order_id)
+    if order is None and _archive_attached():
+        statement = select(*_archive_table.c).where(_archive_table.c.id == order_id)
+        order = db.session.execute(select(Order).from_statement(statement)).scalars().first()
+    return order
+
+
+def get_order_or_404(order_id):
+    order = get_order(order_id)
+    if order is None:
+        abort(404)
+    return order
+
+
+# Mover ---------------------------------------------------------------------
+
+def _columns(conn, schema, table):
+    return [row[1] for row in conn.execute(f'PRAGMA {schema}.table_info("{table}")')]
+
+
+def _prepare_archive(conn):
+    """Create the archive table and bring its columns up to date with the hot table."""
+    # Either file may still hold dollar amounts as REAL
+    money.convert_tables(conn, 'main')
+    money.convert_tables(conn, ARCHIVE_SCHEMA)
+    ddl = conn.execute("SELECT sql FROM main.sqlite_master WHERE type = 'table' AND name = 'order'").fetchone()
+    if ddl is None:
+        raise RuntimeError('The order table does not exist')
+    if not _columns(conn, ARCHIVE_SCHEMA, 'order'):
+        create = ddl[0].replace('CREATE TABLE "order"', f'CREATE TABLE {ARCHIVE_SCHEMA}."order"', 1)
+        conn.execute(create)
+    else:
+        archived = set(_columns(conn, ARCHIVE_SCHEMA, 'order'))
+        for row in conn.execute('PRAGMA main.table_info("order")').fetchall():
+            name, column_type, default = row[1], row[2], row[4]
+            if name not in archived:
+                column = f'"{name}" {column_type}'
+                if default is not None:
+                    column += f' DEFAULT {default}'
+                conn.execute(f'ALTER TABLE {ARCHIVE_SCHEMA}."order" ADD COLUMN {column}')
+    conn.execute(f'CREATE INDEX IF NOT EXISTS {ARCHIVE_SCHEMA}.ix_order_order_date ON "order" (order_date)')
+    conn.execute(f'CREATE INDEX IF NOT EXISTS {ARCHIVE_SCHEMA}.ix_order_user_id ON "order" (user_id)')
+    # The same search indexes as the hot table (imported here: admin_search imports this module)
+    from admin_search import ORDER_INDEXES
+    for name, expression in ORDER_INDEXES:
+        conn.execute(f'CREATE INDEX IF NOT EXISTS {ARCHIVE_SCHEMA}.{name} ON "order" ({expression})')
+    conn.commit()
+
+
+def archive_orders(database_path, archive_file, older_than_days=DEFAULT_ARCHIVE_AFTER_DAYS,
+                   batch_size=DEFAULT_BATCH_SIZE, pause=0.05, vacuum=False):
+    """Move orders older than ``older_than_days`` into ``archive_file``; returns how many moved.
+
+    Each batch is copied and committed to the archive first, then deleted
+    from the hot table in a second short transaction, so a crash in between
+    only leaves a duplicate that the next run cleans up. The newest order
+    is never moved, so SQLite can't hand its id out again.
+    """
+    cutoff = datetime.utcnow() - timedelta(days=older_than_days)
+    conn = sqlite3.connect(database_path, timeout=30, isolation_level=None)
+    moved = 0
+    try:
+        conn.execute(f"ATTACH DATABASE ? AS {ARCHIVE_SCHEMA}", (archive_file,))
+        conn.execute('BEGIN')
+        _prepare_archive(conn)
+        columns = ', '.join(f'"{name}"' for name in _columns(conn, 'main', 'order'))
+        while True:
+            ids = [row[0] for row in conn.execute(
+                'SELECT id FROM main."order" WHERE order_date < ? '
+                'AND id < (SELECT MAX(id) FROM main."order") ORDER BY id LIMIT ?',
+                (cutoff.strftime('%Y-%m-%d %H:%M:%S.%f'), batch_size)
+            )]
+            if not ids:
+                break
+            placeholders = ', '.join('?' * len(ids))
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute(
+                f'INSERT OR IGNORE INTO {ARCHIVE_SCHEMA}."order" ({columns}) '
+                f'SELECT {columns} FROM main."order" WHERE id IN ({placeholders})', ids
+            )
+            conn.execute('COMMIT')
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute(
+                f'DELETE FROM main."order" WHERE id IN ({placeholders}) '
+                f'AND id IN (SELECT id FROM {ARCHIVE_SCHEMA}."order")', ids
+            )
+            conn.execute('COMMIT')
+            moved += len(ids)
+            # Let request threads at the write lock between batches
+            time.sleep(pause)
+        if vacuum and moved:
+            conn.execute('VACUUM main')
+    finally:
+        conn.close()
+    return moved
+
+
+if __name__ == '__main__':
+    from app import get_app
+
+    parser = argparse.ArgumentParser(description="Move old orders into the archive database")
+    parser.add_argument('--older-than-days', type=int, default=None,
+                        help=f"archive orders older than this (default: ORDER_ARCHIVE_AFTER_DAYS or {DEFAULT_ARCHIVE_AFTER_DAYS})")
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument('--vacuum', action='store_true', help="shrink ecommerce.db afterwards")
+    args = parser.parse_args()
+
+    app = get_app()
+    path = archive_path(app)
+    if path is None:
+        raise SystemExit("The configured database is in memory; nothing to archive")
+    with app.app_context():
+        database = db.engine.url.database
+    days = args.older_than_days or app.config.get('ORDER_ARCHIVE_AFTER_DAYS', DEFAULT_ARCHIVE_AFTER_DAYS)
+    moved = archive_orders(database, path, days, args.batch_size, vacuum=args.vacuum)
+    print(f"Archived {moved} orders older than {days} days into {path}")
@@ -0,0 +1,177 @@
+"""Storage backends for one-time login codes.
+
+``MemoryOTPStore`` (the default) keeps codes in a dict with an expiry time and
+a background thread that sweeps expired entries, so issuing and verifying a
+code never touches the disk. ``SQLiteOTPStore`` keeps codes in their own
+SQLite file for setups that need codes to survive a restart or be shared
+between processes; it stores one row per phone, indexes the expiry time and
+purges expired rows in small batches.
+
+Pick the backend with the ``OTP_STORE`` environment variable
+(``memory`` or ``sqlite``) and the file with ``OTP_DB_PATH``.
+"""
+import hmac
+import os
+import re
+import secrets
+import sqlite3
+import threading
+import time
+
+OTP_LENGTH = 6
+OTP_TTL_SECONDS = 10 * 60
+
+# ASCII digits only: compare_digest() raises TypeError on non-ASCII strings
+_OTP_FORMAT = re.compile(f'[0-9]{{{OTP_LENGTH}}}')
+
+
+def generate_otp():
+    return ''.join(secrets.choice('0123456789') for _ in range(OTP_LENGTH))
+
+
+def _well_formed(otp_code):
+    """Whether ``otp_code`` looks like a code we issue; anything else can't match."""
+    return isinstance(otp_code, str) and _OTP_FORMAT.fullmatch(otp_code) is not None
+
+
+class MemoryOTPStore:
+    """Per-process TTL map of phone -> (code, expires_at)."""
+
+    def __init__(self, ttl=OTP_TTL_SECONDS, sweep_interval=60):
+        self.ttl = ttl
+        self.sweep_interval = sweep_interval
+        self._codes = {}
+        self._lock = threading.Lock()
+        self._sweeper = None
+
+    def issue(self, phone):
+        """Create a new code for ``phone``, replacing any earlier one."""
+        self._ensure_sweeper()
+        otp_code = generate_otp()
+        with self._lock:
+            self._codes[phone] = (otp_code, time.monotonic() + self.ttl)
+        return otp_code
+
+    def verify(self, phone, otp_code):
+        """Check and consume the code; a code can only be used once."""
+        if not _well_formed(otp_code):
+            return False
+        with self._lock:
+            entry = self._codes.get(phone)
+            if entry is None:
+                return False
+            stored_code, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._codes[phone]
+                return False
+            if not hmac.compare_digest(stored_code, otp_code):
+                return False
+            del self._codes[phone]
+            return True
+
+    def purge_expired(self):
+        now = time.monotonic()
+        with self._lock:
+            expired = [phone for phone, (_, expires_at) in self._codes.items() if expires_at < now]
+            for phone in expired:
+                del self._codes[phone]
+        return len(expired)
+
+    def _ensure_sweeper(self):
+        # Started lazily so a forked worker gets its own thread
+        if self._sweeper is not None and self._sweeper.is_alive():
+            return
+        with self._lock:
+            if self._sweeper is None or not self._sweeper.is_alive():
+                self._sweeper = threading.Thread(target=self._sweep_forever, name='otp-sweeper', daemon=True)
+                self._sweeper.start()
+
+    def _sweep_forever(self):
+        while True:
+            time.sleep(self.sweep_interval)
+            self.purge_expired()
+
+    def __len__(self):
+        return len(self._codes)
+
+
+class SQLiteOTPStore:
+    """Codes in a dedicated SQLite file, one row per phone."""
+
+    def __init__(self, path, ttl=OTP_TTL_SECONDS, purge_every=500, purge_batch=1000):
+        self.path = path
+        self.ttl = ttl
+        self.purge_every = purge_every
+        self.purge_batch = purge_batch
+        self._local = threading.local()
+        self._issued = 0
+        with self._connect() as conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS otp_code ('
+                ' phone TEXT PRIMARY KEY,'
+                ' otp_code TEXT NOT NULL,'
+                ' expires_at REAL NOT NULL)'
+            )
+            conn.execute('CREATE INDEX IF NOT EXISTS ix_otp_code_expires_at ON otp_code (expires_at)')
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10)
+            # Codes are short-lived: losing the last few on power loss is fine
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def issue(self, phone):
+        otp_code = generate_otp()
+        conn = self._connect()
+        with conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO otp_code (phone, otp_code, expires_at) VALUES (?, ?, ?)',
+                (phone, otp_code, time.time() + self.ttl)
+            )
+        self._issued += 1
+        if self._issued % self.purge_every == 0:
+            self.purge_expired()
+        return otp_code
+
+    def verify(self, phone, otp_code):
+        if not _well_formed(otp_code):
+            return False
+        conn = self._connect()
+        row = conn.execute(
+            'SELECT otp_code FROM otp_code WHERE phone = ? AND expires_at >= ?', (phone, time.time())
+        ).fetchone()
+        # Compared here in constant time, as MemoryOTPStore does, not with = in SQL
+        if row is None or not hmac.compare_digest(row[0], otp_code):
+            return False
+        with conn:
+            # Only one of two concurrent verifications of the same code gets to delete it
+            cursor = conn.execute('DELETE FROM otp_code WHERE phone = ? AND otp_code = ?', (phone, row[0]))
+        return cursor.rowcount == 1
+
+    def purge_expired(self):
+        """Delete expired rows in batches so the write lock is held briefly."""
+        conn = self._connect()
+        total = 0
+        while True:
+            with conn:
+                cursor = conn.execute(
+                    'DELETE FROM otp_code WHERE rowid IN ('
+                    ' SELECT rowid FROM otp_code WHERE expires_at < ? LIMIT ?)',
+                    (time.time(), self.purge_batch)
+                )
+            total += cursor.rowcount
+            if cursor.rowcount < self.purge_batch:
+                return total
+
+
+def create_otp_store(kind=None, path=None):
+    kind = (kind or os.environ.get('OTP_STORE', 'memory')).lower()
+    if kind == 'memory':
+        return MemoryOTPStore()
+    if kind == 'sqlite':
+        return SQLiteOTPStore(path or os.environ.get('OTP_DB_PATH', 'otp.db'))
+    raise ValueError(f"Unknown OTP store '{kind}' (expected 'memory' or 'sqlite')")
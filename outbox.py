@@ -0,0 +1,261 @@
+"""Order and user change events for downstream consumers.
+
+Whenever a flush inserts, changes or deletes an Order or a User, a row is
+added to the ``outbox`` table on the same connection, so the event commits
+or rolls back together with the change (checkout, signup, profile edits,
+and each job of a group commit). The row's id is the event's offset:
+SQLite hands ids out in commit order and AUTOINCREMENT never reuses one.
+
+The relay copies the outbox into JSON Lines segment files and then deletes
+the copied rows, so consumers (finance, warehouse, analytics) read files
+instead of competing with checkout for the database:
+
+    python outbox.py relay                 # keep tailing the outbox
+    python outbox.py relay --once          # copy what is there and exit
+    python outbox.py tail --after 41234    # print events after an offset
+
+Events are appended to ``events-<first offset>.jsonl`` in OUTBOX_DIR
+(default ``instance/events``). Once that file reaches OUTBOX_SEGMENT_BYTES
+it is sealed: gzipped to ``events-<first>-<last>.jsonl.gz`` and a new file
+is started. Every line is one event::
+
+    {"offset": 41235, "topic": "order", "op": "created", "key": 9120,
+     "at": "2025-03-02T10:15:04.123456", "data": {...}}
+
+A consumer remembers the last offset it processed and resumes with
+``read_events(directory, after=offset)``; the open segment may end in a
+partial line while the relay is writing, which the reader skips. Password
+hashes are never included.
+"""
+import argparse
+from datetime import date, datetime
+import glob
+import gzip
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import time
+
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+
+from models import OutboxEvent, Order, User
+
+DEFAULT_SEGMENT_BYTES = 64 * 1024 * 1024
+BATCH_SIZE = 1000
+POLL_INTERVAL = 1.0
+
+TOPICS = {Order: 'order', User: 'user'}
+PRIVATE_FIELDS = {'password_hash'}
+
+logger = logging.getLogger('fashion-store.outbox')
+
+_outbox = OutboxEvent.__table__
+
+
+def _json_default(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+def snapshot(obj):
+    """The columns of ``obj`` as a dict, without secrets; order items are decoded."""
+    data = {attr.key: getattr(obj, attr.key) for attr in inspect(obj).mapper.column_attrs
+            if attr.key not in PRIVATE_FIELDS}
+    if isinstance(obj, Order) and isinstance(data.get('order_items'), str):
+        try:
+            data['order_items'] = json.loads(data['order_items'])
+        except ValueError:
+            pass
+    return data
+
+
+@event.listens_for(Session, 'after_flush')
+def _record_changes(session, flush_context):
+    rows = []
+    for op, objects in (('created', session.new), ('updated', session.dirty), ('deleted', session.deleted)):
+        for obj in objects:
+            topic = TOPICS.get(type(obj))
+            if topic is None or (op == 'updated' and not session.is_modified(obj, include_collections=False)):
+                continue
+            data = {'id': obj.id} if op == 'deleted' else snapshot(obj)
+            rows.append({'topic': topic, 'op': op, 'key': obj.id,
+                         'payload': json.dumps(data, default=_json_default), 'created_at': datetime.utcnow()})
+    if rows:
+        # Same connection and transaction as the flush itself
+        session.connection().execute(_outbox.insert(), rows)
+
+
+# Relay ---------------------------------------------------------------------
+
+def _segments(directory):
+    """(first offset, path) of every segment, oldest first; the open one, if any, last."""
+    found = []
+    for path in glob.glob(os.path.join(directory, 'events-*.jsonl*')):
+        name = os.path.basename(path)
+        if name.endswith(('.jsonl', '.jsonl.gz')):
+            found.append((int(name[len('events-'):].split('-')[0].split('.')[0]), path))
+    return sorted(found, key=lambda item: (item[0], item[1].endswith('.jsonl')))
+
+
+class SegmentWriter:
+    """Appends events to the open segment and seals it once it is big enough."""
+
+    def __init__(self, directory, max_bytes=DEFAULT_SEGMENT_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        self.last_offset = self._recover()
+
+    def _recover(self):
+        """Tidy up after a crash; returns the last offset already written."""
+        last = 0
+        for first, path in _segments(self.directory):
+            if path.endswith('.gz'):
+                last = max(last, int(os.path.basename(path).split('-')[2].split('.')[0]))
+                continue
+            if first <= last:
+                # Sealed, but the relay stopped before removing it
+                os.remove(path)
+                continue
+            with open(path, 'rb+') as f:
+                data = f.read()
+                complete = data.rfind(b'\n') + 1
+                if complete < len(data):
+                    f.truncate(complete)
+                if complete:
+                    last = json.loads(data[:complete].splitlines()[-1])['offset']
+                else:
+                    f.close()
+                    os.remove(path)
+        return last
+
+    def _open_path(self):
+        segments = _segments(self.directory)
+        if segments and segments[-1][1].endswith('.jsonl'):
+            return segments[-1][1]
+        return None
+
+    def append(self, events):
+        """Write ``events`` (dicts with an 'offset') to disk and fsync them."""
+        if not events:
+            return
+        path = self._open_path() or os.path.join(self.directory, f"events-{events[0]['offset']:016d}.jsonl")
+        with open(path, 'a', encoding='utf-8') as f:
+            f.writelines(json.dumps(e, separators=(',', ':'), default=_json_default) + '\n' for e in events)
+            f.flush()
+            os.fsync(f.fileno())
+        self.last_offset = events[-1]['offset']
+        if os.path.getsize(path) >= self.max_bytes:
+            self.seal()
+
+    def seal(self):
+        """Compress the open segment to events-<first>-<last>.jsonl.gz."""
+        path = self._open_path()
+        if path is None:
+            return None
+        first = os.path.basename(path)[len('events-'):-len('.jsonl')]
+        sealed = os.path.join(self.directory, f'events-{first}-{self.last_offset:016d}.jsonl.gz')
+        with open(path, 'rb') as src, gzip.open(sealed + '.partial', 'wb') as dst:
+            shutil.copyfileobj(src, dst, 1024 * 1024)
+        with open(sealed + '.partial', 'rb') as f:
+            os.fsync(f.fileno())
+        os.replace(sealed + '.partial', sealed)
+        os.remove(path)
+        logger.info("Sealed %s", sealed)
+        return sealed
+
+
+def relay_once(conn, writer, batch_size=BATCH_SIZE):
+    """Move up to ``batch_size`` events from the outbox into segments; returns how many."""
+    rows = conn.execute(
+        'SELECT id, topic, op, key, payload, created_at FROM outbox WHERE id > ? ORDER BY id LIMIT ?',
+        (writer.last_offset, batch_size)).fetchall()
+    if rows:
+        writer.append([
+            {'offset': row[0], 'topic': row[1], 'op': row[2], 'key': row[3],
+             'at': row[5].replace(' ', 'T') if row[5] else None, 'data': json.loads(row[4])}
+            for row in rows
+        ])
+    # Only delete what is safely on disk (this also clears rows copied before a crash)
+    with conn:
+        conn.execute('DELETE FROM outbox WHERE id <= ?', (writer.last_offset,))
+    return len(rows)
+
+
+def run_relay(database_path, directory, max_bytes=DEFAULT_SEGMENT_BYTES, once=False, interval=POLL_INTERVAL):
+    writer = SegmentWriter(directory, max_bytes)
+    conn = sqlite3.connect(database_path, timeout=30)
+    try:
+        while True:
+            moved = relay_once(conn, writer)
+            if moved:
+                logger.info("Relayed %d events (last offset %d)", moved, writer.last_offset)
+            elif once:
+                return writer.last_offset
+            else:
+                time.sleep(interval)
+    finally:
+        conn.close()
+
+
+# Consumers -----------------------------------------------------------------
+
+def read_events(directory, after=0):
+    """Yield the events in ``directory`` with an offset greater than ``after``, in order, each once."""
+    for first, path in _segments(directory):
+        if path.endswith('.gz'):
+            if int(os.path.basename(path).split('-')[2].split('.')[0]) <= after:
+                continue
+            opener = gzip.open
+        else:
+            opener = open
+        try:
+            with opener(path, 'rt', encoding='utf-8') as f:
+                for line in f:
+                    if not line.endswith('\n'):
+                        return  # still being written
+                    item = json.loads(line)
+                    # A sealed segment and the .jsonl it was made from can both be listed
+                    if item['offset'] > after:
+                        after = item['offset']
+                        yield item
+        except FileNotFoundError:
+            # Sealed while we were listing; the .gz holds the same events
+            continue
+
+
+def events_dir_for(app):
+    return app.config.get('OUTBOX_DIR') or os.path.join(app.instance_path, 'events')
+
+
+if __name__ == '__main__':
+    from app import get_app
+    from models import db
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Relay order and user events into segment files")
+    commands = parser.add_subparsers(dest='command', required=True)
+    relay_parser = commands.add_parser('relay')
+    relay_parser.add_argument('--once', action='store_true', help="exit when the outbox is empty")
+    relay_parser.add_argument('--interval', type=float, default=POLL_INTERVAL, help="seconds between polls")
+    commands.add_parser('seal')
+    tail_parser = commands.add_parser('tail')
+    tail_parser.add_argument('--after', type=int, default=0)
+    args = parser.parse_args()
+
+    app = get_app()
+    directory = events_dir_for(app)
+    if args.command == 'relay':
+        with app.app_context():
+            database = db.engine.url.database
+        run_relay(database, directory, app.config.get('OUTBOX_SEGMENT_BYTES', DEFAULT_SEGMENT_BYTES),
+                  args.once, args.interval)
+    elif args.command == 'seal':
+        print(SegmentWriter(directory).seal() or "Nothing to seal")
+    elif args.command == 'tail':
+        for item in read_events(directory, args.after):
+            print(json.dumps(item))
@@ -0,0 +1,354 @@
+"""Multi-process production server (Linux/Unix).
+
+Runs several waitress worker processes behind one listening socket so page
+rendering and password hashing can use every core instead of sharing one GIL.
+
+    python prefork_server.py --workers 4 --threads 4 --port 5000
+
+The supervisor process never touches the database or serves requests. It
+binds the socket, forks the workers (which inherit it; ``--reuse-port`` makes
+each worker bind its own SO_REUSEPORT socket instead) and watches them:
+
+- a worker that crashes is restarted, with a back-off if it keeps crashing
+- SIGHUP starts a rolling reload: one new worker is started and reported
+  ready before one old worker is drained, so capacity never drops
+- SIGTERM / SIGINT drain every worker (stop accepting, finish in-flight
+  requests) and exit; a second signal kills them immediately
+
+Workers import the application after the fork, so a reload picks up new
+code and no SQLite connection is ever shared between processes. Each worker
+warms up (see warmup.py) before it reports ready. SQLite runs
+in WAL mode with a busy timeout, so the workers' writes queue on the
+database lock instead of failing.
+
+The worker count defaults to ``$WEB_CONCURRENCY`` or the number of CPUs
+available to the process. On Windows use production_server.py instead.
+"""
+import argparse
+import logging
+import os
+import select
+import signal
+import socket
+import struct
+import sys
+import time
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(process)d - %(levelname)s - %(message)s',
+    handlers=[
+        logging.FileHandler("server.log"),
+        logging.StreamHandler()
+    ]
+)
+logger = logging.getLogger("fashion-store")
+
+_PID = struct.Struct('=i')
+
+
+def default_worker_count():
+    if os.environ.get('WEB_CONCURRENCY'):
+        return max(1, int(os.environ['WEB_CONCURRENCY']))
+    try:
+        return max(1, len(os.sched_getaffinity(0)))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def create_listen_socket(host, port, backlog, reuse_port=False):
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.setblocking(False)
+    return sock
+
+
+def prepare_database(options):
+    """Create or upgrade the schema; runs once in a short-lived child process."""
+    from app import create_app, db, upgrade_schema
+    app = create_app(options.env)
+    upgrade_schema(app)
+    with app.app_context():
+        db.engine.dispose()
+
+
+def run_worker(listen_sock, options, ready_fd):
+    """Body of a worker process: serve until drained, then return."""
+    from waitress import create_server, wasyncore
+    from app import create_app, db
+    import warmup
+
+    app = create_app(options.env)
+
+    draining = False
+
+    def start_drain(signum, frame):
+        nonlocal draining
+        draining = True
+        server.pull_trigger()
+
+    if listen_sock is None:
+        listen_sock = create_listen_socket(options.host, options.port, options.backlog, reuse_port=True)
+
+    server = create_server(app, sockets=[listen_sock], threads=options.threads,
+                           backlog=options.backlog, ident='fashion-store')
+    signal.signal(signal.SIGTERM, start_drain)
+    signal.signal(signal.SIGINT, start_drain)
+
+    # Only report ready once warm, so a reload never routes traffic to a cold worker
+    warmup.warm_up(app, connections=options.threads)
+
+    # Tell the supervisor we are accepting requests
+    os.write(ready_fd, _PID.pack(os.getpid()))
+    os.close(ready_fd)
+
+    deadline = None
+    while True:
+        wasyncore.loop(timeout=server.adj.asyncore_loop_timeout, map=server._map,
+                       use_poll=server.adj.asyncore_use_poll, count=1)
+        if not draining:
+            continue
+        if deadline is None:
+            # Stop accepting; the other workers keep serving the shared socket
+            wasyncore.dispatcher.close(server)
+            deadline = time.monotonic() + options.graceful_timeout
+        # Close keep-alive connections as soon as they have nothing in flight
+        for channel in list(server.active_channels.values()):
+            if not channel.requests:
+                channel.will_close = True
+        if not server.active_channels or time.monotonic() > deadline:
+            break
+
+    server.task_dispatcher.shutdown(timeout=options.graceful_timeout)
+    with app.app_context():
+        db.engine.dispose()
+
+
+class Supervisor:
+    def __init__(self, options):
+        self.options = options
+        self.listen_sock = None
+        self.workers = {}       # pid -> start time
+        self.ready = set()
+        self.retiring = set()   # pids we asked to drain
+        self.signals = []
+        self.crash_count = 0
+        self.restart_at = 0
+
+    # Setup -------------------------------------------------------------
+
+    def run(self):
+        self._run_in_child(prepare_database, self.options)
+        if not self.options.reuse_port:
+            self.listen_sock = create_listen_socket(self.options.host, self.options.port, self.options.backlog)
+            self.listen_sock.set_inheritable(True)
+
+        self.ready_r, self.ready_w = os.pipe()
+        os.set_blocking(self.ready_r, False)
+        self.wake_r, self.wake_w = os.pipe()
+        os.set_blocking(self.wake_r, False)
+        os.set_blocking(self.wake_w, False)
+        signal.set_wakeup_fd(self.wake_w)
+        for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, self._queue_signal)
+        # SIGCHLD only needs to wake the loop (via the wakeup fd) so it can reap
+        signal.signal(signal.SIGCHLD, self._ignore_signal)
+
+        logger.info(f"Supervisor {os.getpid()} listening on http://{self.options.host}:{self.options.port} "
+                    f"with {self.options.workers} workers x {self.options.threads} threads")
+        for _ in range(self.options.workers):
+            self.spawn_worker()
+
+        try:
+            self._main_loop()
+        finally:
+            signal.set_wakeup_fd(-1)
+            if self.listen_sock is not None:
+                self.listen_sock.close()
+        logger.info("Supervisor stopped")
+
+    def _run_in_child(self, func, *args):
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                func(*args)
+            except BaseException:
+                logger.exception(f"{func.__name__} failed")
+                code = 1
+            finally:
+                os._exit(code)
+        _, status = os.waitpid(pid, 0)
+        if os.waitstatus_to_exitcode(status) != 0:
+            raise SystemExit(f"{func.__name__} failed, not starting workers")
+
+    def _queue_signal(self, signum, frame):
+        self.signals.append(signum)
+
+    def _ignore_signal(self, signum, frame):
+        pass
+
+    # Workers -----------------------------------------------------------
+
+    def spawn_worker(self):
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT, signal.SIGCHLD):
+                    signal.signal(signum, signal.SIG_DFL)
+                signal.set_wakeup_fd(-1)
+                os.close(self.ready_r)
+                os.close(self.wake_r)
+                os.close(self.wake_w)
+                run_worker(self.listen_sock, self.options, self.ready_w)
+            except BaseException:
+                logger.exception("Worker failed")
+                code = 1
+            finally:
+                os._exit(code)
+        self.workers[pid] = time.monotonic()
+        logger.info(f"Started worker {pid}")
+        return pid
+
+    def _reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            started = self.workers.pop(pid, None)
+            self.ready.discard(pid)
+            if started is None:
+                continue
+            code = os.waitstatus_to_exitcode(status)
+            if pid in self.retiring:
+                self.retiring.discard(pid)
+                logger.info(f"Worker {pid} exited after draining")
+                continue
+            logger.warning(f"Worker {pid} died unexpectedly (exit code {code})")
+            # Back off if workers die right after starting
+            if time.monotonic() - started < 5:
+                self.crash_count += 1
+                self.restart_at = time.monotonic() + min(2 ** self.crash_count, 30)
+            else:
+                self.crash_count = 0
+
+    def _read_ready(self):
+        try:
+            data = os.read(self.ready_r, 4096)
+        except BlockingIOError:
+            return
+        for offset in range(0, len(data) - len(data) % _PID.size, _PID.size):
+            (pid,) = _PID.unpack_from(data, offset)
+            if pid in self.workers:
+                self.ready.add(pid)
+
+    def _wait(self, timeout):
+        try:
+            readable, _, _ = select.select([self.wake_r, self.ready_r], [], [], timeout)
+        except InterruptedError:
+            readable = []
+        if self.wake_r in readable:
+            try:
+                while os.read(self.wake_r, 4096):
+                    pass
+            except BlockingIOError:
+                pass
+        if self.ready_r in readable:
+            self._read_ready()
+        self._reap()
+
+    def _active_workers(self):
+        return [pid for pid in self.workers if pid not in self.retiring]
+
+    # Main loop ---------------------------------------------------------
+
+    def _main_loop(self):
+        while True:
+            self._wait(1.0)
+            while self.signals:
+                signum = self.signals.pop(0)
+                if signum == signal.SIGHUP:
+                    self.rolling_reload()
+                elif signum in (signal.SIGTERM, signal.SIGINT):
+                    self.stop()
+                    return
+            missing = self.options.workers - len(self._active_workers())
+            if missing > 0 and time.monotonic() >= self.restart_at:
+                for _ in range(missing):
+                    self.spawn_worker()
+
+    def rolling_reload(self):
+        logger.info("Rolling reload: replacing workers one at a time")
+        for old_pid in list(self._active_workers()):
+            new_pid = self.spawn_worker()
+            deadline = time.monotonic() + self.options.boot_timeout
+            while new_pid in self.workers and new_pid not in self.ready and time.monotonic() < deadline:
+                self._wait(0.2)
+            if new_pid not in self.ready:
+                logger.error(f"Worker {new_pid} did not become ready; aborting reload")
+                return
+            self._retire(old_pid)
+            deadline = time.monotonic() + self.options.graceful_timeout + 5
+            while old_pid in self.workers and time.monotonic() < deadline:
+                self._wait(0.2)
+            if any(signum in (signal.SIGTERM, signal.SIGINT) for signum in self.signals):
+                return
+        logger.info("Rolling reload finished")
+
+    def _retire(self, pid, signum=signal.SIGTERM):
+        self.retiring.add(pid)
+        try:
+            os.kill(pid, signum)
+        except ProcessLookupError:
+            pass
+
+    def stop(self):
+        logger.info("Draining workers")
+        for pid in list(self.workers):
+            self._retire(pid)
+        deadline = time.monotonic() + self.options.graceful_timeout + 5
+        while self.workers and time.monotonic() < deadline:
+            self._wait(0.2)
+            # A second SIGTERM/SIGINT means stop now
+            if self.signals:
+                break
+        for pid in list(self.workers):
+            logger.warning(f"Killing worker {pid}")
+            self._retire(pid, signal.SIGKILL)
+        while self.workers:
+            self._wait(0.2)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Fashion Store multi-process server")
+    parser.add_argument('--env', default=os.environ.get('FASHION_STORE_ENV', 'production'),
+                        help="configuration profile (see config.py)")
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--workers', type=int, default=default_worker_count(),
+                        help="number of worker processes (default: $WEB_CONCURRENCY or CPU count)")
+    parser.add_argument('--threads', type=int, default=4, help="waitress threads per worker")
+    parser.add_argument('--backlog', type=int, default=1024)
+    parser.add_argument('--reuse-port', action='store_true',
+                        help="give each worker its own SO_REUSEPORT socket instead of sharing one")
+    parser.add_argument('--graceful-timeout', type=float, default=30,
+                        help="seconds a draining worker may spend finishing requests")
+    parser.add_argument('--boot-timeout', type=float, default=60,
+                        help="seconds a new worker may take to become ready during a reload")
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    if not hasattr(os, 'fork'):
+        sys.exit("prefork_server.py needs a Unix system; use production_server.py on Windows")
+    Supervisor(parse_args()).run()
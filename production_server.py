@@ -1,5 +1,6 @@
 from waitress import serve
-from app import app, db, init_db
+from app import create_app, upgrade_schema
+import warmup
 import os
 import socket
 import logging
@@ -28,17 +29,14 @@ def get_local_ip():
         return "127.0.0.1"  # Fallback to localhost
 
 if __name__ == '__main__':
-    # Initialize the database if it doesn't exist
-    db_path = os.path.join(os.path.dirname(__file__), 'ecommerce.db')
-    initialize_db = not os.path.exists(db_path)
+    app = create_app(os.environ.get('FASHION_STORE_ENV', 'production'))
     
-    with app.app_context():
-        if initialize_db:
-            logger.info("Initializing database...")
-            db.create_all()
-            init_db()
-        else:
-            logger.info("Database already exists. Skipping initialization.")
+    # Create missing tables, indexes and columns, convert older data and load the sample products
+    logger.info("Preparing the database...")
+    upgrade_schema(app)
+    
+    # Compile templates, open connections and prime caches before taking traffic
+    warmup.warm_up(app)
     
     # Get the local IP address
     local_ip = get_local_ip()
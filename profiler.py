@@ -0,0 +1,444 @@
+"""On-demand request profiling and memory snapshots for admins.
+
+Off by default: unless PROFILER_ENABLED is set nothing is installed. When it
+is, each worker process only looks at a small plan file (``plan.json`` in
+PROFILER_DIR, by default ``instance/profiles``) from a background thread
+every WATCH_SECONDS. Requests go straight to the app until an admin arms the
+profiler; then the app's ``wsgi_app`` is swapped for a profiling wrapper,
+and swapped back as soon as the plan ends. Arming through one worker
+reaches the others through that file.
+
+What an admin can ask for (JSON at ``/admin/profiler``):
+
+* ``{"endpoint": "category", "fraction": 0.1, "max_requests": 20, "seconds": 600}``
+  profiles a random tenth of the requests to one endpoint, at most
+  ``max_requests`` per worker, for ``seconds``;
+* ``{"memory_interval": 60}`` starts ``tracemalloc`` in every worker and
+  writes, every interval, the allocation sites that grew the most since the
+  previous snapshot (for a worker whose memory keeps growing). Comparing
+  snapshots holds the GIL for about a second per few hundred thousand live
+  allocations, more with PROFILER_TRACE_FRAMES above 1, so keep the
+  interval long;
+* ``POST /admin/profiler/trigger`` returns a signed token that profiles
+  the one request sending it in the ``X-Profile-Token`` header within
+  TRIGGER_SECONDS, e.g. ``curl -H 'X-Profile-Token: <token>' <url>``.
+
+A profiled request leaves two files: ``.pstats`` from cProfile (``python -m
+pstats``, snakeviz) and ``.folded``, its stack sampled every
+PROFILER_SAMPLE_MS in collapsed form (flamegraph.pl, speedscope). Only the
+newest PROFILER_KEEP files are kept.
+"""
+from collections import Counter
+import cProfile
+from datetime import datetime
+import itertools
+import json
+import logging
+import os
+import random
+import re
+import sys
+import threading
+import time
+import tracemalloc
+import uuid
+
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+from werkzeug.exceptions import HTTPException
+from werkzeug.wsgi import ClosingIterator
+
+DEFAULT_KEEP = 200
+DEFAULT_SAMPLE_MS = 5
+DEFAULT_TRACE_FRAMES = 1
+DEFAULT_SECONDS = 600
+DEFAULT_MAX_REQUESTS = 20
+MAX_SECONDS = 24 * 60 * 60
+MIN_MEMORY_INTERVAL = 10
+WATCH_SECONDS = 2
+TRIGGER_SECONDS = 300
+TOP_ALLOCATIONS = 50
+TOP_TRACEBACKS = 5
+PLAN_FILE = 'plan.json'
+TRIGGERS_DIR = 'triggers'
+
+logger = logging.getLogger('fashion-store.profiler')
+
+_UNSAFE = re.compile(r'[^A-Za-z0-9]+')
+_MEMORY_FILTERS = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+    tracemalloc.Filter(False, '<unknown>'),
+)
+
+
+class ProfilerError(ValueError):
+    """A profiling plan is not valid; the message says why."""
+
+
+def _number(data, field, kind, default, minimum, maximum):
+    value = data.get(field, default)
+    try:
+        value = kind(value)
+    except (TypeError, ValueError):
+        raise ProfilerError(f'{field} must be a number') from None
+    if not minimum <= value <= maximum:
+        raise ProfilerError(f'{field} must be between {minimum} and {maximum}')
+    return value
+
+
+def parse_plan(data, endpoints, now=None):
+    """The plan for ``data`` (a dict from JSON); an empty dict disarms."""
+    unknown = set(data) - {'endpoint', 'fraction', 'max_requests', 'seconds', 'memory_interval'}
+    if unknown:
+        raise ProfilerError(f"unknown field {sorted(unknown)[0]!r}")
+    plan = {}
+    if data.get('endpoint') is not None:
+        if data['endpoint'] not in endpoints:
+            raise ProfilerError(f"unknown endpoint {data['endpoint']!r}")
+        plan['endpoint'] = data['endpoint']
+        plan['fraction'] = _number(data, 'fraction', float, 1.0, 0.0001, 1)
+        plan['max_requests'] = _number(data, 'max_requests', int, DEFAULT_MAX_REQUESTS, 1, 10000)
+    if data.get('memory_interval') is not None:
+        plan['memory_interval'] = _number(data, 'memory_interval', float, None, MIN_MEMORY_INTERVAL, MAX_SECONDS)
+    if plan:
+        plan['until'] = (now or time.time()) + _number(data, 'seconds', float, DEFAULT_SECONDS, 1, MAX_SECONDS)
+        plan['id'] = uuid.uuid4().hex
+    return plan
+
+
+def folded_stack(frame, stop_code=None):
+    """``frame``'s stack, outermost first, as one collapsed-stack line (without the count)."""
+    names = []
+    while frame is not None and frame.f_code is not stop_code:
+        code = frame.f_code
+        names.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+def _read_plan(path):
+    try:
+        with open(path) as f:
+            plan = json.load(f)
+    except FileNotFoundError:
+        return {}
+    except ValueError:
+        # Written with os.replace, so this is a hand-edited file: ignore it
+        logger.warning("Ignoring the unreadable profiling plan %s", path)
+        return {}
+    return plan if isinstance(plan, dict) else {}
+
+
+class Profiler:
+    """The profiler of one app in one process; see the module docstring."""
+
+    def __init__(self, app, directory, keep=DEFAULT_KEEP, sample_ms=DEFAULT_SAMPLE_MS,
+                 trace_frames=DEFAULT_TRACE_FRAMES):
+        self.app = app
+        self.directory = directory
+        self.keep = keep
+        self.sample_interval = sample_ms / 1000
+        self.trace_frames = trace_frames
+        self.plan = {}
+        self.profiled = 0  # requests sampled by this process under the current plan
+        self._plan_stamp = None
+        self._inner = None  # the wsgi_app we wrap (kept after disarming for requests already inside)
+        self._installed = False
+        self._serializer = URLSafeTimedSerializer(app.secret_key, salt='profiler-trigger')
+        self._active = {}  # thread id -> Counter of folded stacks, for requests being profiled
+        self._sampler = None
+        self._memory = None  # (thread, stop event, interval)
+        self._names = itertools.count()
+        self._lock = threading.Lock()
+
+    # Following the plan ---------------------------------------------------
+
+    def start(self):
+        threading.Thread(target=self._watch, name='profiler-watch', daemon=True).start()
+
+    def _watch(self):
+        while True:
+            try:
+                self.refresh()
+            except Exception:
+                logger.exception("Applying the profiling plan failed")
+            time.sleep(WATCH_SECONDS)
+
+    def refresh(self):
+        """Load the plan file if it changed and apply it; parts of the plan that ended are dropped."""
+        path = os.path.join(self.directory, PLAN_FILE)
+        try:
+            stat = os.stat(path)
+            stamp = (stat.st_ino, stat.st_mtime_ns)
+        except FileNotFoundError:
+            stamp = None
+        with self._lock:
+            if stamp != self._plan_stamp:
+                self._plan_stamp = stamp
+                plan = _read_plan(path) if stamp is not None else {}
+                if plan.get('id') != self.plan.get('id'):
+                    self.profiled = 0
+                self.plan = plan
+            self._apply()
+
+    def _apply(self):
+        plan, now = self.plan, time.time()
+        live = plan.get('until', 0) > now
+        sampling = live and 'endpoint' in plan and self.profiled < plan['max_requests']
+        wanted = sampling or plan.get('triggers_until', 0) > now
+        if wanted and not self._installed:
+            self._inner = self.app.wsgi_app
+            self.app.wsgi_app = self._wsgi
+            self._installed = True
+            logger.info("Request profiler armed in process %d", os.getpid())
+        elif not wanted and self._installed:
+            if self.app.wsgi_app == self._wsgi:
+                self.app.wsgi_app = self._inner
+            self._installed = False
+            logger.info("Request profiler disarmed in process %d", os.getpid())
+
+        interval = plan.get('memory_interval') if live else None
+        if self._memory is not None and self._memory[2] != interval:
+            self._memory[1].set()
+            self._memory = None
+        if interval and self._memory is None:
+            stop = threading.Event()
+            thread = threading.Thread(target=self._track_memory, args=(interval, stop),
+                                      name='profiler-memory', daemon=True)
+            self._memory = (thread, stop, interval)
+            thread.start()
+
+    def _write_plan(self, plan):
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, PLAN_FILE)
+        tmp = f'{path}.{os.getpid()}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(plan, f)
+        os.replace(tmp, path)
+        self.refresh()
+
+    def arm(self, data):
+        """Replace the sampling and memory plan with ``data`` in every worker; ``{}`` stops both."""
+        plan = parse_plan(data, self.app.view_functions)
+        triggers_until = self.plan.get('triggers_until')
+        if triggers_until and triggers_until > time.time():
+            plan['triggers_until'] = triggers_until
+        self._write_plan(plan)
+        return plan
+
+    def trigger(self):
+        """A signed token that profiles one request sending it in the X-Profile-Token header."""
+        self.refresh()
+        plan = dict(self.plan)
+        plan['triggers_until'] = max(plan.get('triggers_until', 0), time.time() + TRIGGER_SECONDS)
+        self._write_plan(plan)
+        return self._serializer.dumps(uuid.uuid4().hex)
+
+    def _redeem(self, token):
+        try:
+            nonce = self._serializer.loads(token, max_age=TRIGGER_SECONDS)
+        except BadSignature:
+            return False
+        directory = os.path.join(self.directory, TRIGGERS_DIR)
+        os.makedirs(directory, exist_ok=True)
+        # Creating the marker is atomic, so a token works once across every worker
+        try:
+            os.close(os.open(os.path.join(directory, _UNSAFE.sub('', nonce)), os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except FileExistsError:
+            return False
+        return True
+
+    # Profiling requests ---------------------------------------------------
+
+    def _wsgi(self, environ, start_response):
+        token = environ.get('HTTP_X_PROFILE_TOKEN')
+        if token is not None:
+            if self._redeem(token):
+                return self._profile(environ, start_response)
+        elif self._sampled(environ):
+            return self._profile(environ, start_response)
+        return self._inner(environ, start_response)
+
+    def _sampled(self, environ):
+        plan = self.plan
+        if 'endpoint' not in plan or plan['until'] <= time.time() or random.random() >= plan['fraction']:
+            return False
+        try:
+            endpoint, _ = self.app.url_map.bind_to_environ(environ).match()
+        except HTTPException:
+            return False
+        if endpoint != plan['endpoint']:
+            return False
+        with self._lock:
+            if self.profiled >= plan['max_requests']:
+                return False
+            self.profiled += 1
+            return True
+
+    def _profile(self, environ, start_response):
+        thread_id = threading.get_ident()
+        stacks = Counter()
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except (ValueError, RuntimeError):
+            # Another profiler is active (Python 3.12+ allows one per process); the stack samples still work
+            profile = None
+        self._track(thread_id, stacks)
+        started = time.perf_counter()
+
+        def finish():
+            if profile is not None:
+                profile.disable()
+            self._untrack(thread_id)
+            try:
+                self._save(environ, profile, dict(stacks), time.perf_counter() - started)
+            except Exception:
+                logger.exception("Saving a request profile failed")
+            with self._lock:
+                self._apply()
+
+        try:
+            result = self._inner(environ, start_response)
+        except BaseException:
+            finish()
+            raise
+        # The body may still be generated while it is sent (streamed responses)
+        return ClosingIterator(result, finish)
+
+    def _track(self, thread_id, stacks):
+        with self._lock:
+            self._active[thread_id] = stacks
+            if self._sampler is None:
+                self._sampler = threading.Thread(target=self._sample, name='profiler-sampler', daemon=True)
+                self._sampler.start()
+
+    def _untrack(self, thread_id):
+        with self._lock:
+            self._active.pop(thread_id, None)
+
+    def _sample(self):
+        stop_code = Profiler._profile.__code__
+        while True:
+            with self._lock:
+                if not self._active:
+                    self._sampler = None
+                    return
+                active = list(self._active.items())
+            frames = sys._current_frames()
+            for thread_id, stacks in active:
+                frame = frames.get(thread_id)
+                if frame is not None:
+                    stacks[folded_stack(frame, stop_code)] += 1
+            del frames
+            time.sleep(self.sample_interval)
+
+    def _name(self, label):
+        return os.path.join(self.directory, f"{datetime.now():%Y%m%d-%H%M%S}-{os.getpid()}-{next(self._names)}-{label}")
+
+    def _save(self, environ, profile, stacks, elapsed):
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._name(_UNSAFE.sub('_', environ.get('PATH_INFO', '')).strip('_')[:60] or 'root')
+        if profile is not None:
+            profile.dump_stats(path + '.pstats')
+        with open(path + '.folded', 'w') as f:
+            for stack, count in sorted(stacks.items(), key=lambda item: -item[1]):
+                f.write(f'{stack} {count}\n')
+        logger.info("Profiled %s %s (%.1f ms) to %s", environ.get('REQUEST_METHOD'), environ.get('PATH_INFO'),
+                    elapsed * 1000, os.path.basename(path))
+        self.rotate()
+
+    # Memory ---------------------------------------------------------------
+
+    def _track_memory(self, interval, stop):
+        started = not tracemalloc.is_tracing()
+        if started:
+            tracemalloc.start(self.trace_frames)
+        try:
+            previous = tracemalloc.take_snapshot().filter_traces(_MEMORY_FILTERS)
+            while not stop.wait(interval):
+                current = tracemalloc.take_snapshot().filter_traces(_MEMORY_FILTERS)
+                try:
+                    self._save_memory(current, previous, interval)
+                except Exception:
+                    logger.exception("Saving a memory snapshot diff failed")
+                previous = current
+        finally:
+            if started:
+                tracemalloc.stop()
+
+    def _save_memory(self, current, previous, interval):
+        os.makedirs(self.directory, exist_ok=True)
+        traced, peak = tracemalloc.get_traced_memory()
+        # One grouping pass: it is pure Python over every live allocation
+        key = 'traceback' if tracemalloc.get_traceback_limit() > 1 else 'lineno'
+        stats = current.compare_to(previous, key)
+        lines = [f'Process {os.getpid()}, {datetime.now():%Y-%m-%d %H:%M:%S}: traced {traced / 2**20:.1f} MiB '
+                 f'(peak {peak / 2**20:.1f} MiB), growth over the last {interval:g}s by {key}:', '']
+        lines += [str(stat) for stat in stats[:TOP_ALLOCATIONS]]
+        if key == 'traceback':
+            for stat in stats[:TOP_TRACEBACKS]:
+                lines += ['', f'{stat.size_diff / 1024:+.1f} KiB, {stat.count_diff:+d} blocks']
+                lines += stat.traceback.format()
+        with open(self._name('memory') + '.txt', 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        self.rotate()
+
+    # Files ----------------------------------------------------------------
+
+    def files(self):
+        """The profiles and memory diffs written, newest first."""
+        try:
+            entries = [entry for entry in os.scandir(self.directory)
+                       if entry.is_file() and entry.name != PLAN_FILE and not entry.name.endswith('.tmp')]
+        except FileNotFoundError:
+            return []
+        found = [(entry.stat().st_mtime, entry.name, entry.stat().st_size) for entry in entries]
+        return [{'name': name, 'bytes': size, 'modified': datetime.fromtimestamp(mtime).isoformat(timespec='seconds')}
+                for mtime, name, size in sorted(found, reverse=True)]
+
+    def rotate(self):
+        """Delete all but the newest ``keep`` files, and trigger markers past their token's lifetime."""
+        for entry in self.files()[self.keep:] if self.keep > 0 else []:
+            try:
+                os.remove(os.path.join(self.directory, entry['name']))
+            except FileNotFoundError:
+                pass
+        triggers = os.path.join(self.directory, TRIGGERS_DIR)
+        if os.path.isdir(triggers):
+            expired = time.time() - TRIGGER_SECONDS
+            for entry in os.scandir(triggers):
+                if entry.stat().st_mtime < expired:
+                    try:
+                        os.remove(entry.path)
+                    except FileNotFoundError:
+                        pass
+
+    def status(self):
+        self.refresh()
+        plan = dict(self.plan)
+        for field in ('until', 'triggers_until'):
+            if field in plan:
+                plan[field] = datetime.fromtimestamp(plan[field]).isoformat(timespec='seconds')
+        return {
+            'enabled': True,
+            'plan': plan,
+            'process': {'pid': os.getpid(), 'armed': self._installed, 'profiled': self.profiled,
+                        'tracing_memory': self._memory is not None},
+            'files': self.files(),
+        }
+
+
+def init_app(app):
+    """Set up the profiler of ``app`` if PROFILER_ENABLED; nothing is wrapped until an admin arms it."""
+    if not app.config.get('PROFILER_ENABLED'):
+        return None
+    profiler = app.extensions['profiler'] = Profiler(
+        app,
+        app.config.get('PROFILER_DIR') or os.path.join(app.instance_path, 'profiles'),
+        app.config.get('PROFILER_KEEP', DEFAULT_KEEP),
+        app.config.get('PROFILER_SAMPLE_MS', DEFAULT_SAMPLE_MS),
+        app.config.get('PROFILER_TRACE_FRAMES', DEFAULT_TRACE_FRAMES),
+    )
+    profiler.start()
+    return profiler
@@ -0,0 +1,357 @@
+"""Promotions: automatic discounts, coupons and buy-X-get-Y deals.
+
+Each Promotion row is one rule with:
+
+* a kind: a whole ``percent`` off, an amount off each unit (off the order
+  for cart-wide rules, ``amount_cents``), or ``buy_x_get_y``, where every
+  ``buy_quantity`` units of a product earn ``get_quantity`` more for free;
+* a scope: one product, one category, or (neither set) the whole cart;
+* optional conditions: a coupon code the customer must enter, a minimum
+  cart subtotal (before any discount), and a start and end time.
+
+A cart never walks the rule list. The active rules are compiled into dicts
+keyed by product id and by category (each also keyed by coupon code, or
+None for automatic rules), and rules that another rule in their entry
+always beats are dropped. Pricing is then one pass over the cart lines, and
+each line only looks at the few rules that can apply to it:
+
+* each line gets the single best product or category rule (line rules
+  don't stack);
+* the single best cart-wide rule is then taken off the discounted subtotal.
+
+The compiled set is cached per process under a version and recompiled when
+a Promotion change commits in this process, when another process changed the
+table (its row count and latest ``updated_at`` are checked every
+PROMOTIONS_CHECK_SECONDS), or when a rule starts or ends.
+
+Every amount is in integer cents (see money.py); a percent discount is
+rounded half up to the cent once per line.
+
+Measure with ``python bench_promotions.py``.
+"""
+from collections import namedtuple
+from datetime import datetime
+import threading
+import time
+
+from flask import current_app
+from sqlalchemy import event, func, select
+from sqlalchemy.orm import Session
+
+from models import db, Promotion
+
+DEFAULT_CHECK_SECONDS = 5
+KINDS = ('percent', 'amount', 'buy_x_get_y')
+MAX_CODE_LENGTH = 40
+# Upper bounds for the number fields, well inside SQLite's 64-bit integers
+MAX_AMOUNT_CENTS = 100_000_000
+MAX_QUANTITY = 999
+MAX_ID = 2 ** 63 - 1
+
+# value: the percent, or the amount in cents
+Rule = namedtuple('Rule', 'id name kind value buy get min_subtotal_cents')
+PricedCart = namedtuple('PricedCart', 'items subtotal_cents discount_cents total_cents promotions coupon')
+
+_local_version = 0
+
+
+class PromotionError(ValueError):
+    """A promotion's fields are not valid; the message says why."""
+
+
+def normalize_code(code):
+    code = (code or '').strip().upper()
+    return code or None
+
+
+def _percent_of(cents, percent):
+    return (cents * percent + 50) // 100
+
+
+def line_discount(rule, price_cents, quantity):
+    """Cents ``rule`` takes off a line of ``quantity`` units at ``price_cents``."""
+    if rule.kind == 'percent':
+        return _percent_of(price_cents * quantity, rule.value)
+    if rule.kind == 'amount':
+        return min(rule.value, price_cents) * quantity
+    return quantity // (rule.buy + rule.get) * rule.get * price_cents
+
+
+def cart_discount(rule, subtotal_cents):
+    """Cents a cart-wide ``rule`` takes off ``subtotal_cents``."""
+    if rule.kind == 'percent':
+        return _percent_of(subtotal_cents, rule.value)
+    return min(rule.value, subtotal_cents)
+
+
+class RuleSet:
+    """Active rules as lookup tables; see the module docstring."""
+
+    def __init__(self, version=None, valid_until=None):
+        self.version = version
+        self.valid_until = valid_until  # next time a rule starts or ends
+        self.by_product = {}  # (coupon, product id) -> rules
+        self.by_category = {}  # (coupon, category) -> rules
+        self.cart = {}  # coupon -> rules
+        self.coupons = set()
+
+    def __len__(self):
+        return sum(len(rules) for table in (self.by_product, self.by_category, self.cart)
+                   for rules in table.values())
+
+    def _best(self, rules, discount, *args):
+        best, best_rule = 0, None
+        for rule in rules:
+            amount = discount(rule, *args)
+            if amount > best:
+                best, best_rule = amount, rule
+        return best, best_rule
+
+    def apply(self, items, coupon=None):
+        """Price ``items`` (dicts with id, category, price_cents and quantity) as a PricedCart.
+
+        Sets ``discount_cents``, ``promotion`` and the discounted
+        ``item_total_cents`` on every item. An unknown or expired coupon is
+        ignored.
+        """
+        coupon = normalize_code(coupon)
+        if coupon not in self.coupons:
+            coupon = None
+        subtotal = sum(item['price_cents'] * item['quantity'] for item in items)
+        by_product, by_category = self.by_product, self.by_category
+        applied = []
+        line_discounts = 0
+        for item in items:
+            rules = by_product.get((None, item['id']), ()) + by_category.get((None, item['category']), ())
+            if coupon is not None:
+                rules += by_product.get((coupon, item['id']), ()) + by_category.get((coupon, item['category']), ())
+            best, rule = self._best([rule for rule in rules if rule.min_subtotal_cents <= subtotal],
+                                    line_discount, item['price_cents'], item['quantity'])
+            item['discount_cents'] = best
+            item['promotion'] = rule.name if rule else None
+            item['item_total_cents'] = item['price_cents'] * item['quantity'] - best
+            line_discounts += best
+            if rule and rule.name not in applied:
+                applied.append(rule.name)
+
+        remaining = subtotal - line_discounts
+        rules = self.cart.get(None, ()) + (self.cart.get(coupon, ()) if coupon is not None else ())
+        best, rule = self._best([rule for rule in rules if rule.min_subtotal_cents <= subtotal],
+                                cart_discount, remaining)
+        if rule:
+            applied.append(rule.name)
+        total = remaining - best
+        return PricedCart(items, subtotal, subtotal - total, total, applied, coupon)
+
+
+def _frontier(rules):
+    """The rules of a group that can ever give the best discount.
+
+    A rule is dropped when another rule of the same kind gives at least as
+    much (a higher or equal percent or amount, or the same buy_x_get_y deal)
+    with a lower or equal minimum subtotal.
+    """
+    groups = {}
+    for rule in rules:
+        groups.setdefault((rule.kind, rule.buy, rule.get), []).append(rule)
+    kept = []
+    for group in groups.values():
+        best = None
+        for rule in sorted(group, key=lambda rule: (rule.min_subtotal_cents, -rule.value, rule.id)):
+            if best is None or rule.value > best:
+                kept.append(rule)
+                best = rule.value
+    return tuple(kept)
+
+
+def compile_rules(promotions, now=None, version=None):
+    """A RuleSet of the ``promotions`` (Promotion rows or alike) active at ``now``."""
+    now = now or datetime.utcnow()
+    rules = RuleSet(version)
+    for promotion in promotions:
+        if not promotion.active:
+            continue
+        for moment in (promotion.starts_at, promotion.ends_at):
+            if moment is not None and moment > now and (rules.valid_until is None or moment < rules.valid_until):
+                rules.valid_until = moment
+        if (promotion.starts_at is not None and promotion.starts_at > now) \
+                or (promotion.ends_at is not None and promotion.ends_at <= now):
+            continue
+        value = promotion.percent if promotion.kind == 'percent' else promotion.amount_cents
+        rule = Rule(promotion.id, promotion.name, promotion.kind, value or 0,
+                    promotion.buy_quantity, promotion.get_quantity, promotion.min_subtotal_cents or 0)
+        code = normalize_code(promotion.coupon_code)
+        if code is not None:
+            rules.coupons.add(code)
+        if promotion.product_id is not None:
+            table, key = rules.by_product, (code, promotion.product_id)
+        elif promotion.category:
+            table, key = rules.by_category, (code, promotion.category)
+        else:
+            table, key = rules.cart, code
+        table.setdefault(key, []).append(rule)
+    # Tuples, so a line's candidates are joined with one + and the set is read-only once shared
+    for table in (rules.by_product, rules.by_category, rules.cart):
+        for key, found in table.items():
+            table[key] = _frontier(found)
+    return rules
+
+
+class PromotionEngine:
+    """The compiled rules of one app, cached under a version."""
+
+    def __init__(self, check_seconds=DEFAULT_CHECK_SECONDS):
+        self.check_seconds = check_seconds
+        self.compiled = 0
+        self._rules = None
+        self._checked = float('-inf')
+        self._lock = threading.Lock()
+
+    def _fresh(self, rules):
+        return (rules is not None and rules.version[0] == _local_version
+                and time.monotonic() - self._checked < self.check_seconds
+                and (rules.valid_until is None or datetime.utcnow() < rules.valid_until))
+
+    def rules(self):
+        """The current RuleSet (inside an app context)."""
+        rules = self._rules
+        if self._fresh(rules):
+            return rules
+        with self._lock:
+            rules = self._rules
+            if self._fresh(rules):
+                return rules
+            local_version = _local_version
+            count, updated = db.session.execute(select(func.count(), func.max(Promotion.updated_at))).one()
+            version = (local_version, count, updated)
+            self._checked = time.monotonic()
+            if rules is None or rules.version != version \
+                    or (rules.valid_until is not None and datetime.utcnow() >= rules.valid_until):
+                rules = self._rules = compile_rules(Promotion.query.filter_by(active=True).all(), version=version)
+                self.compiled += 1
+        return rules
+
+
+def get_engine(app):
+    engine = app.extensions.get('promotions')
+    if engine is None:
+        engine = app.extensions['promotions'] = PromotionEngine(
+            app.config.get('PROMOTIONS_CHECK_SECONDS', DEFAULT_CHECK_SECONDS))
+    return engine
+
+
+def current_rules():
+    return get_engine(current_app).rules()
+
+
+# Editing ---------------------------------------------------------------------
+
+FIELDS = ('name', 'kind', 'percent', 'amount_cents', 'buy_quantity', 'get_quantity', 'product_id', 'category',
+          'coupon_code', 'min_subtotal_cents', 'starts_at', 'ends_at', 'active')
+
+
+def _number(data, field, minimum=0, maximum=MAX_AMOUNT_CENTS):
+    value = data.get(field)
+    if value is None or value == '':
+        return None
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    try:
+        # Whole numbers only: 12.5 percent or 99.5 cents is refused rather than truncated
+        if isinstance(value, (bool, float)):
+            raise ValueError(value)
+        value = int(value)
+    except (TypeError, ValueError):
+        raise PromotionError(f'{field} must be a whole number') from None
+    if value < minimum:
+        raise PromotionError(f'{field} must be at least {minimum}')
+    if value > maximum:
+        raise PromotionError(f'{field} must be at most {maximum}')
+    return value
+
+
+def _moment(data, field):
+    value = data.get(field)
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        raise PromotionError(f'{field} must be an ISO date and time') from None
+
+
+def update_promotion(promotion, data):
+    """Set the fields given in ``data`` (a dict from JSON) on ``promotion``, validating the result."""
+    unknown = set(data) - set(FIELDS)
+    if unknown:
+        raise PromotionError(f"unknown field {sorted(unknown)[0]!r}")
+    if 'name' in data:
+        promotion.name = (data['name'] or '').strip()
+    if 'kind' in data:
+        promotion.kind = data['kind']
+    for field, minimum, maximum in (('percent', 0, 100), ('amount_cents', 0, MAX_AMOUNT_CENTS),
+                                    ('min_subtotal_cents', 0, MAX_AMOUNT_CENTS), ('buy_quantity', 1, MAX_QUANTITY),
+                                    ('get_quantity', 1, MAX_QUANTITY), ('product_id', 1, MAX_ID)):
+        if field in data:
+            setattr(promotion, field, _number(data, field, minimum, maximum))
+    if 'category' in data:
+        # Product categories are lower case ('men') and matched exactly
+        promotion.category = (data['category'] or '').strip().lower() or None
+    if 'coupon_code' in data:
+        promotion.coupon_code = normalize_code(data['coupon_code'])
+    for field in ('starts_at', 'ends_at'):
+        if field in data:
+            setattr(promotion, field, _moment(data, field))
+    if 'active' in data:
+        # bool('false') is True: only real JSON booleans, so "ending" a promotion can't leave it running
+        if not isinstance(data['active'], bool):
+            raise PromotionError('active must be true or false')
+        promotion.active = data['active']
+
+    if not promotion.name:
+        raise PromotionError('name is required')
+    if promotion.kind not in KINDS:
+        raise PromotionError(f"kind must be one of {', '.join(KINDS)}")
+    if promotion.kind == 'percent' and not 0 < (promotion.percent or 0) <= 100:
+        raise PromotionError('percent must be more than 0 and at most 100')
+    if promotion.kind == 'amount' and not promotion.amount_cents:
+        raise PromotionError('amount_cents must be more than 0')
+    if promotion.kind == 'buy_x_get_y':
+        if not promotion.buy_quantity or not promotion.get_quantity:
+            raise PromotionError('buy_x_get_y needs buy_quantity and get_quantity')
+        if promotion.product_id is None and not promotion.category:
+            raise PromotionError('buy_x_get_y needs a product_id or a category')
+    if promotion.product_id is not None and promotion.category:
+        raise PromotionError('give a product_id or a category, not both')
+    if promotion.coupon_code and len(promotion.coupon_code) > MAX_CODE_LENGTH:
+        raise PromotionError(f'coupon_code must be at most {MAX_CODE_LENGTH} characters')
+    if promotion.starts_at and promotion.ends_at and promotion.ends_at <= promotion.starts_at:
+        raise PromotionError('ends_at must be after starts_at')
+    return promotion
+
+
+def as_dict(promotion):
+    data = {field: getattr(promotion, field) for field in ('id',) + FIELDS}
+    for field in ('starts_at', 'ends_at'):
+        if data[field] is not None:
+            data[field] = data[field].isoformat()
+    return data
+
+
+# Recompile once a transaction that changed promotions commits
+@event.listens_for(Session, 'after_flush')
+def _remember_promotion_change(session, flush_context):
+    if any(isinstance(obj, Promotion) for obj in list(session.new) + list(session.dirty) + list(session.deleted)):
+        session.info['promotions_changed'] = True
+
+
+@event.listens_for(Session, 'after_commit')
+def _bump_after_commit(session):
+    global _local_version
+    if session.info.pop('promotions_changed', False):
+        _local_version += 1
+
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_promotion_change(session):
+    session.info.pop('promotions_changed', None)
@@ -0,0 +1,71 @@
+"""In-process token-bucket rate limiting.
+
+Each key (a phone number, an IP address, ...) gets a bucket that refills at a
+fixed rate up to its capacity. Buckets live in a plain dict guarded by a lock;
+idle buckets that have refilled completely carry no information and are
+swept away so the table stays small.
+"""
+import threading
+import time
+
+
+class RateLimiter:
+    """Token buckets keyed by an arbitrary hashable key.
+
+    ``capacity`` is the burst size and ``per_seconds`` the time it takes an
+    empty bucket to refill completely.
+    """
+
+    def __init__(self, capacity, per_seconds, sweep_every=1024):
+        self.capacity = float(capacity)
+        self.rate = self.capacity / float(per_seconds)
+        self.sweep_every = sweep_every
+        self._buckets = {}  # key -> [tokens, last_refill]
+        self._lock = threading.Lock()
+        self._calls = 0
+
+    def hit(self, key, cost=1, now=None):
+        """Take ``cost`` tokens from ``key``'s bucket.
+
+        Returns ``(allowed, retry_after)`` where ``retry_after`` is the number
+        of seconds until the request would be allowed (0 when allowed).
+        """
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = [self.capacity, now]
+            else:
+                bucket[0] = min(self.capacity, bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+
+            self._calls += 1
+            if self._calls >= self.sweep_every:
+                self._calls = 0
+                self._sweep_locked(now)
+
+            if bucket[0] >= cost:
+                bucket[0] -= cost
+                return True, 0
+            return False, (cost - bucket[0]) / self.rate
+
+    def reset(self, key):
+        with self._lock:
+            self._buckets.pop(key, None)
+
+    def sweep(self, now=None):
+        """Drop buckets that have refilled completely; returns how many."""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            return self._sweep_locked(now)
+
+    def _sweep_locked(self, now):
+        full_after = self.capacity / self.rate
+        idle = [key for key, (tokens, last) in self._buckets.items()
+                if now - last >= full_after]
+        for key in idle:
+            del self._buckets[key]
+        return len(idle)
+
+    def __len__(self):
+        return len(self._buckets)
@@ -0,0 +1,276 @@
+"""Recommendations for products that are frequently bought together.
+
+An offline job streams every order (hot and archived), counts how often each
+pair of products appears in the same order and keeps, for every product, its
+``top_k`` most frequent companions. Counting is done with NumPy on whole
+chunks of orders: each chunk becomes one array of (product, product) pair
+codes that is reduced with ``np.unique`` and merged into the running sparse
+co-occurrence counts.
+
+The result is written to a single ``topk.npy`` file (one int32 row per
+product: its id, ``top_k`` neighbour ids, ``top_k`` counts) that web
+processes memory-map, so suggestions are served from memory with no SQL.
+The job keeps its counts and a watermark (the last order id it saw) in
+``cooccurrence.npz``, so later runs only read new orders:
+
+    python recommendations.py            # incremental update
+    python recommendations.py --full     # rebuild from scratch
+"""
+import argparse
+from collections import namedtuple
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+DEFAULT_TOP_K = 20
+CHUNK_SIZE = 5000
+RELOAD_CHECK_SECONDS = 30
+CATALOG_TTL_SECONDS = 300
+
+SuggestedProduct = namedtuple('SuggestedProduct', 'id name price_cents image_url category')
+
+
+def recommendations_dir(app):
+    return app.config.get('RECOMMENDATIONS_DIR') or os.path.join(app.instance_path, 'recommendations')
+
+
+# Building ------------------------------------------------------------------
+
+def _stream_orders(conn, after_id, chunk_size):
+    """Yield lists of (order id, [product ids]) in id order, hot and archived."""
+    tables = ['main."order"']
+    if conn.execute("SELECT 1 FROM pragma_database_list WHERE name = 'archive'").fetchone():
+        tables.append('archive."order"')
+    query = ' UNION ALL '.join(f'SELECT id, order_items FROM {table} WHERE id > ?' for table in tables)
+    cursor = conn.execute(f'{query} ORDER BY id', (after_id,) * len(tables))
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            return
+        chunk = []
+        for order_id, order_items in rows:
+            try:
+                items = json.loads(order_items)
+                chunk.append((order_id, [int(item['id']) for item in items]))
+            except (ValueError, TypeError, KeyError):
+                chunk.append((order_id, []))
+        yield chunk
+
+
+def _chunk_pair_codes(orders, index_of, index_ids):
+    """Pair codes (left << 32 | right) for every ordered pair of distinct products per order."""
+    items = []
+    lengths = []
+    for _, product_ids in orders:
+        distinct = []
+        for product_id in set(product_ids):
+            index = index_of.get(product_id)
+            if index is None:
+                index = index_of[product_id] = len(index_ids)
+                index_ids.append(product_id)
+            distinct.append(index)
+        if len(distinct) > 1:
+            items.extend(distinct)
+            lengths.append(len(distinct))
+    if not lengths:
+        return np.empty(0, dtype=np.int64)
+
+    items = np.asarray(items, dtype=np.int64)
+    lengths = np.asarray(lengths, dtype=np.int64)
+    starts = np.cumsum(lengths) - lengths
+    # Every item is paired with every item of its own order
+    item_start = np.repeat(starts, lengths)
+    item_len = np.repeat(lengths, lengths)
+    left = np.repeat(items, item_len)
+    block_start = np.repeat(item_start, item_len)
+    offset_in_block = np.arange(left.size) - np.repeat(np.cumsum(item_len) - item_len, item_len)
+    right = items[block_start + offset_in_block]
+    keep = left != right
+    return (left[keep] << 32) | right[keep]
+
+
+def _merge(codes, counts, new_codes):
+    if new_codes.size == 0:
+        return codes, counts
+    new_codes, new_counts = np.unique(new_codes, return_counts=True)
+    merged, inverse = np.unique(np.concatenate([codes, new_codes]), return_inverse=True)
+    merged_counts = np.bincount(inverse, weights=np.concatenate([counts, new_counts]),
+                                minlength=merged.size).astype(np.int64)
+    return merged, merged_counts
+
+
+def _top_k_table(codes, counts, index_ids, top_k):
+    """int32 array of rows [product id, neighbour ids..., counts...] sorted by product id."""
+    rows = (codes >> 32).astype(np.int64)
+    cols = (codes & 0xFFFFFFFF).astype(np.int64)
+    order = np.lexsort((-counts, rows))
+    rows, cols, counts = rows[order], cols[order], counts[order]
+    rank = np.arange(rows.size) - np.searchsorted(rows, rows, side='left')
+    keep = rank < top_k
+    rows, cols, counts, rank = rows[keep], cols[keep], counts[keep], rank[keep]
+
+    ids = np.asarray(index_ids, dtype=np.int64)
+    present = np.unique(rows)
+    table = np.full((present.size, 1 + 2 * top_k), -1, dtype=np.int32)
+    table[:, 1 + top_k:] = 0
+    position = np.searchsorted(present, rows)
+    table[:, 0] = ids[present]
+    table[position, 1 + rank] = ids[cols]
+    table[position, 1 + top_k + rank] = np.minimum(counts, np.iinfo(np.int32).max)
+    return table[np.argsort(table[:, 0], kind='stable')]
+
+
+def _save_atomically(path, save):
+    tmp = f'{path}.tmp-{os.getpid()}'
+    with open(tmp, 'wb') as f:
+        save(f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def build(database_path, output_dir, top_k=DEFAULT_TOP_K, full=False, archive_path=None,
+          chunk_size=CHUNK_SIZE):
+    """Update (or with ``full`` rebuild) the co-occurrence counts and top-k file."""
+    os.makedirs(output_dir, exist_ok=True)
+    state_path = os.path.join(output_dir, 'cooccurrence.npz')
+
+    codes = np.empty(0, dtype=np.int64)
+    counts = np.empty(0, dtype=np.int64)
+    index_ids = []
+    watermark = 0
+    if not full and os.path.exists(state_path):
+        with np.load(state_path) as state:
+            codes, counts = state['codes'], state['counts']
+            index_ids = state['index_ids'].tolist()
+            watermark = int(state['watermark'])
+    index_of = {product_id: index for index, product_id in enumerate(index_ids)}
+
+    conn = sqlite3.connect(f'file:{database_path}?mode=ro', uri=True, timeout=30)
+    orders_seen = 0
+    try:
+        if archive_path and os.path.exists(archive_path):
+            conn.execute("ATTACH DATABASE ? AS archive", (f'file:{archive_path}?mode=ro',))
+        for chunk in _stream_orders(conn, watermark, chunk_size):
+            codes, counts = _merge(codes, counts, _chunk_pair_codes(chunk, index_of, index_ids))
+            watermark = chunk[-1][0]
+            orders_seen += len(chunk)
+    finally:
+        conn.close()
+
+    table = _top_k_table(codes, counts, index_ids, top_k)
+    _save_atomically(state_path, lambda f: np.savez(
+        f, codes=codes, counts=counts, index_ids=np.asarray(index_ids, dtype=np.int64),
+        watermark=np.int64(watermark)))
+    _save_atomically(os.path.join(output_dir, 'topk.npy'), lambda f: np.save(f, table))
+    return orders_seen, table.shape[0]
+
+
+# Serving -------------------------------------------------------------------
+
+class Recommender:
+    """Serves suggestions from a memory-mapped topk.npy, reloading it when it changes.
+
+    ``load_catalog`` returns ``{product id: SuggestedProduct}``; it is called
+    when the file changes or every CATALOG_TTL_SECONDS, never per request.
+    """
+
+    def __init__(self, directory, load_catalog=None):
+        self.path = os.path.join(directory, 'topk.npy')
+        self.load_catalog = load_catalog
+        self._table = None
+        self._ids = None
+        self._mtime = None
+        self._checked = float('-inf')
+        self._catalog = {}
+        self._catalog_loaded = float('-inf')
+        self._lock = threading.Lock()
+
+    def _current(self):
+        now = time.monotonic()
+        if now - self._checked >= RELOAD_CHECK_SECONDS:
+            with self._lock:
+                self._checked = now
+                try:
+                    mtime = os.stat(self.path).st_mtime_ns
+                except FileNotFoundError:
+                    self._table = self._ids = self._mtime = None
+                else:
+                    if mtime != self._mtime:
+                        table = np.load(self.path, mmap_mode='r')
+                        self._ids = np.ascontiguousarray(table[:, 0])
+                        self._table, self._mtime = table, mtime
+                        self._catalog_loaded = float('-inf')
+        return self._table, self._ids
+
+    def also_bought(self, product_ids, limit=4, exclude=()):
+        """Product ids most often bought with ``product_ids``, best first."""
+        table, ids = self._current()
+        if table is None or not len(product_ids):
+            return []
+        seeds = np.asarray(sorted({int(product_id) for product_id in product_ids}), dtype=np.int32)
+        positions = np.searchsorted(ids, seeds)
+        positions = positions[positions < ids.size]
+        positions = positions[np.isin(ids[positions], seeds)]
+        if positions.size == 0:
+            return []
+        top_k = (table.shape[1] - 1) // 2
+        neighbours = np.asarray(table[positions, 1:1 + top_k]).ravel()
+        scores = np.asarray(table[positions, 1 + top_k:]).ravel()
+        valid = neighbours >= 0
+        candidates, inverse = np.unique(neighbours[valid], return_inverse=True)
+        totals = np.bincount(inverse, weights=scores[valid])
+        skip = np.isin(candidates, np.asarray(list(set(exclude) | set(seeds.tolist())), dtype=np.int32))
+        candidates, totals = candidates[~skip], totals[~skip]
+        best = np.argsort(-totals, kind='stable')[:limit]
+        return candidates[best].tolist()
+
+    def also_bought_products(self, product_ids, limit=4, exclude=()):
+        """Like also_bought() but returns SuggestedProduct rows for products still in the catalog."""
+        suggested = self.also_bought(product_ids, limit + len(exclude), exclude)
+        if not suggested:
+            return []
+        if self.load_catalog and time.monotonic() - self._catalog_loaded >= CATALOG_TTL_SECONDS:
+            with self._lock:
+                self._catalog = self.load_catalog()
+                self._catalog_loaded = time.monotonic()
+        catalog = self._catalog
+        return [catalog[product_id] for product_id in suggested if product_id in catalog][:limit]
+
+
+def load_catalog():
+    """Display columns of every product, for suggestion cards."""
+    from models import Product
+    rows = Product.query.with_entities(
+        Product.id, Product.name, Product.price_cents, Product.image_url, Product.category).all()
+    return {row.id: SuggestedProduct(*row) for row in rows}
+
+
+def get_recommender(app):
+    recommender = app.extensions.get('recommender')
+    if recommender is None:
+        recommender = app.extensions['recommender'] = Recommender(recommendations_dir(app), load_catalog)
+    return recommender
+
+
+if __name__ == '__main__':
+    from app import get_app
+    from models import db
+    from order_archive import archive_path
+
+    parser = argparse.ArgumentParser(description="Build 'frequently bought together' recommendations")
+    parser.add_argument('--full', action='store_true', help="rebuild from all orders instead of only new ones")
+    parser.add_argument('--top-k', type=int, default=DEFAULT_TOP_K)
+    args = parser.parse_args()
+
+    app = get_app()
+    with app.app_context():
+        database = db.engine.url.database
+    started = time.perf_counter()
+    orders, products = build(database, recommendations_dir(app), args.top_k, args.full, archive_path(app))
+    print(f"Processed {orders} new orders; {products} products have suggestions "
+          f"({time.perf_counter() - started:.2f}s)")
@@ -0,0 +1,315 @@
+"""Sales reports for the admin pages.
+
+Each process keeps a column-wise snapshot of every order (hot and archived)
+in NumPy arrays: one array per order column and one per order-line column.
+The snapshot is loaded CHUNK_SIZE rows at a time, and afterwards only orders
+with an id above the last one seen are read, since orders don't change once
+placed. A report for a date range masks the snapshot and computes every
+breakdown as a vectorized group-by (a sort + ``np.add.reduceat``) rather
+than a Python loop over orders.
+
+Amounts are int64 cents throughout, so every sum is exact. Each figure is
+converted to whole INR once, after summing (see ``money.convert()``), rather
+than rounding every order.
+
+Finished reports are cached per date range: ranges that include the present
+for OPEN_RANGE_TTL seconds, ranges that ended in the past for
+CLOSED_RANGE_TTL seconds.
+"""
+from collections import namedtuple
+from datetime import datetime
+import threading
+import time
+
+import numpy as np
+from flask import current_app
+from sqlalchemy import Integer, String, cast, func, literal, select, true
+
+from models import db, Product
+from money import convert
+from order_archive import order_source, order_tables
+
+CHUNK_SIZE = 20000
+OPEN_RANGE_TTL = 60
+CLOSED_RANGE_TTL = 3600
+MAX_CACHED_REPORTS = 32
+SECONDS_PER_DAY = 86400
+EPOCH = datetime(1970, 1, 1)
+
+SalesColumns = namedtuple('SalesColumns', [
+    'ids',              # order id, ascending
+    'seconds',          # order date, Unix time
+    'totals',           # order total (USD cents)
+    'customers',        # customer number, see SalesData.customer_codes
+    'item_orders',      # for every order line: position of its order in the arrays above
+    'item_products',
+    'item_quantities',
+    'item_totals',      # line total (USD cents)
+])
+
+_DTYPES = SalesColumns(np.int64, np.int64, np.int64, np.int32, np.int32, np.int32, np.int32, np.int64)
+
+
+def _empty_columns():
+    return SalesColumns(*(np.empty(0, dtype=dtype) for dtype in _DTYPES))
+
+
+def _fetch_columns(statement, dtypes, chunk_size):
+    """Run ``statement`` and return one array (a list for dtype object) per column.
+
+    Rows are read straight from the DB-API cursor in chunks: the columns are
+    plain numbers and strings, so SQLAlchemy's per-row processing would only
+    add overhead.
+    """
+    cursor = db.session.execute(statement).cursor
+    parts = [[] for _ in dtypes]
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            break
+        for part, column, dtype in zip(parts, zip(*rows), dtypes):
+            if dtype is object:
+                part.extend(column)
+            else:
+                part.append(np.array(column, dtype=dtype))
+    cursor.close()
+    return [part if dtype is object else np.concatenate(part) if part else np.empty(0, dtype=dtype)
+            for part, dtype in zip(parts, dtypes)]
+
+
+def load_columns(customer_codes, after_id=0, chunk_size=CHUNK_SIZE):
+    """SalesColumns for the orders with an id above ``after_id``.
+
+    Customers ('#<user id>', or the e-mail address for guest orders) are
+    numbered through the ``customer_codes`` dict, which is updated in place.
+    """
+    source = order_source(after_id=after_id)
+    ids, seconds, totals, customer_keys = _fetch_columns(select(
+        source.c.id,
+        cast(func.strftime('%s', source.c.order_date), Integer),
+        source.c.order_total_cents,
+        func.coalesce(literal('#', String).concat(source.c.user_id), func.lower(source.c.customer_email)),
+    ), (np.int64, np.int64, np.int64, object), chunk_size)
+    if not ids.size:
+        return _empty_columns()
+
+    # SQLite unpacks the JSON order lines itself and hands back only the numbers
+    lines = func.json_each(source.c.order_items).table_valued('key', 'value')
+    line_ids, line_keys, products, quantities, line_totals = _fetch_columns(
+        select(
+            source.c.id,
+            lines.c.key,
+            func.coalesce(cast(func.json_extract(lines.c.value, '$.id'), Integer), 0),
+            func.coalesce(cast(func.json_extract(lines.c.value, '$.quantity'), Integer), 0),
+            func.coalesce(cast(func.json_extract(lines.c.value, '$.item_total_cents'), Integer), 0),
+        ).select_from(source).join(lines, true()).where(
+            func.json_valid(source.c.order_items) == 1,
+            # A separate read: leave out orders committed since the one above
+            source.c.id <= int(ids.max())),
+        (np.int64, np.int64, np.int32, np.int32, np.int64), chunk_size)
+
+    # An order the archive mover has copied but not yet deleted is read twice
+    ids, first = np.unique(ids, return_index=True)
+    if first.size < len(customer_keys):
+        _, first_line = np.unique(np.stack([line_ids, line_keys]), axis=1, return_index=True)
+        line_ids, products, quantities, line_totals = (
+            line_ids[first_line], products[first_line], quantities[first_line], line_totals[first_line])
+
+    customers = np.fromiter(
+        (customer_codes.setdefault(customer_keys[row], len(customer_codes)) for row in first.tolist()),
+        np.int32, first.size)
+    return SalesColumns(ids, seconds[first], totals[first], customers,
+                        np.searchsorted(ids, line_ids).astype(np.int32), products, quantities, line_totals)
+
+
+def _stored_order_count():
+    # A plain count(*) per table, which SQLite answers from the b-tree without reading rows. An
+    # order the archive mover has copied but not yet deleted counts twice and causes one extra reload
+    return sum(db.session.execute(select(func.count()).select_from(table)).scalar() for table in order_tables())
+
+
+class SalesData:
+    """A snapshot of all orders as SalesColumns, refreshed incrementally, plus cached reports."""
+
+    def __init__(self):
+        self.columns = _empty_columns()
+        self.customer_codes = {}
+        self.reports = {}
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        """Append orders placed since the last refresh; reload everything if orders were removed."""
+        with self._lock:
+            columns = self.columns
+            after_id = int(columns.ids[-1]) if columns.ids.size else 0
+            new = load_columns(self.customer_codes, after_id)
+            if new.ids.size:
+                new = new._replace(item_orders=new.item_orders + np.int32(columns.ids.size))
+                columns = SalesColumns(*(np.concatenate(pair) for pair in zip(columns, new)))
+            if _stored_order_count() != columns.ids.size:
+                self.customer_codes = {}
+                columns = load_columns(self.customer_codes)
+            self.columns = columns
+            return columns
+
+    def select(self, start=None, end=None):
+        """The orders placed in [start, end) and their lines."""
+        columns = self.refresh()
+        keep = np.ones(columns.ids.size, dtype=bool)
+        if start is not None:
+            keep &= columns.seconds >= int((start - EPOCH).total_seconds())
+        if end is not None:
+            keep &= columns.seconds < int((end - EPOCH).total_seconds())
+        keep_lines = keep[columns.item_orders]
+        positions = np.cumsum(keep, dtype=np.int64) - 1
+        return SalesColumns(
+            columns.ids[keep], columns.seconds[keep], columns.totals[keep], columns.customers[keep],
+            positions[columns.item_orders[keep_lines]].astype(np.int32), columns.item_products[keep_lines],
+            columns.item_quantities[keep_lines], columns.item_totals[keep_lines],
+        )
+
+
+def _group(keys, weights):
+    """Distinct keys with the sum of ``weights`` and the row count for each.
+
+    Integer weights are summed as int64 (np.bincount would turn them into float64).
+    """
+    order = np.argsort(keys)
+    sorted_keys = keys[order]
+    starts = np.flatnonzero(np.r_[True, sorted_keys[1:] != sorted_keys[:-1]]) if keys.size else order
+    weights = weights.astype(np.result_type(weights.dtype, np.int64), copy=False)[order]
+    sums = np.add.reduceat(weights, starts) if keys.size else weights
+    return sorted_keys[starts], sums, np.diff(np.r_[starts, keys.size])
+
+
+def _by_period(periods, labels, cents, rate):
+    keys, sums, counts = _group(periods, cents)
+    return [{'period': label, 'revenue': int(total), 'orders': int(count)}
+            for label, total, count in zip(labels(keys), convert(sums, rate), counts)]
+
+
+def _day_labels(days):
+    return np.datetime_as_string(days.astype('datetime64[D]'), unit='D').tolist()
+
+
+def _month_labels(months):
+    return np.datetime_as_string(months.astype('datetime64[M]'), unit='M').tolist()
+
+
+def _cohorts(customers, months):
+    """Share of each first-order-month cohort that ordered again N months later."""
+    if customers.size == 0:
+        return []
+    customers = customers.astype(np.int64)
+    order = np.lexsort((months, customers))
+    sorted_customers = customers[order]
+    first_rows = np.flatnonzero(np.r_[True, sorted_customers[1:] != sorted_customers[:-1]])
+    first_month = np.zeros(customers.max() + 1, dtype=np.int64)
+    first_month[sorted_customers[first_rows]] = months[order][first_rows]
+
+    age = months - first_month[customers]
+    width = int(age.max()) + 1
+    # Each customer counts once per cohort/age cell however many orders they placed that month
+    active = np.unique(customers * width + age)
+    active_customers, active_age = active // width, active % width
+    cohort_months, cohort_index = np.unique(first_month[active_customers], return_inverse=True)
+    cells = np.bincount(cohort_index * width + active_age, minlength=cohort_months.size * width)
+    cells = cells.reshape(cohort_months.size, width)
+    sizes = cells[:, 0]
+    # Later cohorts have had fewer months to come back in
+    observable = width - (cohort_months - cohort_months.min())
+    return [
+        {'cohort': label, 'customers': int(size), 'retention': np.round(row[:months_seen] / size, 4).tolist()}
+        for label, size, row, months_seen in zip(_month_labels(cohort_months), sizes, cells, observable)
+    ]
+
+
+def build_report(columns, rate, catalog):
+    """The sales report for ``columns`` in INR at ``rate`` paise per USD.
+
+    ``catalog`` maps product id to (name, category).
+    """
+    days = columns.seconds // SECONDS_PER_DAY
+    # 1970-01-01 was a Thursday; weeks start on Monday
+    weeks = days - (days + 3) % 7
+    months = days.astype('datetime64[D]').astype('datetime64[M]').astype(np.int64)
+
+    order_count = int(columns.totals.size)
+    total = int(convert(columns.totals.sum(dtype=np.int64), rate))
+    orders_per_customer = np.bincount(columns.customers)
+    customer_count = int(np.count_nonzero(orders_per_customer))
+    repeat_customers = int(np.count_nonzero(orders_per_customer > 1))
+
+    product_ids, product_cents, _ = _group(columns.item_products, columns.item_totals)
+    _, units, _ = _group(columns.item_products, columns.item_quantities)
+    categories = np.array([catalog.get(product_id, (None, 'other'))[1] for product_id in product_ids.tolist()],
+                          dtype=object)
+    if categories.size:
+        category_names, category_cents, _ = _group(categories, product_cents)
+        category_revenue = convert(category_cents, rate)
+        _, category_units, _ = _group(categories, units)
+    else:
+        category_names = category_revenue = category_units = []
+    product_revenue = convert(product_cents, rate)
+    ranked = np.argsort(-product_cents, kind='stable')
+
+    return {
+        'summary': {
+            'orders': order_count,
+            'revenue': total,
+            'average_order_value': round(total / order_count, 2) if order_count else 0,
+            'units': int(columns.item_quantities.sum()),
+            'customers': customer_count,
+            'repeat_customers': repeat_customers,
+            'repeat_customer_rate': round(repeat_customers / customer_count, 4) if customer_count else 0,
+        },
+        'revenue_by_day': _by_period(days, _day_labels, columns.totals, rate),
+        'revenue_by_week': _by_period(weeks, _day_labels, columns.totals, rate),
+        'revenue_by_month': _by_period(months, _month_labels, columns.totals, rate),
+        'revenue_by_category': sorted(
+            ({'category': name, 'revenue': int(amount), 'units': int(count)}
+             for name, amount, count in zip(category_names, category_revenue, category_units)),
+            key=lambda row: -row['revenue']),
+        'revenue_by_product': [
+            {'product_id': int(product_ids[i]),
+             'name': catalog.get(int(product_ids[i]), (f'Product #{product_ids[i]}', None))[0],
+             'revenue': int(product_revenue[i]), 'units': int(units[i])}
+            for i in ranked.tolist()
+        ],
+        'cohort_retention': _cohorts(columns.customers, months),
+        'currency': 'INR',
+    }
+
+
+def get_sales_data(app):
+    data = app.extensions.get('sales_data')
+    if data is None:
+        data = app.extensions.setdefault('sales_data', SalesData())
+    return data
+
+
+def sales_report(start=None, end=None):
+    """Cached sales report for orders in [start, end) (either bound may be None)."""
+    from app import INR_PAISE_PER_USD
+
+    data = get_sales_data(current_app)
+    now = time.monotonic()
+    cached = data.reports.get((start, end))
+    if cached and cached[0] > now:
+        return cached[1]
+
+    started = time.perf_counter()
+    catalog = {row.id: (row.name, row.category)
+               for row in Product.query.with_entities(Product.id, Product.name, Product.category)}
+    report = build_report(data.select(start, end), INR_PAISE_PER_USD, catalog)
+    report['range'] = {'start': start.isoformat() if start else None, 'end': end.isoformat() if end else None}
+    report['generated_at'] = datetime.utcnow().isoformat()
+    report['build_seconds'] = round(time.perf_counter() - started, 3)
+
+    closed = end is not None and end <= datetime.utcnow()
+    reports = data.reports
+    reports[(start, end)] = (now + (CLOSED_RANGE_TTL if closed else OPEN_RANGE_TTL), report)
+    # Oldest first; the dict is only pruned here, and a lost race just drops one entry early
+    for key in list(reports)[:-MAX_CACHED_REPORTS]:
+        reports.pop(key, None)
+    return report
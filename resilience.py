@@ -0,0 +1,207 @@
+"""Stale-while-revalidate catalog data and a circuit breaker for the database.
+
+The storefront pages show the same product lists to everybody, so the last
+successful result of each catalog query is kept in memory:
+
+* younger than CATALOG_FRESH_SECONDS (and no product changed since, see
+  fragments.catalog_version()): served without touching the database;
+* older: refreshed on a background thread. The request waits at most
+  CATALOG_DEADLINE seconds for the new result and otherwise renders with
+  the stale copy, while the refresh finishes for later requests.
+
+Only one refresh per query runs at a time, and at most CATALOG_MAX_ENTRIES
+results are kept (least recently used go first), since keys include URL
+segments such as the category name. Refreshes that fail or exceed
+the deadline trip a circuit breaker; while it is open no refresh is
+started at all and stale data is served straight away, so a locked or
+struggling database isn't hammered by every page view. With no copy to
+fall back on, the request gets a 503 with ``Retry-After``.
+
+Pages are still rendered per request (they contain the visitor's session),
+so only the data is shared. Responses built from stale data carry a
+``Warning: 110`` header.
+"""
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import threading
+import time
+
+from flask import current_app, g, jsonify, request
+
+from fragments import catalog_version
+
+DEFAULT_FRESH_SECONDS = 5
+DEFAULT_DEADLINE = 0.25
+DEFAULT_MAX_ENTRIES = 256
+DEFAULT_FAILURE_THRESHOLD = 3
+DEFAULT_RESET_TIMEOUT = 10
+
+logger = logging.getLogger('fashion-store.resilience')
+
+_Entry = namedtuple('_Entry', 'loaded_at version value')
+
+
+class CatalogUnavailable(Exception):
+    """The database can't answer and there is no earlier result to fall back on."""
+
+
+class CircuitBreaker:
+    """Opens after ``failure_threshold`` consecutive failures; lets one trial through after ``reset_timeout``."""
+
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+
+    def __init__(self, failure_threshold=DEFAULT_FAILURE_THRESHOLD, reset_timeout=DEFAULT_RESET_TIMEOUT):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._lock = threading.Lock()
+
+    def allow(self, now=None):
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and now - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                return True
+            return False
+
+    def retry_after(self, now=None):
+        now = time.monotonic() if now is None else now
+        return max(0.0, self.opened_at + self.reset_timeout - now)
+
+    def record_success(self):
+        with self._lock:
+            if self.state != self.CLOSED:
+                logger.info("Database looks healthy again; closing the circuit")
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self, now=None):
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    logger.warning("Opening the circuit after %d slow or failed catalog queries", self.failures)
+                self.state = self.OPEN
+                self.opened_at = now
+
+
+class StaleWhileRevalidate:
+    """Last good result per key, refreshed in the background; see the module docstring."""
+
+    def __init__(self, app, fresh_for=DEFAULT_FRESH_SECONDS, deadline=DEFAULT_DEADLINE, breaker=None,
+                 max_entries=DEFAULT_MAX_ENTRIES):
+        self.app = app
+        self.fresh_for = fresh_for
+        self.deadline = deadline
+        self.breaker = breaker or CircuitBreaker()
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # key -> _Entry, least recently used first
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='catalog-refresh')
+
+    def get(self, key, load):
+        """``load()``'s result for ``key``, possibly stale; raises CatalogUnavailable."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+        if entry is not None and entry.version == catalog_version() \
+                and time.monotonic() - entry.loaded_at < self.fresh_for:
+            return entry.value
+
+        future = self._refresh(key, load)
+        if future is None:
+            if entry is not None:
+                return self._stale(entry)
+            raise CatalogUnavailable(key)
+        try:
+            # Without a stale copy there is nothing better to do than wait
+            return future.result(timeout=self.deadline if entry is not None else None)
+        except Exception as e:
+            if entry is None:
+                raise CatalogUnavailable(key) from e
+            return self._stale(entry)
+
+    def _stale(self, entry):
+        g.stale_catalog = True
+        return entry.value
+
+    def _refresh(self, key, load):
+        with self._lock:
+            future = self._pending.get(key)
+            if future is None:
+                if not self.breaker.allow():
+                    return None
+                future = self._pending[key] = self._executor.submit(self._load, key, load)
+            return future
+
+    def _load(self, key, load):
+        started = time.monotonic()
+        version = catalog_version()
+        try:
+            with self.app.app_context():
+                # The result outlives this context and is shared by threads: plain rows, see listings.py
+                value = load()
+        except Exception:
+            self.breaker.record_failure()
+            logger.exception("Refreshing catalog data %r failed", key)
+            raise
+        else:
+            with self._lock:
+                self._entries[key] = _Entry(time.monotonic(), version, value)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        finally:
+            with self._lock:
+                self._pending.pop(key, None)
+        if time.monotonic() - started > self.deadline:
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+        return value
+
+
+def catalog_data(app):
+    return app.extensions['catalog_data']
+
+
+def _mark_stale(response):
+    if g.pop('stale_catalog', False):
+        response.headers['Warning'] = '110 - "Response is Stale"'
+    return response
+
+
+def _unavailable(error):
+    breaker = current_app.extensions['catalog_data'].breaker
+    message = 'The store is busy right now, please try again in a moment.'
+    if request.path.startswith('/api/'):
+        response = jsonify({'success': False, 'message': message})
+    else:
+        response = current_app.response_class(message, mimetype='text/plain')
+    response.status_code = 503
+    response.headers['Retry-After'] = str(int(breaker.retry_after()) + 1)
+    return response
+
+
+def init_app(app):
+    cache = app.extensions['catalog_data'] = StaleWhileRevalidate(
+        app,
+        fresh_for=app.config.get('CATALOG_FRESH_SECONDS', DEFAULT_FRESH_SECONDS),
+        deadline=app.config.get('CATALOG_DEADLINE', DEFAULT_DEADLINE),
+        breaker=CircuitBreaker(
+            app.config.get('CATALOG_BREAKER_FAILURES', DEFAULT_FAILURE_THRESHOLD),
+            app.config.get('CATALOG_BREAKER_RESET', DEFAULT_RESET_TIMEOUT),
+        ),
+        max_entries=app.config.get('CATALOG_MAX_ENTRIES', DEFAULT_MAX_ENTRIES),
+    )
+    app.after_request(_mark_stale)
+    app.register_error_handler(CatalogUnavailable, _unavailable)
+    return cache
@@ -1,5 +1,5 @@
-from app import app, db, init_db
-import os
+from app import app, upgrade_schema
+import warmup
 import socket
 
 def get_local_ip():
@@ -15,17 +15,12 @@ def get_local_ip():
         return "127.0.0.1"  # Fallback to localhost
 
 if __name__ == '__main__':
-    # Initialize the database if it doesn't exist
-    db_path = os.path.join(os.path.dirname(__file__), 'ecommerce.db')
-    initialize_db = not os.path.exists(db_path)
+    # Create missing tables, indexes and columns, convert older data and load the sample products
+    print("Preparing the database...")
+    upgrade_schema(app)
     
-    with app.app_context():
-        if initialize_db:
-            print("Initializing database...")
-            db.create_all()
-            init_db()
-        else:
-            print("Database already exists. Skipping initialization.")
+    # Compile templates, open connections and prime caches before taking traffic
+    warmup.warm_up(app)
     
     # Get the local IP address
     local_ip = get_local_ip()
@@ -1,13 +1,13 @@
 from flask import Flask, render_template, url_for, request, redirect, session, flash, jsonify
 from flask_sqlalchemy import SQLAlchemy
 import os
-from datetime import datetime, timedelta
+from datetime import datetime
 import json
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
 import time
-import random
-import string
+from otp_store import create_otp_store
+from ratelimit import RateLimiter
 
 # Configure upload folder
 UPLOAD_FOLDER = 'static/images/profile'
@@ -80,49 +80,22 @@ class User(db.Model):
             return ", ".join(address_parts)
         return "No address provided"
 
-# OTP Model for phone verification
-class OTP(db.Model):
-    id = db.Column(db.Integer, primary_key=True)
-    phone = db.Column(db.String(20), nullable=False)
-    otp_code = db.Column(db.String(6), nullable=False)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    expires_at = db.Column(db.DateTime, default=lambda: datetime.utcnow() + timedelta(minutes=10))
-    is_verified = db.Column(db.Boolean, default=False)
-    
-    @staticmethod
-    def generate_otp():
-        return ''.join(random.choices(string.digits, k=6))
-    
+# OTP codes for phone login live in a pluggable store (in memory by default)
+otp_store = create_otp_store()
+
+class OTP:
     @staticmethod
     def create_otp_for_phone(phone):
-        # Delete any existing OTPs for this phone
-        OTP.query.filter_by(phone=phone).delete()
-        db.session.commit()
-        
-        # Create new OTP
-        otp_code = OTP.generate_otp()
-        otp = OTP(phone=phone, otp_code=otp_code)
-        db.session.add(otp)
-        db.session.commit()
-        return otp_code
+        return otp_store.issue(phone)
     
     @staticmethod
     def verify_otp(phone, otp_code):
-        otp = OTP.query.filter_by(
-            phone=phone, 
-            otp_code=otp_code, 
-            is_verified=False
-        ).first()
-        
-        if not otp:
-            return False
-        
-        if otp.expires_at < datetime.utcnow():
-            return False
-        
-        otp.is_verified = True
-        db.session.commit()
-        return True
+        return otp_store.verify(phone, otp_code)
+
+# Rate limits for phone login: bursts of a few codes, then one every few minutes
+otp_phone_limiter = RateLimiter(capacity=3, per_seconds=10 * 60)
+otp_ip_limiter = RateLimiter(capacity=10, per_seconds=10 * 60)
+otp_verify_limiter = RateLimiter(capacity=5, per_seconds=10 * 60)
 
 # Product Model
 class Product(db.Model):
@@ -171,7 +144,10 @@ def login():
             phone = request.form.get('phone')
             otp = request.form.get('otp')
             
-            if OTP.verify_otp(phone, otp):
+            allowed, _ = otp_verify_limiter.hit(phone)
+            if not allowed:
+                flash('Too many attempts. Please request a new OTP later.', 'danger')
+            elif OTP.verify_otp(phone, otp):
                 user = User.query.filter_by(phone=phone).first()
                 if user:
                     session['user_id'] = user.id
@@ -193,6 +169,15 @@ def send_otp():
     if not phone:
         return jsonify({'success': False, 'message': 'Phone number is required'})
     
+    # Throttle per client IP and per phone number
+    for limiter, key in ((otp_ip_limiter, request.remote_addr), (otp_phone_limiter, phone)):
+        allowed, retry_after = limiter.hit(key)
+        if not allowed:
+            response = jsonify({'success': False, 'message': 'Too many OTP requests. Please try again later.'})
+            response.status_code = 429
+            response.headers['Retry-After'] = str(int(retry_after) + 1)
+            return response
+    
     # Check if user exists with this phone
     user = User.query.filter_by(phone=phone).first()
     if not user:
@@ -0,0 +1,227 @@
+"""Slow-query log with query plans.
+
+Every statement on the app's engine is timed. Statements that take longer
+than SLOW_QUERY_MS milliseconds are:
+
+* grouped by their shape (literals replaced with ``?``, IN lists collapsed)
+  in a bounded table of the SLOW_QUERY_SHAPES most recent shapes, with
+  count, total and worst time and the endpoints that ran them;
+* explained with ``EXPLAIN QUERY PLAN`` on the same connection (once per
+  shape, again after PLAN_TTL seconds), flagging full table scans and temp
+  B-trees for sorting or grouping, the usual sign of a missing index;
+* kept in a ring of the last SLOW_QUERY_RECENT occurrences;
+* written to SLOW_QUERY_LOG (default ``instance/slow_queries.log``).
+
+The admin page ``/admin/slow-queries`` shows the table, worst shapes first.
+
+SQLite does the work of a SELECT while stepping through its rows, and the
+time measured here ends at the first row. That covers everything for
+statements that sort, group or count, but a scan that streams its rows
+back is only partly timed, so look at the plans as well as the times.
+"""
+from collections import OrderedDict, deque
+from datetime import datetime
+import logging
+from logging.handlers import RotatingFileHandler
+import os
+import re
+import sqlite3
+import threading
+import time
+
+from flask import has_request_context, request
+from sqlalchemy import event
+
+from models import db
+
+DEFAULT_THRESHOLD_MS = 100
+DEFAULT_SHAPES = 200
+DEFAULT_RECENT = 500
+PLAN_TTL = 10 * 60
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_BACKUPS = 5
+MAX_ENDPOINTS = 20
+
+logger = logging.getLogger('fashion-store.slow_queries')
+
+_STRINGS = re.compile(r"'(?:[^']|'')*'")
+_NUMBERS = re.compile(r'(?<![\w."])-?\d+(?:\.\d+)?')
+_LISTS = re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)')
+_ROWS = re.compile(r'(\(\?, \.\.\.\)|\(\?\))(?:\s*,\s*\1)+')
+_SPACES = re.compile(r'\s+')
+_EXPLAINABLE = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH')
+_FULL_SCAN = re.compile(r'^SCAN (\S+)(?! USING)')
+
+
+def normalize(statement):
+    """The shape of ``statement``: literals as ``?``, IN lists and VALUES rows collapsed."""
+    shape = _SPACES.sub(' ', statement).strip()
+    shape = _STRINGS.sub('?', shape)
+    shape = _NUMBERS.sub('?', shape)
+    shape = _LISTS.sub('(?, ...)', shape)
+    return _ROWS.sub(r'\1, ...', shape)
+
+
+def explain(dbapi_connection, statement, parameters):
+    """SQLite's query plan for ``statement`` as a list of lines; None if it can't be explained."""
+    if not statement.lstrip().upper().startswith(_EXPLAINABLE):
+        return None
+    try:
+        rows = dbapi_connection.execute('EXPLAIN QUERY PLAN ' + statement, parameters or ()).fetchall()
+    except sqlite3.Error:
+        return None
+    # Rows are (id, parent, notused, detail); indent children under their parent
+    depth = {0: -1}
+    plan = []
+    for node, parent, _, detail in rows:
+        depth[node] = depth.get(parent, -1) + 1
+        plan.append('  ' * depth[node] + detail)
+    return plan
+
+
+def plan_flags(plan):
+    """Tables read with a full scan, and whether a temp B-tree is built."""
+    full_scans = []
+    temp_btree = False
+    for line in plan or ():
+        line = line.strip()
+        match = _FULL_SCAN.match(line)
+        if match:
+            full_scans.append(match.group(1))
+        temp_btree = temp_btree or line.startswith('USE TEMP B-TREE')
+    return full_scans, temp_btree
+
+
+class SlowQueryLog:
+    def __init__(self, threshold_ms=DEFAULT_THRESHOLD_MS, max_shapes=DEFAULT_SHAPES, max_recent=DEFAULT_RECENT):
+        self.threshold = threshold_ms / 1000
+        self.max_shapes = max_shapes
+        self.shapes = OrderedDict()  # shape -> stats dict
+        self.recent = deque(maxlen=max_recent)
+        self.statements = 0
+        self._lock = threading.Lock()
+
+    def before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        # A connection runs one statement at a time (EXPLAIN below bypasses these events)
+        conn.info['query_started'] = time.perf_counter()
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        started = conn.info.pop('query_started', None)
+        if started is None:
+            return
+        elapsed = time.perf_counter() - started
+        self.statements += 1
+        if elapsed >= self.threshold:
+            if executemany:
+                parameters = parameters[0] if parameters else ()
+            self.record(statement, parameters, elapsed, cursor.connection)
+
+    def record(self, statement, parameters, elapsed, dbapi_connection=None):
+        shape = normalize(statement)
+        endpoint = _endpoint()
+        now = time.time()
+        with self._lock:
+            stats = self.shapes.pop(shape, None)
+            if stats is None:
+                stats = {'count': 0, 'total': 0.0, 'max': 0.0, 'endpoints': {}, 'plan': None, 'explained_at': 0}
+                while len(self.shapes) >= self.max_shapes:
+                    self.shapes.popitem(last=False)
+            self.shapes[shape] = stats
+            stats['count'] += 1
+            stats['total'] += elapsed
+            stats['max'] = max(stats['max'], elapsed)
+            stats['last_seen'] = now
+            endpoints = stats['endpoints']
+            if endpoint in endpoints or len(endpoints) < MAX_ENDPOINTS:
+                endpoints[endpoint] = endpoints.get(endpoint, 0) + 1
+            needs_plan = dbapi_connection is not None and now - stats['explained_at'] > PLAN_TTL
+            if needs_plan:
+                stats['explained_at'] = now
+            self.recent.append((now, elapsed, endpoint, shape))
+
+        if needs_plan:
+            plan = explain(dbapi_connection, statement, parameters)
+            stats['plan'] = plan
+            stats['full_scans'], stats['temp_btree'] = plan_flags(plan)
+        plan = stats['plan']
+        logger.warning("%.1f ms [%s] %s%s", elapsed * 1000, endpoint, shape,
+                       ' | ' + '; '.join(line.strip() for line in plan) if plan else '')
+
+    def report(self):
+        """The recorded shapes, most total time first, and the latest occurrences."""
+        with self._lock:
+            shapes = [(shape, dict(stats)) for shape, stats in self.shapes.items()]
+            recent = list(self.recent)
+        shapes.sort(key=lambda item: item[1]['total'], reverse=True)
+        return {
+            'threshold_ms': self.threshold * 1000,
+            'statements': self.statements,
+            'shapes': [{
+                'shape': shape,
+                'count': stats['count'],
+                'total_ms': round(stats['total'] * 1000, 1),
+                'mean_ms': round(stats['total'] * 1000 / stats['count'], 1),
+                'max_ms': round(stats['max'] * 1000, 1),
+                'last_seen': datetime.fromtimestamp(stats['last_seen']).isoformat(timespec='seconds'),
+                'endpoints': stats['endpoints'],
+                'plan': stats['plan'],
+                'full_scans': stats.get('full_scans', []),
+                'temp_btree': stats.get('temp_btree', False),
+            } for shape, stats in shapes],
+            'recent': [{
+                'at': datetime.fromtimestamp(at).isoformat(timespec='seconds'),
+                'ms': round(elapsed * 1000, 1),
+                'endpoint': endpoint,
+                'shape': shape,
+            } for at, elapsed, endpoint, shape in reversed(recent)],
+        }
+
+    def clear(self):
+        with self._lock:
+            self.shapes.clear()
+            self.recent.clear()
+
+
+def _endpoint():
+    if has_request_context():
+        return request.endpoint or request.path
+    return threading.current_thread().name
+
+
+_log_files = set()
+
+
+class _LogFileHandler(RotatingFileHandler):
+    """Creates the log's directory with the file, when the first slow statement is written."""
+
+    def _open(self):
+        os.makedirs(os.path.dirname(self.baseFilename), exist_ok=True)
+        return super()._open()
+
+
+def _log_to(path):
+    path = os.path.abspath(path)
+    if path in _log_files:
+        return
+    handler = _LogFileHandler(path, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUPS, delay=True)
+    handler.setFormatter(logging.Formatter('%(asctime)s - %(message)s'))
+    logger.addHandler(handler)
+    _log_files.add(path)
+
+
+def init_app(app):
+    """Time the statements of ``app``'s engine unless SLOW_QUERY_MS is None."""
+    threshold = app.config.get('SLOW_QUERY_MS', DEFAULT_THRESHOLD_MS)
+    if threshold is None:
+        return None
+    log = app.extensions['slow_queries'] = SlowQueryLog(
+        threshold,
+        app.config.get('SLOW_QUERY_SHAPES', DEFAULT_SHAPES),
+        app.config.get('SLOW_QUERY_RECENT', DEFAULT_RECENT),
+    )
+    _log_to(app.config.get('SLOW_QUERY_LOG') or os.path.join(app.instance_path, 'slow_queries.log'))
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, 'before_cursor_execute', log.before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', log.after_cursor_execute)
+    return log
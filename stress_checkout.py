@@ -0,0 +1,103 @@
+"""Concurrency stress test for stock reservation.
+
+Many threads check out random carts against a scratch SQLite database as fast
+as they can. When the stock runs out, every unit that left the shelf must
+belong to exactly one successful checkout and no product may go negative.
+
+    python stress_checkout.py --threads 16 --products 5 --stock 200
+"""
+import argparse
+import os
+import random
+import tempfile
+import threading
+import time
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import Session
+
+from models import Product
+from inventory import OutOfStockError, reserve_stock
+
+
+def run(threads, products, stock, max_lines, max_quantity):
+    db_dir = tempfile.mkdtemp(prefix='stress_checkout_')
+    db_path = os.path.join(db_dir, 'stress.db')
+    engine = create_engine(f'sqlite:///{db_path}', connect_args={'timeout': 60})
+    Product.__table__.create(engine)
+
+    with engine.begin() as conn:
+        for i in range(products):
+            conn.execute(Product.__table__.insert().values(
+                name=f'Product {i}', price_cents=1000, description='stress', category='stress',
+                image_url='stress.jpg', stock=stock
+            ))
+        product_ids = [row[0] for row in conn.execute(text('SELECT id FROM product'))]
+
+    sold = {product_id: 0 for product_id in product_ids}
+    counts = {'ok': 0, 'out_of_stock': 0}
+    lock = threading.Lock()
+    start_gate = threading.Event()
+
+    def worker():
+        rng = random.Random()
+        local_sold = {product_id: 0 for product_id in product_ids}
+        local_ok = local_failed = 0
+        start_gate.wait()
+        # Keep buying until every product is sold out
+        while local_failed < 50 * products:
+            lines = [(rng.choice(product_ids), rng.randint(1, max_quantity))
+                     for _ in range(rng.randint(1, max_lines))]
+            with Session(engine) as session:
+                try:
+                    reserve_stock(session, lines)
+                    session.commit()
+                except OutOfStockError:
+                    session.rollback()
+                    local_failed += 1
+                    continue
+            local_ok += 1
+            for product_id, quantity in lines:
+                local_sold[product_id] += quantity
+        with lock:
+            counts['ok'] += local_ok
+            counts['out_of_stock'] += local_failed
+            for product_id, quantity in local_sold.items():
+                sold[product_id] += quantity
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    for t in workers:
+        t.start()
+    started = time.perf_counter()
+    start_gate.set()
+    for t in workers:
+        t.join()
+    elapsed = time.perf_counter() - started
+
+    with engine.connect() as conn:
+        remaining = dict(conn.execute(text('SELECT id, stock FROM product')).all())
+    engine.dispose()
+
+    print(f"{counts['ok']} checkouts, {counts['out_of_stock']} rejected in {elapsed:.2f}s "
+          f"({(counts['ok'] + counts['out_of_stock']) / elapsed:.0f} attempts/s)")
+    failures = []
+    for product_id in product_ids:
+        line = f"product {product_id}: sold {sold[product_id]}, remaining {remaining[product_id]}"
+        print(line)
+        if remaining[product_id] < 0 or sold[product_id] + remaining[product_id] != stock:
+            failures.append(line)
+
+    if failures:
+        raise SystemExit("OVERSOLD:\n" + "\n".join(failures))
+    print("OK: no product was oversold")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--products', type=int, default=5)
+    parser.add_argument('--stock', type=int, default=200)
+    parser.add_argument('--max-lines', type=int, default=3)
+    parser.add_argument('--max-quantity', type=int, default=3)
+    args = parser.parse_args()
+    run(args.threads, args.products, args.stock, args.max_lines, args.max_quantity)
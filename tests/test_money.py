@@ -0,0 +1,83 @@
+import json
+import sqlite3
+
+import pytest
+from sqlalchemy import create_engine
+
+import money
+
+# The tables as they were before money moved to integer cents
+OLD_SCHEMA = '''
+CREATE TABLE product (
+    id INTEGER PRIMARY KEY, name VARCHAR(100) NOT NULL, price FLOAT NOT NULL,
+    description TEXT NOT NULL, category VARCHAR(50) NOT NULL, image_url VARCHAR(200) NOT NULL,
+    stock INTEGER NOT NULL DEFAULT 0, created_date DATETIME
+);
+CREATE TABLE "order" (
+    id INTEGER PRIMARY KEY, user_id INTEGER, customer_name VARCHAR(100) NOT NULL,
+    customer_email VARCHAR(100) NOT NULL, customer_phone VARCHAR(20) NOT NULL,
+    customer_address TEXT NOT NULL, order_date DATETIME, order_total FLOAT NOT NULL,
+    order_items TEXT NOT NULL
+);
+'''
+
+ORDER_ITEMS = [
+    {'product_id': 1, 'name': 'T-Shirt', 'quantity': 3, 'price': 19.99, 'discount': 2.0, 'item_total': 57.97},
+    {'product_id': 2, 'name': 'Jeans', 'quantity': 1, 'price': 49.995, 'item_total': 49.995},
+]
+
+
+@pytest.fixture
+def old_database(tmp_path):
+    path = tmp_path / 'ecommerce.db'
+    conn = sqlite3.connect(path)
+    conn.executescript(OLD_SCHEMA)
+    conn.executemany(
+        "INSERT INTO product (id, name, price, description, category, image_url) VALUES (?, ?, ?, '', 'men', '')",
+        [(1, 'T-Shirt', 19.99), (2, 'Jeans', 49.995), (3, 'Cap', 0.1 + 0.2)])
+    conn.execute(
+        "INSERT INTO \"order\" (id, customer_name, customer_email, customer_phone, customer_address, "
+        "order_total, order_items) VALUES (1, 'Alice', 'a@example.com', '1', 'Pune', 107.965, ?)",
+        (json.dumps(ORDER_ITEMS),))
+    conn.commit()
+    conn.close()
+    engine = create_engine(f'sqlite:///{path}')
+    yield engine
+    engine.dispose()
+
+
+def _dump(engine):
+    with engine.connect() as conn:
+        raw = conn.connection.driver_connection
+        return {table: raw.execute(f'SELECT * FROM "{table}" ORDER BY id').fetchall()
+                for table in ('product', 'order')}, \
+            {table: [row[1] for row in raw.execute(f'PRAGMA table_info("{table}")')]
+             for table in ('product', 'order')}
+
+
+def test_upgrade_schema_converts_dollars_to_cents(old_database):
+    assert money.upgrade_schema(old_database) == ['product', 'order']
+
+    _, columns = _dump(old_database)
+    assert 'price' not in columns['product'] and 'price_cents' in columns['product']
+    assert 'order_total' not in columns['order'] and 'order_total_cents' in columns['order']
+    with old_database.connect() as conn:
+        raw = conn.connection.driver_connection
+        prices = dict(raw.execute('SELECT id, price_cents FROM product'))
+        total, items = raw.execute('SELECT order_total_cents, order_items FROM "order"').fetchone()
+    assert prices == {1: 1999, 2: 5000, 3: 30}
+    assert total == 10797
+    items = json.loads(items)
+    assert [(item['price_cents'], item['discount_cents'], item['item_total_cents']) for item in items] == \
+        [(1999, 200, 5797), (5000, 0, 5000)]
+    for item in items:
+        assert not {'price', 'discount', 'item_total'} & item.keys()
+        assert all(type(item[key]) is int for key in ('price_cents', 'discount_cents', 'item_total_cents'))
+    assert [item['name'] for item in items] == ['T-Shirt', 'Jeans']
+
+
+def test_upgrade_schema_twice_changes_nothing(old_database):
+    money.upgrade_schema(old_database)
+    before = _dump(old_database)
+    assert money.upgrade_schema(old_database) == []
+    assert _dump(old_database) == before
@@ -0,0 +1,167 @@
+"""Rate limiting and load shedding for the endpoints bots like to hammer.
+
+Every request to a protected endpoint takes a token from two buckets of its
+policy: one for the client IP and one for the session (the logged-in user,
+or an anonymous id kept in the session cookie). The buckets are
+ratelimit.RateLimiter tables, so idle entries are swept away as they go.
+An empty bucket gets a 429 with ``Retry-After``.
+
+Waitress runs a handful of threads per process. When SHED_IN_FLIGHT of them
+are already busy, requests to sheddable endpoints (login, signup and the
+cart XHR calls) are refused with a 503 and ``Retry-After`` straight away, so
+the remaining threads stay free for browsing and checkout.
+
+Policies can be overridden per app with the RATE_LIMITS setting, a dict of
+policy name to a Policy, a dict of its fields or a list of them in order (so
+the setting can come from JSON in ``FASHION_STORE_RATE_LIMITS``);
+RATE_LIMIT_ENABLED = False turns all of this off.
+"""
+from collections import namedtuple
+import threading
+import uuid
+
+from flask import current_app, g, jsonify, request, session
+
+from ratelimit import RateLimiter
+
+Policy = namedtuple('Policy', 'ip_capacity ip_per_seconds session_capacity session_per_seconds methods shed')
+
+POLICIES = {
+    'login': Policy(20, 5 * 60, 10, 5 * 60, ('POST',), True),
+    'signup': Policy(10, 60 * 60, 5, 60 * 60, ('POST',), True),
+    'checkout': Policy(30, 10 * 60, 10, 10 * 60, ('POST',), False),
+    'cart': Policy(240, 60, 120, 60, ('GET', 'POST'), True),
+}
+
+# Endpoint -> policy name
+ENDPOINTS = {
+    'login': 'login',
+    'signup': 'signup',
+    'checkout': 'checkout',
+    'add_to_cart': 'cart',
+    'update_cart': 'cart',
+    'remove_from_cart': 'cart',
+    'clear_cart': 'cart',
+    'apply_coupon': 'cart',
+    'cart_api': 'cart',
+    'also_bought_api': 'cart',
+}
+
+# Never refused, so probes and static files keep working under load
+EXEMPT_ENDPOINTS = {'readiness', 'static'}
+
+SHED_RETRY_AFTER = 1
+
+
+class Throttle:
+    def __init__(self, policies, shed_in_flight):
+        self.policies = policies
+        self.limiters = {
+            name: (RateLimiter(policy.ip_capacity, policy.ip_per_seconds),
+                   RateLimiter(policy.session_capacity, policy.session_per_seconds))
+            for name, policy in policies.items()
+        }
+        self.shed_in_flight = shed_in_flight
+        self.in_flight = 0
+        self.shed = 0
+        self.limited = 0
+        self._lock = threading.Lock()
+
+    def before_request(self):
+        endpoint = request.endpoint
+        if endpoint in EXEMPT_ENDPOINTS:
+            return None
+        with self._lock:
+            busy = self.in_flight
+            self.in_flight += 1
+        g.throttle_counted = True
+
+        name = ENDPOINTS.get(endpoint)
+        policy = self.policies.get(name)
+        if policy is None or request.method not in policy.methods:
+            return None
+
+        if policy.shed and self.shed_in_flight and busy >= self.shed_in_flight:
+            self.shed += 1
+            return _refuse(503, 'The store is busy right now, please try again in a moment.', SHED_RETRY_AFTER)
+
+        ip_limiter, session_limiter = self.limiters[name]
+        for limiter, key in ((ip_limiter, request.remote_addr), (session_limiter, _session_key())):
+            allowed, retry_after = limiter.hit(key)
+            if not allowed:
+                self.limited += 1
+                return _refuse(429, 'Too many requests, please slow down.', retry_after)
+        return None
+
+    def teardown_request(self, exc=None):
+        if g.pop('throttle_counted', False):
+            with self._lock:
+                self.in_flight -= 1
+
+    def stats(self):
+        return {
+            'in_flight': self.in_flight,
+            'shed': self.shed,
+            'limited': self.limited,
+            'buckets': {name: len(ip) + len(sess) for name, (ip, sess) in self.limiters.items()},
+        }
+
+
+def _session_key():
+    user_id = session.get('user_id')
+    if user_id is not None:
+        return f'user:{user_id}'
+    client_id = session.get('client_id')
+    if client_id is None:
+        client_id = session['client_id'] = uuid.uuid4().hex
+    return client_id
+
+
+def _refuse(status, message, retry_after):
+    if request.headers.get('X-Requested-With') == 'XMLHttpRequest' or request.is_json \
+            or request.path.startswith('/api/'):
+        response = jsonify({'success': False, 'message': message})
+    else:
+        response = current_app.response_class(message, mimetype='text/plain')
+    response.status_code = status
+    response.headers['Retry-After'] = str(int(retry_after) + 1)
+    return response
+
+
+def _policy(name, value):
+    """The Policy for a RATE_LIMITS entry; raises ValueError if it isn't one."""
+    if name not in POLICIES:
+        raise ValueError(f"RATE_LIMITS: unknown policy {name!r}")
+    try:
+        if isinstance(value, dict):
+            policy = Policy(**value)
+        elif isinstance(value, (list, tuple)):
+            policy = Policy(*value)
+        else:
+            raise TypeError(f'expected a Policy, dict or list, got {type(value).__name__}')
+    except TypeError as e:
+        raise ValueError(f"RATE_LIMITS[{name!r}]: {e}") from None
+    counts = (policy.ip_capacity, policy.ip_per_seconds, policy.session_capacity, policy.session_per_seconds)
+    if not all(isinstance(count, (int, float)) and not isinstance(count, bool) and count > 0 for count in counts):
+        raise ValueError(f"RATE_LIMITS[{name!r}]: capacities and periods must be positive numbers")
+    if not isinstance(policy.methods, (list, tuple)) or not all(isinstance(method, str) for method in policy.methods):
+        raise ValueError(f"RATE_LIMITS[{name!r}]: methods must be a list of HTTP methods")
+    if not isinstance(policy.shed, bool):
+        raise ValueError(f"RATE_LIMITS[{name!r}]: shed must be true or false")
+    return policy._replace(methods=tuple(method.upper() for method in policy.methods))
+
+
+def init_app(app):
+    """Install the limits on ``app`` unless RATE_LIMIT_ENABLED is off."""
+    if not app.config.get('RATE_LIMIT_ENABLED', True):
+        return None
+    limits = app.config.get('RATE_LIMITS') or {}
+    if not isinstance(limits, dict):
+        raise ValueError("RATE_LIMITS must map policy names to policies")
+    policies = dict(POLICIES)
+    # Checked here, so a bad setting stops the server from starting instead of failing requests
+    policies.update((name, _policy(name, value)) for name, value in limits.items())
+    throttle = app.extensions['throttle'] = Throttle(policies, app.config.get('SHED_IN_FLIGHT'))
+    app.before_request(throttle.before_request)
+    app.teardown_request(throttle.teardown_request)
+    return throttle
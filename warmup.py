@@ -0,0 +1,97 @@
+"""Startup warm-up for server processes.
+
+A fresh process pays for a lot of one-time work on its first requests:
+compiling every Jinja template, opening SQLite connections, loading the
+catalog pages into SQLite's cache and building Flask's request machinery.
+``warm_up()`` does all of that up front so the first real request costs the
+same as any other, and flips the readiness flag that ``/healthz/ready``
+reports (and that prefork_server.py waits for before sending traffic).
+
+Compiled templates are kept in a persistent Jinja bytecode cache, so later
+processes skip the Jinja compiler entirely.
+"""
+import logging
+import os
+import threading
+import time
+
+from jinja2 import FileSystemBytecodeCache
+
+logger = logging.getLogger("fashion-store")
+
+_ready = threading.Event()
+
+
+def is_ready():
+    return _ready.is_set()
+
+
+def install_bytecode_cache(app):
+    """Store compiled templates under instance/jinja_cache (or TEMPLATE_CACHE_DIR)."""
+    if app.jinja_env.bytecode_cache is not None:
+        return
+    cache_dir = app.config.get('TEMPLATE_CACHE_DIR') or os.path.join(app.instance_path, 'jinja_cache')
+    os.makedirs(cache_dir, exist_ok=True)
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(cache_dir)
+
+
+def precompile_templates(app):
+    count = 0
+    for name in app.jinja_env.list_templates():
+        try:
+            app.jinja_env.get_template(name)
+            count += 1
+        except Exception as e:
+            logger.warning(f"Could not compile template {name}: {e}")
+    return count
+
+
+def open_connections(app, count):
+    """Open ``count`` pooled connections at once so requests find them ready."""
+    db = app.extensions['sqlalchemy']
+    with app.app_context():
+        pool_size = getattr(db.engine.pool, 'size', lambda: count)()
+        connections = [db.engine.connect() for _ in range(min(count, pool_size))]
+        for conn in connections:
+            conn.exec_driver_sql('SELECT 1')
+        for conn in connections:
+            conn.close()
+    return len(connections)
+
+
+def prime_catalog(app):
+    """Run the catalog queries once and fill the price conversion cache."""
+    from app import usd_to_inr
+    from models import Product
+
+    with app.app_context():
+        products = Product.query.all()
+        for category in {product.category for product in products}:
+            Product.query.filter_by(category=category).all()
+        for product in products:
+            usd_to_inr(product.price_cents)
+    return len(products)
+
+
+def warm_requests(app, paths):
+    """Push a few requests through the full Flask stack and discard the responses."""
+    client = app.test_client()
+    for path in paths:
+        try:
+            client.get(path)
+        except Exception as e:
+            logger.warning(f"Warm-up request to {path} failed: {e}")
+
+
+def warm_up(app, connections=4):
+    """Warm this process up and mark it ready."""
+    started = time.perf_counter()
+    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+    install_bytecode_cache(app)
+    templates = precompile_templates(app)
+    opened = open_connections(app, connections)
+    products = prime_catalog(app)
+    warm_requests(app, app.config.get('WARMUP_PATHS', ('/',)))
+    _ready.set()
+    logger.info(f"Warm-up finished in {(time.perf_counter() - started) * 1000:.0f} ms: "
+                f"{templates} templates, {opened} connections, {products} products")